@@ -3,12 +3,13 @@
 
     Allows for data validation to be done by Fast Api, as well as error reporting and interactive documentation
 """
-from pydantic import BaseModel
+from pydantic import BaseModel, StrictBool, StrictInt, StrictFloat
 from typing import Any, List, Dict, Tuple, Union, Optional
 from typing_extensions import Literal
 
 class SavePathOutput(BaseModel):
     save_path : str
+    timings : Optional[Dict[str, Any]]
 
     class Config:
         schema_extra = {
@@ -1068,6 +1069,33 @@ class StandardNERTrainingApiParams(BaseModel):
     batch_size: Optional[int]
     lr_decay: Optional[float]
     build_data: bool
+    num_data_workers: Optional[int]
+    loader_workers: Optional[int]
+    prefetch_batches: Optional[int]
+    grad_accum_steps: Optional[int]
+    precision: Optional[Literal['fp32', 'bf16']]
+    checkpoint_every: Optional[int]
+    checkpoint_keep: Optional[int]
+    early_stop_patience: Optional[int]
+    early_stop_min_delta: Optional[float]
+    lr_plateau_patience: Optional[int]
+    lr_plateau_factor: Optional[float]
+    matcher_eval_every: Optional[int]
+    matcher_eval_samples: Optional[int]
+    sequence_eval_every: Optional[int]
+    sequence_eval_samples: Optional[int]
+    eval_in_background: Optional[bool]
+    eval_confusion_matrix: Optional[bool]
+    train_processes: Optional[int]
+    weak_label_batch_size: Optional[int]
+    trigger_index: Optional[bool]
+    trigger_index_nlist: Optional[int]
+    trigger_index_nprobe: Optional[int]
+    timings: Optional[bool]
+    profile: Optional[bool]
+    profile_steps: Optional[int]
+    memory_budget_mb: Optional[float]
+    memory_tracemalloc: Optional[bool]
 
 
 class StandardNERTrainingPayload(BaseModel):
@@ -1104,6 +1132,32 @@ class LeanLifeStandardNERParams(BaseModel):
     pre_train_num_epochs: Optional[int]
     batch_size: Optional[int]
     lr_decay: Optional[float]
+    num_data_workers: Optional[int]
+    loader_workers: Optional[int]
+    prefetch_batches: Optional[int]
+    grad_accum_steps: Optional[int]
+    precision: Optional[Literal['fp32', 'bf16']]
+    checkpoint_every: Optional[int]
+    checkpoint_keep: Optional[int]
+    early_stop_patience: Optional[int]
+    early_stop_min_delta: Optional[float]
+    lr_plateau_patience: Optional[int]
+    lr_plateau_factor: Optional[float]
+    matcher_eval_every: Optional[int]
+    matcher_eval_samples: Optional[int]
+    sequence_eval_every: Optional[int]
+    sequence_eval_samples: Optional[int]
+    eval_in_background: Optional[bool]
+    eval_confusion_matrix: Optional[bool]
+    train_processes: Optional[int]
+    weak_label_batch_size: Optional[int]
+    trigger_index: Optional[bool]
+    trigger_index_nlist: Optional[int]
+    trigger_index_nprobe: Optional[int]
+    profile: Optional[bool]
+    profile_steps: Optional[int]
+    memory_budget_mb: Optional[float]
+    memory_tracemalloc: Optional[bool]
 
     class Config:
         schema_extra = {
@@ -1124,6 +1178,7 @@ class StandardNEREvalDataOutput(BaseModel):
     precision: float
     recall: float
     f1: float
+    timings: Optional[Dict[str, Any]]
 
     class Config:
         schema_extra = {
@@ -1147,6 +1202,19 @@ class EvalStandardNERApiParams(BaseModel):
     emb_dim: Optional[int]
     hidden_dim: Optional[int]
     seed: Optional[int]
+    num_data_workers: Optional[int]
+    loader_workers: Optional[int]
+    prefetch_batches: Optional[int]
+    precision: Optional[Literal['fp32', 'bf16']]
+    trigger_index: Optional[bool]
+    trigger_index_nlist: Optional[int]
+    trigger_index_nprobe: Optional[int]
+    crf_transition_mask: Optional[bool]
+    decode_mode: Optional[Literal['viterbi', 'greedy']]
+    eval_confusion_matrix: Optional[bool]
+    timings: Optional[bool]
+    profile: Optional[bool]
+    memory_budget_mb: Optional[float]
 
     class Config:
         schema_extra = {
@@ -1196,6 +1264,7 @@ class NERPredictionOutputs(BaseModel):
     class_preds: List[Any]
     trigger_preds: List[Any]
     distance_preds: List[Any]
+    timings: Optional[Dict[str, Any]]
 
     class Config:
         schema_extra = {
@@ -1209,6 +1278,7 @@ class NERPredictionOutputs(BaseModel):
 
 class StandardNERPredictionOutputs(BaseModel):
     class_preds: List[Any]
+    timings: Optional[Dict[str, Any]]
 
     class Config:
         schema_extra = {
@@ -1252,3 +1322,79 @@ class ExplanationTriggerTrainingPayload(BaseModel):
     explanation_triples: Optional[List[ExplanationTriple]]
     dev_data: Optional[List[LabeledDoc]]
     eval_data: Optional[List[LabeledDoc]]
+
+
+class TriggerLabeledDoc(BaseModel):
+    text: str
+    label: str
+    explanation: str
+
+
+class TriggerSweepSearch(BaseModel):
+    mode: Literal['grid', 'random']
+    space: Dict[str, List[Union[StrictBool, StrictInt, StrictFloat]]]
+    num_trials: Optional[int]
+    workers: Optional[int]
+    threads_per_trial: Optional[int]
+    keep_models: Optional[bool]
+
+
+class TriggerSweepPayload(BaseModel):
+    params: StandardNERTrainingApiParams
+    search: TriggerSweepSearch
+    labeled_data: List[TriggerLabeledDoc]
+    dev_data: List[LabeledDoc]
+    eval_data: Optional[List[LabeledDoc]]
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "params": {
+                    "experiment_name": "trigger_sweep",
+                    "dataset_name": "IDRISI-RE-flood",
+                    "task": "ner",
+                    "build_data": True,
+                    "num_epochs": 10,
+                    "pre_train_num_epochs": 10
+                },
+                "search": {
+                    "mode": "grid",
+                    "space": {
+                        "hidden_dim": [100, 200],
+                        "dropout": [0.3, 0.5],
+                        "learning_rate": [0.01]
+                    },
+                    "threads_per_trial": 1
+                },
+                "labeled_data": [
+                    {
+                        "text": "Maldives offers financial assistance to flood hit Sri Lanka",
+                        "label": "O O O O O O O B-LOC I-LOC",
+                        "explanation": "O O O O O T-0 T-0 O O"
+                    }
+                ],
+                "dev_data": [
+                    {
+                        "text": "Medical camp at Mathugama today .",
+                        "label": "O O O B-LOC O O"
+                    }
+                ]
+            }
+        }
+
+
+class SweepTrialOutput(BaseModel):
+    trial: int
+    params: Dict[str, Union[StrictBool, StrictInt, StrictFloat]]
+    dev_precision: float
+    dev_recall: float
+    dev_f1: float
+    test_precision: Optional[float]
+    test_recall: Optional[float]
+    test_f1: Optional[float]
+    epochs_run: int
+    wall_time: float
+
+
+class SweepOutput(BaseModel):
+    trials: List[SweepTrialOutput]
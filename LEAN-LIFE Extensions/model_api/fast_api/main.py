@@ -9,13 +9,19 @@
 
     To access interactive docs and dummy test data navigate to http://127.0.0.1:9000/docs after running the
     above command
+
+    Setting MODEL_API_PROFILE=1 profiles every prediction, evaluation and training run with torch.profiler, the traces
+    are written to MODEL_API_PROFILE_DIR (see `trigger_ner/utilities/profiling.py`)
 """
 import json
 import os
 import sys
+import time
 import torch
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, BackgroundTasks, Request
 from fastapi import status
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Match
 
 sys.path.append(".")
 sys.path.append("../model_training/")
@@ -26,12 +32,75 @@ from internal_api.internal_main import train_next_framework_lean_life, train_nex
     train_standard_lean_life, evaluate_standard, predict_next, predict_standard, train_standard_ner_pipeline, \
     train_standard_ner_lean_life, evaluate_standard_ner, predict_standard_ner, train_trigger_soft_match_pipeline, \
     evaluate_trigger_ner, predict_trigger_ner, train_trigger_soft_match_lean_life
+from internal_api.sweep import trigger_sweep_pipeline
+from trigger_ner.utilities.timing import StageTimer
+from trigger_ner.utilities.metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, TRAINING_JOBS
 
 # We don't have a sophisticated CUDA Management policy, so please make needed changes to fit your needs
 os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 app = FastAPI()
 
 
+def run_timed(name, requested, pipeline, *args):
+    """
+        Runs `pipeline`, returning its result and, when `requested`, the time spent in every stage of the run
+    """
+    if not requested:
+        return pipeline(*args), None
+    timer = StageTimer(name)
+    with timer.activate():
+        result = pipeline(*args)
+    timer.log()
+    return result, timer.summary()
+
+
+def queue_training(name, pipeline):
+    """
+        Counts a training job as queued until the background task starts `pipeline`, then as running until it ends
+    """
+    TRAINING_JOBS.inc(pipeline=name, state="queued")
+
+    def run(*args):
+        TRAINING_JOBS.dec(pipeline=name, state="queued")
+        with TRAINING_JOBS.track(pipeline=name, state="running"):
+            return pipeline(*args)
+    return run
+
+
+def route_name(scope):
+    """
+        Path template of the route serving the request, so that e.g. every download is counted under one route
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    method, route = request.method, route_name(request.scope)
+    start = time.perf_counter()
+    status_code = 500
+    with REQUESTS_IN_FLIGHT.track(method=method, route=route):
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, route=route)
+            REQUESTS.inc(method=method, route=route, status=str(status_code))
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+        Request, training, prediction and process metrics in the Prometheus text format
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.post("/training/next/lean-life/", status_code=status.HTTP_201_CREATED)
 async def start_next_training_lean_life(lean_life_payload: schema.LeanLifePayload, background_tasks: BackgroundTasks):
     """
@@ -47,8 +116,8 @@ async def start_next_training_lean_life(lean_life_payload: schema.LeanLifePayloa
         unlabeled_docs = None
     if len(explanation_triples) == 0:
         explanation_triples = None
-    background_tasks.add_task(train_next_framework_lean_life, params.__dict__, label_space, unlabeled_docs,
-                              explanation_triples, ner_label_space)
+    background_tasks.add_task(queue_training("next", train_next_framework_lean_life), params.__dict__, label_space,
+                              unlabeled_docs, explanation_triples, ner_label_space)
 
 
 @app.post("/training/next/api/", status_code=status.HTTP_200_OK, response_model=schema.SavePathOutput)
@@ -74,8 +143,9 @@ async def start_next_training_api(api_payload: schema.ExplanationTrainingPayload
             data["dev_data"][i] = doc.dict()
     else:
         data["dev_data"] = None
-    return schema.SavePathOutput(save_path=train_next_framework(data, label_space, unlabeled_docs,
-                                                                explanation_triples, ner_label_space))
+    with TRAINING_JOBS.track(pipeline="next", state="running"):
+        save_path = train_next_framework(data, label_space, unlabeled_docs, explanation_triples, ner_label_space)
+    return schema.SavePathOutput(save_path=save_path)
 
 
 @app.post("/training/next/eval", status_code=status.HTTP_200_OK, response_model=schema.NextEvalDataOutput)
@@ -173,9 +243,9 @@ async def start_standard_training_api(api_payload: schema.StandardPipelinePayloa
         labeled_docs = None
     if len(dev_docs) == 0:
         dev_docs = None
-    return schema.SavePathOutput(
-        save_path=train_standard_pipeline(params.dict(), label_space, labeled_docs, dev_docs, ner_label_space)
-    )
+    with TRAINING_JOBS.track(pipeline="standard", state="running"):
+        save_path = train_standard_pipeline(params.dict(), label_space, labeled_docs, dev_docs, ner_label_space)
+    return schema.SavePathOutput(save_path=save_path)
 
 
 @app.post("/training/standard/lean-life/", status_code=status.HTTP_201_CREATED)
@@ -194,8 +264,8 @@ async def start_standard_training_lean_life(lean_life_payload: schema.LeanLifeSt
         labeled_docs = None
     if len(dev_docs) == 0:
         dev_docs = None
-    background_tasks.add_task(train_standard_lean_life, params.dict(), label_space, labeled_docs, dev_docs,
-                              ner_label_space)
+    background_tasks.add_task(queue_training("standard", train_standard_lean_life), params.dict(), label_space,
+                              labeled_docs, dev_docs, ner_label_space)
 
 
 @app.post("/training/standard/eval", status_code=status.HTTP_200_OK, response_model=schema.StandardEvalDataOutput)
@@ -244,7 +314,8 @@ async def start_standard_training_ner_lean_life(lean_life_payload: schema.LeanLi
         labeled_docs = None
     if len(dev_docs) == 0:
         dev_docs = None
-    background_tasks.add_task(train_standard_ner_lean_life, params.dict(), labeled_docs, dev_docs)
+    background_tasks.add_task(queue_training("standard_ner", train_standard_ner_lean_life), params.dict(),
+                              labeled_docs, dev_docs)
 
 
 @app.post("/training/standard/ner/api/", status_code=status.HTTP_200_OK, response_model=schema.SavePathOutput)
@@ -266,8 +337,10 @@ async def start_standard_training_ner_api(api_payload: schema.StandardNERTrainin
             eval_docs[i] = doc.dict()
     else:
         eval_docs = None
-    return schema.SavePathOutput(
-                    save_path=train_standard_ner_pipeline(params.dict(), labeled_docs, dev_docs, eval_docs))
+    with TRAINING_JOBS.track(pipeline="standard_ner", state="running"):
+        save_path, timings = run_timed("standard_ner_training", params.timings, train_standard_ner_pipeline,
+                                       params.dict(), labeled_docs, dev_docs, eval_docs)
+    return schema.SavePathOutput(save_path=save_path, timings=timings)
 
 
 @app.post("/training/standard/ner/eval", status_code=status.HTTP_200_OK, response_model=schema.StandardNEREvalDataOutput)
@@ -278,8 +351,9 @@ async def start_eval_standard_ner(api_payload: schema.EvalStandardNERPayload):
     """
     params = api_payload.params.dict()
     params["eval_data"] = api_payload.eval_data
-    precision, recall, f1 = evaluate_standard_ner(params)
-    return schema.StandardNEREvalDataOutput(precision=precision, recall=recall, f1=f1)
+    (precision, recall, f1), timings = run_timed("standard_ner_eval", params.get("timings"), evaluate_standard_ner,
+                                                 params)
+    return schema.StandardNEREvalDataOutput(precision=precision, recall=recall, f1=f1, timings=timings)
 
 
 @app.post("/training/standard/ner/predict", status_code=status.HTTP_200_OK, response_model=schema.StandardNERPredictionOutputs)
@@ -290,8 +364,8 @@ async def start_predict_standard_ner(api_payload: schema.PredictStandardNERPaylo
     """
     params = api_payload.params.dict()
     params["prediction_data"] = api_payload.prediction_data
-    preds = predict_standard_ner(params)
-    return schema.StandardNERPredictionOutputs(class_preds=preds)
+    preds, timings = run_timed("standard_ner_predict", params.get("timings"), predict_standard_ner, params)
+    return schema.StandardNERPredictionOutputs(class_preds=preds, timings=timings)
 
 
 @app.post("/training/trigger/lean-life/", status_code=status.HTTP_201_CREATED)
@@ -308,8 +382,8 @@ async def start_trigger_training_lean_life(lean_life_payload: schema.LeanLifeTri
         unlabeled_docs = None
     if len(explanation_triples) == 0:
         explanation_triples = None
-    background_tasks.add_task(train_trigger_soft_match_lean_life, params.__dict__,unlabeled_docs,
-                              explanation_triples)
+    background_tasks.add_task(queue_training("trigger", train_trigger_soft_match_lean_life), params.__dict__,
+                              unlabeled_docs, explanation_triples)
 
 
 @app.post("/training/trigger/api/", status_code=status.HTTP_200_OK, response_model=schema.SavePathOutput)
@@ -343,9 +417,10 @@ async def start_trigger_training_api(api_payload: schema.ExplanationTriggerTrain
         eval_docs = []
 
     data["eval_data"] = eval_docs
-    return schema.SavePathOutput(save_path=train_trigger_soft_match_pipeline(
-                                    data, unlabeled_docs, explanation_triples
-                                ))
+    with TRAINING_JOBS.track(pipeline="trigger", state="running"):
+        save_path, timings = run_timed("trigger_training", params.timings, train_trigger_soft_match_pipeline, data,
+                                       unlabeled_docs, explanation_triples)
+    return schema.SavePathOutput(save_path=save_path, timings=timings)
 
 
 @app.post("/training/trigger/eval", status_code=status.HTTP_200_OK, response_model=schema.StandardNEREvalDataOutput)
@@ -356,8 +431,8 @@ async def eval_trigger(api_payload: schema.EvalStandardNERPayload):
     """
     params = api_payload.params.dict()
     params["eval_data"] = api_payload.eval_data
-    precision, recall, f1 = evaluate_trigger_ner(params)
-    return schema.StandardNEREvalDataOutput(precision=precision, recall=recall, f1=f1)
+    (precision, recall, f1), timings = run_timed("trigger_eval", params.get("timings"), evaluate_trigger_ner, params)
+    return schema.StandardNEREvalDataOutput(precision=precision, recall=recall, f1=f1, timings=timings)
 
 
 @app.post("/training/trigger/predict", status_code=status.HTTP_200_OK, response_model=schema.NERPredictionOutputs)
@@ -368,5 +443,27 @@ async def predict_trigger(api_payload: schema.PredictStandardNERPayload):
     """
     params = api_payload.params.dict()
     params["prediction_data"] = api_payload.prediction_data
-    preds, trigs, dists = predict_trigger_ner(params)
-    return schema.NERPredictionOutputs(class_preds=preds, trigger_preds=trigs, distance_preds=dists)
+    (preds, trigs, dists), timings = run_timed("trigger_predict", params.get("timings"), predict_trigger_ner, params)
+    return schema.NERPredictionOutputs(class_preds=preds, trigger_preds=trigs, distance_preds=dists, timings=timings)
+
+
+@app.post("/training/trigger/sweep/", status_code=status.HTTP_200_OK, response_model=schema.SweepOutput)
+def sweep_trigger(api_payload: schema.TriggerSweepPayload):
+    """
+        Endpoint used to run a hyperparameter sweep of the trigger framework. The data is built once and shared by
+        all trials, which run in parallel. `labeled_data` is trigger annotated in the TriggerNER format (see
+        `json_schema.py`), the trials are returned best dev f1 first. The trial models are deleted after scoring
+        unless `search.keep_models` is set.
+
+        A plain function, so FastAPI runs the sweep in its threadpool instead of blocking the event loop.
+    """
+    data = api_payload.params.dict()
+    data["labeled_data"] = [doc.dict() for doc in api_payload.labeled_data]
+    data["dev_data"] = [doc.dict() for doc in api_payload.dev_data]
+    if api_payload.eval_data is not None:
+        data["eval_data"] = [doc.dict() for doc in api_payload.eval_data]
+    search = api_payload.search
+    with TRAINING_JOBS.track(pipeline="trigger_sweep", state="running"):
+        trials = trigger_sweep_pipeline(data, search.space, search.mode, search.num_trials, search.workers,
+                                        search.threads_per_trial, bool(search.keep_models))
+    return schema.SweepOutput(trials=trials)
@@ -0,0 +1,167 @@
+"""
+    Micro-benchmarks of the trigger NER hot paths across batch sizes and sentence lengths
+
+    The trigger-annotated flood sentences are split into sentence-length buckets, and every component is timed on
+    batches of every batch size drawn from every bucket: `batching_list_instances`, `CharBiLSTM.forward`,
+    `SoftEncoder.forward` with and without trigger positions, `SoftMatcher.forward` with `ContrastiveLoss`,
+    `SoftSequence.forward`, and `SoftSequence.decode` split into encoder, matcher, nearest-trigger, attention and CRF
+    parts. The models are untrained, which does not change their cost.
+
+    Results are written as JSON. With --compare, every timing is also compared with the one of a saved baseline, and
+    the script exits with status 1 when a component got slower than --threshold times its baseline.
+
+    Usage:
+        python bench_components.py [--batch-sizes 1 10 32] [--repeats 20] [--output bench_components.json]
+        python bench_components.py --compare bench_components_baseline.json [--threshold 1.1]
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import torch
+
+from common import benchmark_payload, build_trigger_setup, extract_triggers, write_results
+from trigger_ner.utilities.utils import batching_list_instances
+from trigger_ner.utilities.precision import autocast
+from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
+from trigger_ner.model.soft_inferencer import SoftSequence
+
+# upper bounds of the sentence-length buckets, in tokens
+LENGTH_BUCKETS = (16, 32, 64, 1000)
+
+
+def time_ms(function, repeats, warmup=2):
+    """
+    Median and minimum wall time of `function` in milliseconds
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(1000 * (time.perf_counter() - start))
+    return float(np.median(times)), float(np.min(times))
+
+
+def bucket_instances(dataset):
+    buckets = {bound: [] for bound in LENGTH_BUCKETS}
+    for inst in dataset:
+        bound = next((bound for bound in LENGTH_BUCKETS if len(inst.input.words) <= bound), LENGTH_BUCKETS[-1])
+        buckets[bound].append(inst)
+    return buckets
+
+
+def component_timings(conf, matcher, matcher_trainer, sequence, triggers, insts, repeats):
+    """
+    Timing of every component on one batch of `insts`
+    """
+    timings = {"batching_list_instances": lambda: batching_list_instances(conf, insts)}
+    batch = batching_list_instances(conf, insts)[0]
+    words, lens, context_emb, chars, char_lens = batch[0:5]
+    trigger_positions, tags = batch[-2], batch[-3]
+
+    def contrastive_loss():
+        trig_rep, _, match_trig, match_sent = matcher(*batch[0:5], trigger_positions)
+        return matcher_trainer.contrastive_loss(match_trig, match_sent,
+                                                matcher_trainer.get_match_targets(trig_rep.size(0)))
+
+    results = {}
+    with torch.no_grad(), autocast(conf):
+        matcher.eval()
+        sequence.eval()
+        if conf.use_char_rnn:
+            timings["CharBiLSTM.forward"] = lambda: sequence.encoder.char_feature(chars, char_lens)
+        timings["SoftEncoder.forward"] = lambda: sequence.encoder(*batch[0:5], None)
+        timings["SoftEncoder.forward+triggers"] = lambda: sequence.encoder(*batch[0:5], trigger_positions)
+        timings["SoftMatcher.forward+ContrastiveLoss"] = contrastive_loss
+
+        # decode, part by part, every part on the outputs of the previous ones
+        output, sentence_mask, _, _ = sequence.encoder(*batch[0:5], None)
+        soft_sent_rep = sequence.match_representation(*batch[0:5])
+        trig_rep, _, _ = sequence.nearest_triggers(soft_sent_rep, triggers)
+        lstm_scores = sequence.hidden2tag(
+            torch.cat([output, sequence.trigger_attention(output, sentence_mask, trig_rep)], dim=2))
+        timings["decode.encoder"] = lambda: sequence.encoder(*batch[0:5], None)
+        timings["decode.matcher"] = lambda: sequence.match_representation(*batch[0:5])
+        timings["decode.nearest_trigger"] = lambda: sequence.nearest_triggers(soft_sent_rep, triggers)
+        timings["decode.attention"] = lambda: sequence.hidden2tag(
+            torch.cat([output, sequence.trigger_attention(output, sentence_mask, trig_rep)], dim=2))
+        timings["decode.crf"] = lambda: sequence.decode_labels(lstm_scores, lens)
+        timings["SoftSequence.decode"] = lambda: sequence.decode(*batch[0:5], triggers)
+        for name, function in timings.items():
+            results[name] = time_ms(function, repeats)
+
+    # the training forward builds the autograd graph
+    sequence.train()
+    results["SoftSequence.forward"] = time_ms(lambda: sequence(*batch[0:5], trigger_positions, tags), repeats)
+    return results
+
+
+def run(batch_sizes, repeats):
+    conf, dataset, dev_data, label_length = build_trigger_setup(benchmark_payload(experiment_name="bench_components"))
+    torch.manual_seed(conf.seed)
+    matcher = SoftMatcher(conf, label_length)
+    matcher_trainer = SoftMatcherTrainer(matcher, conf, dev_data, None)
+    triggers = extract_triggers(matcher_trainer, dataset)
+    sequence = SoftSequence(conf, matcher)
+
+    results = []
+    for bound, insts in bucket_instances(dataset).items():
+        for batch_size in batch_sizes:
+            if len(insts) < batch_size:
+                continue
+            conf.batch_size = batch_size
+            batch_insts = insts[:batch_size]
+            mean_length = float(np.mean([len(inst.input.words) for inst in batch_insts]))
+            for component, (median_ms, min_ms) in component_timings(conf, matcher, matcher_trainer, sequence,
+                                                                    triggers, batch_insts, repeats).items():
+                results.append({"component": component, "max_length": bound, "batch_size": batch_size,
+                                "mean_length": mean_length, "median_ms": median_ms, "min_ms": min_ms})
+                print("%-38s len<=%-5d batch %-4d %10.3f ms" % (component, bound, batch_size, median_ms))
+    return {"torch": torch.__version__, "threads": torch.get_num_threads(), "repeats": repeats, "results": results}
+
+
+def compare(report, baseline, threshold):
+    """
+    Print the ratio of every timing to its baseline
+    :return: whether a component got slower than `threshold` times its baseline
+    """
+    key = lambda result: (result["component"], result["max_length"], result["batch_size"])
+    baseline_ms = {key(result): result["median_ms"] for result in baseline["results"]}
+    regressed = False
+    print("%-38s %9s %6s %12s %12s %8s" % ("component", "max len", "batch", "baseline ms", "current ms", "ratio"))
+    for result in report["results"]:
+        if key(result) not in baseline_ms:
+            continue
+        ratio = result["median_ms"] / baseline_ms[key(result)] if baseline_ms[key(result)] else float("inf")
+        slower = ratio > threshold
+        regressed = regressed or slower
+        print("%-38s %9d %6d %12.3f %12.3f %7.2fx%s" % (result["component"], result["max_length"],
+                                                       result["batch_size"], baseline_ms[key(result)],
+                                                       result["median_ms"], ratio, "  SLOWER" if slower else ""))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 32])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", default="bench_components.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="report of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.1, help="ratio to the baseline that counts as slower")
+    args = parser.parse_args()
+
+    report = run(args.batch_sizes, args.repeats)
+    write_results(args.output, report)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
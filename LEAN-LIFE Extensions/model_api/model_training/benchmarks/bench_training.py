@@ -0,0 +1,115 @@
+"""
+    Epoch wall time and peak memory of the matcher and sequence training loops on the IDRISI flood data
+
+    Compares the shared `TrainLoop` fed by a prefetching `BatchLoader` against the loop both trainers used before it
+    (all batches padded up front, retained graphs, `train()` on every step, tensor loss accumulation and contrastive
+    targets rebuilt per batch). Every variant runs in its own process so peak RSS is comparable.
+
+    Usage:
+        python bench_training.py [--epochs 3] [--output bench_training.json]
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from common import benchmark_payload, build_trigger_setup, extract_triggers, peak_rss_mb, write_results
+from trigger_ner.utilities.utils import batching_list_instances, get_optimizer
+from trigger_ner.utilities.train_loop import TrainLoop
+from trigger_ner.utilities.batch_loader import BatchLoader
+from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
+from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
+
+
+def legacy_matcher_epoch(trainer, optimizer, batched_data):
+    criterion = nn.NLLLoss()
+    epoch_loss = 0
+    trainer.model.zero_grad()
+    for index in np.random.permutation(len(batched_data)):
+        trainer.model.train()
+        trig_rep, trig_type_probas, match_trig, match_sent = trainer.model(*batched_data[index][0:5],
+                                                                           batched_data[index][-2])
+        trigger_loss = criterion(trig_type_probas, batched_data[index][-1])
+        soft_matching_loss = trainer.contrastive_loss(match_trig, match_sent, torch.stack(
+            [torch.tensor(1)] * trig_rep.size(0) + [torch.tensor(0)] * trig_rep.size(0)))
+        loss = trigger_loss + soft_matching_loss
+        epoch_loss = epoch_loss + loss.data
+        loss.backward(retain_graph=True)
+        optimizer.step()
+        trainer.model.zero_grad()
+    return epoch_loss.item()
+
+
+def legacy_sequence_epoch(trainer, optimizer, batched_data):
+    epoch_loss = 0
+    trainer.model.zero_grad()
+    for index in np.random.permutation(len(batched_data)):
+        trainer.model.train()
+        loss = trainer.model(*batched_data[index][0:5], batched_data[index][-2], batched_data[index][-3])
+        epoch_loss = epoch_loss + loss.data
+        loss.backward(retain_graph=True)
+        optimizer.step()
+        trainer.model.zero_grad()
+    return epoch_loss.item()
+
+
+def run_variant(trainer_name, variant, epochs):
+    payload = benchmark_payload()
+    conf, dataset, dev_data, label_length = build_trigger_setup(payload)
+    torch.manual_seed(conf.seed)
+    np.random.seed(conf.seed)
+
+    encoder = SoftMatcher(conf, label_length)
+    trainer = SoftMatcherTrainer(encoder, conf, dev_data, None)
+    if trainer_name == "sequence":
+        triggers = extract_triggers(trainer, dataset)
+        trainer = SoftSequenceTrainer(SoftSequence(conf, encoder), conf, dev_data, None, triggers)
+    batched_data = batching_list_instances(conf, dataset) if variant == "legacy" \
+        else BatchLoader(conf, dataset, shuffle=True)
+    optimizer = get_optimizer(conf, trainer.model, "adam" if trainer_name == "matcher" else "sgd")
+    legacy_epoch = legacy_matcher_epoch if trainer_name == "matcher" else legacy_sequence_epoch
+    train_loop = TrainLoop(trainer.model, optimizer, trainer.step_loss, conf)
+
+    rss_before = peak_rss_mb()
+    epoch_times = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        if variant == "legacy":
+            legacy_epoch(trainer, optimizer, batched_data)
+        else:
+            train_loop.run_epoch(batched_data)
+        epoch_times.append(time.perf_counter() - start)
+    return {"trainer": trainer_name, "variant": variant, "epoch_seconds": epoch_times,
+            "mean_epoch_seconds": float(np.mean(epoch_times)), "peak_rss_mb": peak_rss_mb(),
+            "training_rss_growth_mb": peak_rss_mb() - rss_before}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--output", default="bench_training.json")
+    parser.add_argument("--run", nargs=2, metavar=("TRAINER", "VARIANT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_variant(args.run[0], args.run[1], args.epochs)))
+        return
+
+    results = []
+    for trainer_name in ("matcher", "sequence"):
+        for variant in ("legacy", "train_loop"):
+            output = subprocess.run([sys.executable, __file__, "--epochs", str(args.epochs), "--run", trainer_name,
+                                     variant], check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            print("%(trainer)-8s %(variant)-10s %(mean_epoch_seconds)8.2fs/epoch  peak RSS %(peak_rss_mb)8.1f MB"
+                  % results[-1])
+    write_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
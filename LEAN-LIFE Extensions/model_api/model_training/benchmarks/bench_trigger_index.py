@@ -0,0 +1,117 @@
+"""
+    Benchmark of the IVF trigger index against the exhaustive trigger search of `SoftSequence.decode`
+
+    Synthetic banks of clustered trigger vectors, growing to tens of thousands of triggers, are searched with batches
+    of sentence-sized queries. For every bank size the report holds the search time per batch of the exhaustive
+    search and of the index, the index build time and the recall@1 against exact search for several nprobe values.
+    With --idrisi, the recall@1 is also measured on the triggers and dev sentences of the flood data.
+
+    Usage:
+        python bench_trigger_index.py [--sizes 1000 5000 20000 50000] [--idrisi] [--output trigger_index.json]
+"""
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+import torch
+
+PATH_TO_PARENT = str(pathlib.Path(__file__).parent.absolute()) + "/"
+sys.path.append(PATH_TO_PARENT + "../")
+
+from trigger_ner.utilities.trigger_index import TriggerIndex
+
+NPROBES = (1, 4, 8, 16)
+
+
+def exhaustive_search(queries, vectors):
+    # the search of SoftSequence.decode without an index
+    n, m, d = queries.size(0), vectors.size(0), queries.size(1)
+    dist = torch.pow(queries.unsqueeze(1).expand(n, m, d) - vectors.unsqueeze(0).expand(n, m, d), 2).sum(2).sqrt()
+    return torch.min(dist, dim=1)
+
+
+def clustered(centers, size, generator):
+    return centers[torch.randint(len(centers), (size,), generator=generator)] + \
+        torch.randn(size, centers.size(1), generator=generator)
+
+
+def seconds_per_call(function, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+def run_size(size, dim, batch_size, num_queries, repeats):
+    generator = torch.Generator().manual_seed(size)
+    # trigger phrases come in groups of similar meaning, about 50 triggers per group
+    centers = 3 * torch.randn(max(1, size // 50), dim, generator=generator)
+    vectors = clustered(centers, size, generator)
+    queries = clustered(centers, num_queries, generator)
+    batch = queries[:batch_size]
+
+    start = time.perf_counter()
+    index = TriggerIndex(vectors)
+    build_seconds = time.perf_counter() - start
+    with torch.no_grad():
+        return {"size": size, "nlist": index.nlist, "build_seconds": build_seconds,
+                "exhaustive_ms": 1000 * seconds_per_call(lambda: exhaustive_search(batch, vectors), repeats),
+                "index_ms": {nprobe: 1000 * seconds_per_call(lambda: index.search(batch, nprobe), repeats)
+                             for nprobe in NPROBES},
+                "recall_at_1": {nprobe: index.recall_at_1(queries, nprobe) for nprobe in NPROBES}}
+
+
+def run_idrisi(matcher_epochs):
+    from common import benchmark_payload, build_trigger_setup, extract_triggers
+    from trigger_ner.utilities.batch_loader import BatchLoader
+    from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
+    from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
+
+    conf, dataset, dev_data, label_length = build_trigger_setup(benchmark_payload())
+    torch.manual_seed(conf.seed)
+    encoder = SoftMatcher(conf, label_length)
+    matcher_trainer = SoftMatcherTrainer(encoder, conf, dev_data, None)
+    matcher_trainer.train_model(matcher_epochs, dataset)
+    triggers = extract_triggers(matcher_trainer, dataset)
+    results = {"triggers": len(triggers[0]), "recall_at_1": {}}
+    for nprobe in NPROBES:
+        sequence_trainer = SoftSequenceTrainer(SoftSequence(conf, encoder), conf, dev_data, None, triggers,
+                                               TriggerIndex(triggers[0], nprobe=nprobe, seed=conf.seed))
+        results["recall_at_1"][nprobe] = sequence_trainer.trigger_index_recall(BatchLoader(conf, dev_data))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--dim", type=int, default=100, help="trigger vector size, hidden_dim // 2")
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--idrisi", action="store_true")
+    parser.add_argument("--matcher-epochs", type=int, default=5)
+    parser.add_argument("--output", default="trigger_index.json")
+    args = parser.parse_args()
+
+    report = {"synthetic": []}
+    print("%8s %6s %9s %14s %s" % ("triggers", "nlist", "build s", "exhaustive ms",
+                                   " ".join("ivf%-2d ms  r@1 " % nprobe for nprobe in NPROBES)))
+    for size in args.sizes:
+        result = run_size(size, args.dim, args.batch_size, args.queries, args.repeats)
+        report["synthetic"].append(result)
+        print("%8d %6d %9.2f %14.2f %s" % (size, result["nlist"], result["build_seconds"], result["exhaustive_ms"],
+                                          " ".join("%8.2f %5.3f" % (result["index_ms"][nprobe],
+                                                                    result["recall_at_1"][nprobe])
+                                                   for nprobe in NPROBES)))
+    if args.idrisi:
+        report["idrisi"] = run_idrisi(args.matcher_epochs)
+        print("IDRISI flood, %d triggers, dev recall@1: %s" % (report["idrisi"]["triggers"],
+                                                             report["idrisi"]["recall_at_1"]))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+    Parity report of bfloat16 autocast against fp32 on the IDRISI test sets
+
+    Trains the soft matcher and the sequence model on the flood data once per precision, each in its own process and
+    with the same seed, and reports for every test set the precision, recall and F1 of both runs, the share of tokens
+    labelled identically, training time and peak RSS.
+
+    Usage:
+        python bf16_parity.py [--matcher-epochs 5] [--epochs 10] [--output bf16_parity.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from common import TEST_SETS, benchmark_payload, build_trigger_setup, build_test_set, extract_triggers, peak_rss_mb, \
+    write_results
+from trigger_ner.utilities.batch_loader import BatchLoader
+from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
+from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
+
+
+def run_precision(precision, matcher_epochs, epochs, predictions_path):
+    payload = benchmark_payload(precision=precision, experiment_name="benchmark_" + precision)
+    conf, dataset, dev_data, label_length = build_trigger_setup(payload)
+    torch.manual_seed(conf.seed)
+    np.random.seed(conf.seed)
+
+    start = time.perf_counter()
+    encoder = SoftMatcher(conf, label_length)
+    matcher_trainer = SoftMatcherTrainer(encoder, conf, dev_data, None)
+    matcher_trainer.train_model(matcher_epochs, dataset)
+    triggers = extract_triggers(matcher_trainer, dataset)
+    sequence_trainer = SoftSequenceTrainer(SoftSequence(conf, encoder), conf, dev_data, None, triggers)
+    sequence_trainer.train_model(epochs, dataset, False)
+    train_seconds = time.perf_counter() - start
+
+    sequence_trainer.model.eval()
+    metrics = {}
+    predictions = {}
+    with torch.no_grad():
+        for name in TEST_SETS:
+            test_data = build_test_set(conf, name)
+            start = time.perf_counter()
+            metrics[name] = sequence_trainer.evaluate_model(BatchLoader(conf, test_data), name, test_data, triggers)
+            metrics[name].append(time.perf_counter() - start)
+            sequence_trainer.predict_model(BatchLoader(conf, test_data), test_data, triggers)
+            predictions[name] = [inst.prediction[0] for inst in test_data]
+    with open(predictions_path, "w") as f:
+        json.dump(predictions, f)
+    return {"precision": precision, "train_seconds": train_seconds, "peak_rss_mb": peak_rss_mb(),
+            "metrics": {name: dict(zip(("precision", "recall", "f1", "eval_seconds"), values))
+                        for name, values in metrics.items()}}
+
+
+def agreement(predictions_a, predictions_b):
+    same = total = 0
+    for labels_a, labels_b in zip(predictions_a, predictions_b):
+        same += sum(a == b for a, b in zip(labels_a, labels_b))
+        total += len(labels_a)
+    return same / total if total else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--matcher-epochs", type=int, default=5)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--output", default="bf16_parity.json")
+    parser.add_argument("--run", nargs=2, metavar=("PRECISION", "PREDICTIONS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_precision(args.run[0], args.matcher_epochs, args.epochs, args.run[1])))
+        return
+
+    print("CPU capability: %s" % torch.backends.cpu.get_cpu_capability())
+    runs = {}
+    predictions = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for precision in ("fp32", "bf16"):
+            predictions_path = os.path.join(tmp, precision + ".json")
+            output = subprocess.run([sys.executable, __file__, "--matcher-epochs", str(args.matcher_epochs),
+                                     "--epochs", str(args.epochs), "--run", precision, predictions_path],
+                                    check=True, capture_output=True, text=True).stdout
+            runs[precision] = json.loads(output.strip().splitlines()[-1])
+            with open(predictions_path, "r") as f:
+                predictions[precision] = json.load(f)
+
+    report = {"runs": runs, "test_sets": {}}
+    print("%-32s %8s %8s %8s %10s" % ("test set", "fp32 F1", "bf16 F1", "delta", "agreement"))
+    for name in TEST_SETS:
+        f1_fp32 = runs["fp32"]["metrics"][name]["f1"]
+        f1_bf16 = runs["bf16"]["metrics"][name]["f1"]
+        token_agreement = agreement(predictions["fp32"][name], predictions["bf16"][name])
+        report["test_sets"][name] = {"f1_delta": f1_bf16 - f1_fp32, "token_agreement": token_agreement}
+        print("%-32s %8.2f %8.2f %8.2f %9.2f%%" % (name, f1_fp32, f1_bf16, f1_bf16 - f1_fp32, 100 * token_agreement))
+    for precision, run in runs.items():
+        print("%s: training %.1fs, peak RSS %.1f MB" % (precision, run["train_seconds"], run["peak_rss_mb"]))
+    write_results(args.output, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+    Shared setup of the benchmark scripts
+
+    Builds the IDRISI-RE data under `Dataset/` the same way `trigger_soft_match_pipeline` does, so benchmarks run on
+    production-shaped inputs without going through the API. The corpora are read in the columnar format of
+    `columnar.py`, converted once into `benchmarks/corpora/`.
+"""
+import json
+import pathlib
+import resource
+import sys
+
+PATH_TO_PARENT = str(pathlib.Path(__file__).parent.absolute()) + "/"
+sys.path.append(PATH_TO_PARENT + "../")
+sys.path.append(PATH_TO_PARENT + "../../")
+
+from trigger_ner.utilities.config import Config
+from trigger_ner.utilities.reader import Reader
+from trigger_ner.utilities.run_options import apply_run_options
+from trigger_ner.utilities.embedding_store import build_emb_table
+from trigger_ner.utilities.duplicates import remove_duplicates
+from trigger_ner.utilities.columnar import load_corpus
+from trigger_ner.utilities import parallel_builder
+
+DATASET_DIR = str(pathlib.Path(__file__).absolute().parents[4] / "Dataset") + "/"
+FLOOD_TRIGGERS = "explanation_IDRISI-RE-flood_tokenized.json"
+FLOOD_DEV = "dev_IDRISI-RE-flood.json"
+TEST_SETS = ["test_IDRISI-RE-cyclone.json", "test_IDRISI-RE-hurricane.json"]
+CORPUS_DIR = PATH_TO_PARENT + "corpora/"
+
+
+def load_dataset(name):
+    """
+    Memory-mapped columnar view of a corpus under `Dataset/`, which `Reader.build_data` takes like the JSON list
+    """
+    return load_corpus(DATASET_DIR + name, CORPUS_DIR + name + ".columnar")
+
+
+def benchmark_payload(**params):
+    """
+    Training payload with the defaults used for the IDRISI experiments, `params` override single fields
+    """
+    payload = {
+        "experiment_name": "benchmark",
+        "dataset_name": "idrisi_benchmark",
+        "task": "ner",
+        "embeddings": "glove.6B.100d",
+        "emb_dim": 100,
+        "seed": 1337,
+        "digit2zero": True,
+        "hidden_dim": 200,
+        "dropout": 0.5,
+        "use_char_rnn": True,
+        "use_crf_layer": True,
+        "trig_optimizer": "adam",
+        "batch_size": 10,
+        "build_data": True,
+    }
+    payload.update(params)
+    return payload
+
+
+def build_trigger_setup(payload):
+    """
+    Config, trigger-annotated training instances, dev instances and label_length for the flood data
+    """
+    conf = apply_run_options(Config(payload), payload)
+    conf.optimizer = conf.trig_optimizer
+    reader = Reader(conf.digit2zero)
+    train_data, _, label_length = reader.build_trigger_data(load_dataset(FLOOD_TRIGGERS))
+    reader.merge_labels(train_data)
+    dev_data = parallel_builder.build_data(reader, conf, load_dataset(FLOOD_DEV), "dev")
+
+    conf.build_label_idx(train_data)
+    conf.build_word_idx(train_data, dev_data)
+    build_emb_table(conf)
+    parallel_builder.map_insts_ids(conf, train_data)
+    parallel_builder.map_insts_ids(conf, dev_data)
+    dataset = reader.trigger_percentage(train_data, conf.percentage)
+    return conf, dataset, dev_data, label_length
+
+
+def build_test_set(conf, name):
+    reader = Reader(conf.digit2zero)
+    return parallel_builder.build_data(reader, conf, load_dataset(name), "eval", with_ids=True)
+
+
+def extract_triggers(matcher_trainer, dataset):
+    logits, predicted, triggers = matcher_trainer.get_triggervec(dataset)
+    return remove_duplicates(logits, predicted, triggers, dataset)
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, benchmarks run every variant in a fresh process to compare it
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_results(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
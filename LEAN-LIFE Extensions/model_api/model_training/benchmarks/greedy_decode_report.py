@@ -0,0 +1,75 @@
+"""
+    F1 and decode time of the greedy decode mode against Viterbi on the IDRISI test sets
+
+    Trains the soft matcher and the sequence model on the flood data once, then evaluates and predicts every test set
+    with `decode_mode` "viterbi" and "greedy". Reports precision, recall and F1 of both modes, the F1 delta, the time
+    spent evaluating and the share of tokens labelled identically.
+
+    Usage:
+        python greedy_decode_report.py [--matcher-epochs 5] [--epochs 10] [--output greedy_decode_report.json]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from common import TEST_SETS, benchmark_payload, build_trigger_setup, build_test_set, extract_triggers, write_results
+from bf16_parity import agreement
+from trigger_ner.utilities.batch_loader import BatchLoader
+from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
+from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
+
+DECODE_MODES = ("viterbi", "greedy")
+
+
+def decode_test_set(sequence_trainer, conf, test_data, triggers, decode_mode, name):
+    conf.decode_mode = decode_mode
+    start = time.perf_counter()
+    metrics = sequence_trainer.evaluate_model(BatchLoader(conf, test_data), name, test_data, triggers)
+    seconds = time.perf_counter() - start
+    sequence_trainer.predict_model(BatchLoader(conf, test_data), test_data, triggers)
+    result = dict(zip(("precision", "recall", "f1"), metrics))
+    result["eval_seconds"] = seconds
+    return result, [inst.prediction[0] for inst in test_data]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--matcher-epochs", type=int, default=5)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--output", default="greedy_decode_report.json")
+    args = parser.parse_args()
+
+    conf, dataset, dev_data, label_length = build_trigger_setup(benchmark_payload(experiment_name="benchmark_greedy"))
+    torch.manual_seed(conf.seed)
+    np.random.seed(conf.seed)
+    encoder = SoftMatcher(conf, label_length)
+    matcher_trainer = SoftMatcherTrainer(encoder, conf, dev_data, None)
+    matcher_trainer.train_model(args.matcher_epochs, dataset)
+    triggers = extract_triggers(matcher_trainer, dataset)
+    sequence_trainer = SoftSequenceTrainer(SoftSequence(conf, encoder), conf, dev_data, None, triggers)
+    sequence_trainer.train_model(args.epochs, dataset, False)
+
+    sequence_trainer.model.eval()
+    report = {}
+    print("%-32s %11s %10s %8s %13s %13s %10s" % ("test set", "viterbi F1", "greedy F1", "delta", "viterbi time",
+                                                  "greedy time", "agreement"))
+    with torch.no_grad():
+        for name in TEST_SETS:
+            test_data = build_test_set(conf, name)
+            results, predictions = {}, {}
+            for decode_mode in DECODE_MODES:
+                results[decode_mode], predictions[decode_mode] = decode_test_set(sequence_trainer, conf, test_data,
+                                                                                 triggers, decode_mode, name)
+            f1_delta = results["greedy"]["f1"] - results["viterbi"]["f1"]
+            token_agreement = agreement(predictions["viterbi"], predictions["greedy"])
+            report[name] = {"modes": results, "f1_delta": f1_delta, "token_agreement": token_agreement}
+            print("%-32s %11.2f %10.2f %8.2f %12.2fs %12.2fs %9.2f%%" % (
+                name, results["viterbi"]["f1"], results["greedy"]["f1"], f1_delta,
+                results["viterbi"]["eval_seconds"], results["greedy"]["eval_seconds"], 100 * token_agreement))
+    write_results(args.output, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+    Load test of the model API with a concurrent mix of prediction and evaluation requests
+
+    Starts the FastAPI app of `fast_api/main.py`, on a local port in a child process by default or in this process with
+    --in-process, and sends requests from --concurrency concurrent clients for --duration seconds. Every request picks
+    an endpoint of --mix by weight, its payload holds sentences sampled from the IDRISI test sets under `Dataset/`.
+    `update_model_training` and `send_model_metadata` are replaced by local stubs, so no LEAN-LIFE server is needed.
+
+    The models must be trained beforehand; --trigger-params and --standard-params point to json files with the params
+    of the eval/predict payloads (experiment_name, dataset_name, ...), by default those of the benchmark experiments.
+    The report holds throughput, p50/p95/p99 latency and error rate per endpoint and overall, and the server RSS over
+    time.
+
+    Usage:
+        python load_test.py [--concurrency 8] [--duration 60] [--mix trigger_predict=6 trigger_eval=1
+                            standard_predict=3] [--sentences 10] [--in-process] [--output load_test.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import os
+import pathlib
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+from common import DATASET_DIR, TEST_SETS, benchmark_payload, write_results
+
+FAST_API_DIR = str(pathlib.Path(__file__).absolute().parents[2] / "fast_api")
+MODEL_API_DIR = str(pathlib.Path(__file__).absolute().parents[2])
+
+ENDPOINTS = {
+    "trigger_predict": "/training/trigger/predict",
+    "trigger_eval": "/training/trigger/eval",
+    "standard_predict": "/training/standard/ner/predict",
+}
+# fields of the benchmark payload accepted by the eval/predict params
+PARAM_FIELDS = ("experiment_name", "dataset_name", "task", "embeddings", "emb_dim", "hidden_dim", "seed", "batch_size")
+
+
+def _stub(name):
+    def callback(*args, **kwargs):
+        logging.debug("stubbed %s%s" % (name, args))
+    return callback
+
+
+def load_app():
+    """
+    FastAPI app of main.py with the LEAN-LIFE callbacks stubbed
+    """
+    # main.py resolves the model code relative to the working directory
+    os.chdir(FAST_API_DIR)
+    for path in (FAST_API_DIR, MODEL_API_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # the pipelines import the callbacks as fast_api.fast_api_util_functions, main.py as fast_api_util_functions
+    import fast_api_util_functions
+    import fast_api.fast_api_util_functions as package_util_functions
+    for module in (fast_api_util_functions, package_util_functions):
+        module.update_model_training = _stub("update_model_training")
+        module.send_model_metadata = _stub("send_model_metadata")
+    import main
+    return main.app
+
+
+def serve(port):
+    import uvicorn
+    uvicorn.run(load_app(), host="127.0.0.1", port=port, log_level="warning")
+
+
+def rss_mb(pid):
+    with open("/proc/%d/status" % pid, "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval):
+        super(RssSampler, self).__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.start_time = time.perf_counter()
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.samples.append((time.perf_counter() - self.start_time, rss_mb(self.pid)))
+            except OSError:
+                return
+            self.stopped.wait(self.interval)
+
+
+class PayloadFactory(object):
+    def __init__(self, trigger_params, standard_params, sentences, seed):
+        self.params = {"trigger_predict": trigger_params, "trigger_eval": trigger_params,
+                       "standard_predict": standard_params}
+        self.sentences = sentences
+        self.random = random.Random(seed)
+        self.docs = []
+        for name in TEST_SETS:
+            with open(DATASET_DIR + name, "r", encoding="utf8") as f:
+                self.docs.extend(json.load(f))
+
+    def __call__(self, endpoint):
+        docs = self.random.sample(self.docs, min(self.sentences, len(self.docs)))
+        if endpoint == "trigger_eval":
+            return {"params": self.params[endpoint], "eval_data": [[doc["text"], doc["label"]] for doc in docs]}
+        return {"params": self.params[endpoint], "prediction_data": [doc["text"] for doc in docs]}
+
+
+async def client(http, endpoints, weights, payloads, deadline, records, rng):
+    while time.perf_counter() < deadline:
+        endpoint = rng.choices(endpoints, weights)[0]
+        payload = payloads(endpoint)
+        start = time.perf_counter()
+        try:
+            response = await http.post(ENDPOINTS[endpoint], json=payload)
+            ok = response.status_code == 200
+        except Exception as e:
+            logging.warning("%s failed: %s" % (endpoint, e))
+            ok = False
+        records.append((endpoint, start, time.perf_counter() - start, ok))
+
+
+async def drive(http, mix, payloads, concurrency, duration, seed):
+    endpoints, weights = list(mix), list(mix.values())
+    records = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[client(http, endpoints, weights, payloads, deadline, records, random.Random(seed + i))
+                           for i in range(concurrency)])
+    return records
+
+
+def summarize(records, duration):
+    def stats(rows):
+        latencies = np.asarray([latency for _, _, latency, _ in rows]) * 1000
+        errors = sum(not ok for _, _, _, ok in rows)
+        if not len(latencies):
+            return {"requests": 0}
+        return {"requests": len(rows), "errors": errors, "error_rate": errors / len(rows),
+                "throughput": len(rows) / duration, "mean_ms": float(latencies.mean()),
+                "p50_ms": float(np.percentile(latencies, 50)), "p95_ms": float(np.percentile(latencies, 95)),
+                "p99_ms": float(np.percentile(latencies, 99))}
+
+    summary = {"overall": stats(records)}
+    for endpoint in sorted({record[0] for record in records}):
+        summary[endpoint] = stats([record for record in records if record[0] == endpoint])
+    return summary
+
+
+def wait_until_ready(url, process, timeout):
+    import httpx
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if not process.is_alive():
+            raise RuntimeError("The API server exited during start up")
+        try:
+            if httpx.get(url + "/docs").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("The API server did not start within %d seconds" % timeout)
+
+
+def read_params(path):
+    if path:
+        with open(path, "r") as f:
+            return json.load(f)
+    payload = benchmark_payload()
+    return {field: payload[field] for field in PARAM_FIELDS}
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        endpoint, weight = item.split("=")
+        if endpoint not in ENDPOINTS:
+            raise ValueError("Unknown endpoint %s, expected one of %s" % (endpoint, ", ".join(ENDPOINTS)))
+        mix[endpoint] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of load")
+    parser.add_argument("--mix", nargs="+", default=["trigger_predict=6", "trigger_eval=1", "standard_predict=3"])
+    parser.add_argument("--sentences", type=int, default=10, help="sentences per request")
+    parser.add_argument("--trigger-params", help="json file with the params of the trigger requests")
+    parser.add_argument("--standard-params", help="json file with the params of the standard NER requests")
+    parser.add_argument("--in-process", action="store_true", help="serve the app in this process over ASGI")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--startup-timeout", type=int, default=120)
+    parser.add_argument("--rss-interval", type=float, default=1.0, help="seconds between server RSS samples")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--output", default="load_test.json")
+    args = parser.parse_args()
+
+    import httpx
+    mix = parse_mix(args.mix)
+    payloads = PayloadFactory(read_params(args.trigger_params), read_params(args.standard_params), args.sentences,
+                              args.seed)
+    # serving in process changes the working directory
+    output = os.path.abspath(args.output)
+    timeout = httpx.Timeout(None)
+    process = None
+    if args.in_process:
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=load_app()), base_url="http://load-test",
+                                 timeout=timeout)
+        server_pid = os.getpid()
+    else:
+        process = mp.get_context("spawn").Process(target=serve, args=(args.port,), daemon=True)
+        process.start()
+        url = "http://127.0.0.1:%d" % args.port
+        wait_until_ready(url, process, args.startup_timeout)
+        http = httpx.AsyncClient(base_url=url, timeout=timeout)
+        server_pid = process.pid
+
+    sampler = RssSampler(server_pid, args.rss_interval)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        records = asyncio.run(drive(http, mix, payloads, args.concurrency, args.duration, args.seed))
+    finally:
+        duration = time.perf_counter() - start
+        sampler.stopped.set()
+        sampler.join()
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    summary = summarize(records, duration)
+    print("%-18s %9s %7s %9s %10s %10s %10s" % ("endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms",
+                                               "p99 ms"))
+    for endpoint, stats in summary.items():
+        if stats["requests"]:
+            print("%-18s %9d %7d %9.2f %10.1f %10.1f %10.1f" % (endpoint, stats["requests"], stats["errors"],
+                                                               stats["throughput"], stats["p50_ms"], stats["p95_ms"],
+                                                               stats["p99_ms"]))
+    rss = [mb for _, mb in sampler.samples]
+    if rss:
+        print("server RSS: start %.1f MB, peak %.1f MB, end %.1f MB" % (rss[0], max(rss), rss[-1]))
+    write_results(output, {"concurrency": args.concurrency, "duration": duration, "mix": mix,
+                                "sentences_per_request": args.sentences, "in_process": args.in_process,
+                                "summary": summary, "server_rss_mb": sampler.samples})
+
+
+if __name__ == "__main__":
+    main()
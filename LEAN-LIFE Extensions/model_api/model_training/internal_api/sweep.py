@@ -0,0 +1,194 @@
+"""
+    Hyperparameter sweeps over the trigger pipeline
+
+    The data, vocab and embedding table are built once. Trials then run in worker processes, each limited to
+    `threads_per_trial` torch threads, and the dev/test scores and wall time of every trial are collected into one
+    table. Only fields that leave the built data untouched can be swept.
+    The workers are started with forkserver (spawn where it is not available) rather than forked from the API server,
+    and get the built data through the pool initializer, so the server's own torch threads are never changed. Sweeps
+    run one at a time, a second one waits for the first to finish.
+    The models and checkpoints every trial saves are deleted once its scores are collected, unless `keep_models`.
+"""
+import copy
+import glob
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import pathlib
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+PATH_TO_PARENT = str(pathlib.Path(__file__).parent.absolute()) + "/"
+sys.path.append(PATH_TO_PARENT)
+sys.path.append(PATH_TO_PARENT + "../")
+sys.path.append(PATH_TO_PARENT + "../../")
+
+from trigger_ner.utilities.config import Config
+from trigger_ner.utilities.reader import Reader
+from trigger_ner.utilities.batch_loader import BatchLoader
+from trigger_ner.utilities.duplicates import remove_duplicates
+from trigger_ner.utilities.embedding_store import build_emb_table
+from trigger_ner.utilities.run_options import apply_run_options
+from trigger_ner.utilities.trigger_index import build_trigger_index
+from trigger_ner.utilities import parallel_builder
+from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
+from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
+
+SWEEP_FIELDS = ("hidden_dim", "dropout", "learning_rate", "lr_decay", "batch_size", "use_char_rnn", "percentage")
+
+# state of a trial worker process, set by `_init_trial_worker`
+_trial = {}
+_sweep_lock = threading.Lock()
+
+
+def sweep_trials(space, mode="grid", num_trials=None, seed=1337):
+    """
+    Parameter overrides of every trial
+    :param space: candidate values per field, e.g. {"hidden_dim": [100, 200], "dropout": [0.3, 0.5]}
+    :param mode: "grid" for every combination, "random" for `num_trials` independent draws
+    """
+    unknown = [field for field in space if field not in SWEEP_FIELDS]
+    if unknown:
+        raise ValueError("Can't sweep %s, choose from %s" % (", ".join(unknown), ", ".join(SWEEP_FIELDS)))
+    fields = sorted(space)
+    if mode == "grid":
+        trials = [dict(zip(fields, values)) for values in itertools.product(*(space[field] for field in fields))]
+        return trials[:num_trials] if num_trials else trials
+    if mode == "random":
+        if not num_trials:
+            raise ValueError("A random sweep needs num_trials")
+        rng = random.Random(seed)
+        return [{field: rng.choice(space[field]) for field in fields} for _ in range(num_trials)]
+    raise ValueError("Unknown sweep mode %s" % mode)
+
+
+def build_sweep_data(payload):
+    """
+    Config, trigger-annotated training data, dev and eval data and label_length, built like
+    `trigger_soft_match_pipeline` does
+    """
+    conf = apply_run_options(Config(payload), payload)
+    conf.optimizer = conf.trig_optimizer
+    reader = Reader(conf.digit2zero)
+    train_data, _, label_length = reader.build_trigger_data(payload["labeled_data"])
+    reader.merge_labels(train_data)
+    dev_data = parallel_builder.build_data(reader, conf, payload["dev_data"], "dev")
+    eval_data = parallel_builder.build_data(reader, conf, payload["eval_data"], "eval") \
+        if payload.get("eval_data") else None
+
+    conf.build_label_idx(train_data)
+    conf.build_word_idx(train_data, dev_data)
+    build_emb_table(conf)
+    parallel_builder.map_insts_ids(conf, train_data)
+    parallel_builder.map_insts_ids(conf, dev_data)
+    if eval_data:
+        parallel_builder.map_insts_ids(conf, eval_data)
+    return conf, reader, train_data, dev_data, eval_data, label_length
+
+
+def remove_trial_artifacts(conf):
+    """
+    Delete the models and checkpoints a trial saved, and their directory when the trial was its only user
+    """
+    for kind in ("trigger_soft", "trigger"):
+        path = conf.generate_model_path(kind)
+        for artifact in glob.glob(glob.escape(path) + "*"):
+            if os.path.isfile(artifact):
+                os.remove(artifact)
+        directory = os.path.dirname(path)
+        if conf.experiment_name in os.path.basename(directory) and os.path.isdir(directory) \
+                and not os.listdir(directory):
+            os.rmdir(directory)
+
+
+def _init_trial_worker(state):
+    _trial.update(state)
+    torch.set_num_threads(state["threads_per_trial"])
+
+
+def run_trial(trial_id, overrides):
+    conf = copy.copy(_trial["conf"])
+    for field, value in overrides.items():
+        setattr(conf, field, value)
+    conf.experiment_name = "%s_trial%d" % (conf.experiment_name, trial_id)
+    conf.is_lean_life = False
+    # trials run in daemonic pool workers, which can't fork loader or training processes
+    conf.loader_workers = 0
+    conf.train_processes = 1
+    try:
+        return _train_trial(trial_id, overrides, conf)
+    finally:
+        if not _trial["keep_models"]:
+            remove_trial_artifacts(conf)
+
+
+def _train_trial(trial_id, overrides, conf):
+    random.seed(conf.seed)
+    np.random.seed(conf.seed)
+    torch.manual_seed(conf.seed)
+
+    start_time = time.time()
+    dev_data, eval_data = _trial["dev_data"], _trial["eval_data"]
+    dataset = _trial["reader"].trigger_percentage(_trial["train_data"], conf.percentage)
+    encoder = SoftMatcher(conf, _trial["label_length"])
+    trainer = SoftMatcherTrainer(encoder, conf, dev_data, eval_data)
+    random.shuffle(dataset)
+    trainer.train_model(conf.num_epochs_soft, dataset)
+    logits, predicted, triggers = trainer.get_triggervec(dataset)
+    triggers_remove = remove_duplicates(logits, predicted, triggers, dataset)
+
+    random.shuffle(dataset)
+    inference = SoftSequence(conf, encoder)
+    sequence_trainer = SoftSequenceTrainer(inference, conf, dev_data, None, triggers_remove,
+                                           build_trigger_index(conf, triggers_remove))
+    sequence_trainer.train_model(conf.num_epochs, dataset, True)
+
+    inference.eval()
+    with torch.no_grad():
+        dev_metrics = sequence_trainer.evaluate_model(BatchLoader(conf, dev_data), "dev", dev_data, triggers_remove)
+        test_metrics = sequence_trainer.evaluate_model(BatchLoader(conf, eval_data), "test", eval_data,
+                                                       triggers_remove) if eval_data else [None] * 3
+    return {"trial": trial_id, "params": overrides, "dev_precision": dev_metrics[0], "dev_recall": dev_metrics[1],
+            "dev_f1": dev_metrics[2], "test_precision": test_metrics[0], "test_recall": test_metrics[1],
+            "test_f1": test_metrics[2], "epochs_run": sequence_trainer.epochs_run,
+            "wall_time": time.time() - start_time}
+
+
+def _run_trial(args):
+    return run_trial(*args)
+
+
+def trigger_sweep_pipeline(payload, space, mode="grid", num_trials=None, workers=None, threads_per_trial=None,
+                           keep_models=False):
+    """
+    Run a sweep and return one row per trial, best dev F1 first
+    :param payload: trigger training params plus "labeled_data" in the trigger format
+        ({"text", "label", "explanation"}), "dev_data" and optionally "eval_data"
+    :param workers: trials run at once, defaults to as many as fit with `threads_per_trial` threads each
+    :param threads_per_trial: torch threads of every trial, defaults to 1
+    :param keep_models: keep the models and checkpoints of every trial instead of deleting them after scoring
+    """
+    with _sweep_lock:
+        return _run_sweep(payload, space, mode, num_trials, workers, threads_per_trial, keep_models)
+
+
+def _run_sweep(payload, space, mode, num_trials, workers, threads_per_trial, keep_models):
+    trials = sweep_trials(space, mode, num_trials, payload.get("seed") or 1337)
+    conf, reader, train_data, dev_data, eval_data, label_length = build_sweep_data(payload)
+    threads_per_trial = threads_per_trial or 1
+    workers = workers or max(1, (mp.cpu_count() or 1) // threads_per_trial)
+    workers = max(1, min(workers, len(trials)))
+    logging.info("Running %d trials on %d workers with %d threads each" % (len(trials), workers, threads_per_trial))
+
+    state = dict(conf=conf, reader=reader, train_data=train_data, dev_data=dev_data, eval_data=eval_data,
+                 label_length=label_length, threads_per_trial=threads_per_trial, keep_models=keep_models)
+    context = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+    with context.Pool(workers, initializer=_init_trial_worker, initargs=(state,), maxtasksperchild=1) as pool:
+        results = pool.map(_run_trial, list(enumerate(trials)), chunksize=1)
+    return sorted(results, key=lambda row: -row["dev_f1"])
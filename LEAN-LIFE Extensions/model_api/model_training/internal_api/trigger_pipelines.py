@@ -4,7 +4,6 @@
 import logging
 import pathlib
 import sys
-import pickle
 import random
 import time
 import torch
@@ -17,8 +16,18 @@ sys.path.append(PATH_TO_PARENT + "../../")
 
 from trigger_ner.utilities.config import Config
 from trigger_ner.utilities.reader import Reader
-from trigger_ner.utilities.utils import batching_list_instances
+from trigger_ner.utilities.batch_loader import BatchLoader
 from trigger_ner.utilities.duplicates import remove_duplicates
+from trigger_ner.utilities.data_cache import DataCache, read_vocab
+from trigger_ner.utilities.embedding_store import build_emb_table
+from trigger_ner.utilities.run_options import apply_run_options
+from trigger_ner.utilities.trigger_index import build_trigger_index
+from trigger_ner.utilities.trigger_store import save_triggers, load_triggers
+from trigger_ner.utilities.timing import stage, timed_pipeline
+from trigger_ner.utilities.memory import active_tracker, configure_memory
+from trigger_ner.utilities.profiling import profiled
+from trigger_ner.utilities.metrics import MODEL_LOAD_SECONDS, PREDICTION_SECONDS, SENTENCES_PREDICTED
+from trigger_ner.utilities import parallel_builder, distributed
 from trigger_ner.model.soft_inferencer_naive import SoftSequenceNaive, SoftSequenceNaiveTrainer
 from trigger_ner.model.soft_matcher import SoftMatcher, SoftMatcherTrainer
 from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
@@ -26,10 +35,23 @@ from trigger_ner.model.soft_inferencer import SoftSequence, SoftSequenceTrainer
 from fast_api.fast_api_util_functions import update_model_training, send_model_metadata
 
 
+def memory_report():
+    """
+    Stage of the run with the highest RSS peak so far, for the progress updates sent to LEAN-LIFE
+    """
+    tracker = active_tracker()
+    peak_stage = tracker.peak_stage() if tracker is not None else None
+    if peak_stage is None:
+        return ""
+    return ", peak RSS %.0f MB in %s" % (tracker.stages[peak_stage]["peak_rss_mb"], peak_stage)
+
+
+@timed_pipeline("standard_ner_training")
 def standard_ner_pipeline(payload):
     start_time = time.time()
     build_data = payload["build_data"]
-    conf = Config(payload)
+    conf = apply_run_options(Config(payload), payload)
+    configure_memory(conf)
 
     if conf.is_lean_life:
         update_model_training(
@@ -37,32 +59,48 @@ def standard_ner_pipeline(payload):
             "starting training pipeline"
         )
 
-    if build_data:
-        reader = Reader(conf.digit2zero)
-        train_data = reader.build_data(payload["labeled_data"], "labeled")
+    reader = Reader(conf.digit2zero)
+    cache = DataCache(conf, payload, {"labeled": "labeled_data", "dev": "dev_data", "eval": "eval_data"})
+
+    if not build_data and all(cache.contains(name) for name in ("vocab", "labeled", "dev", "eval")):
+        # load_data, the cache keys cover the payload data, reader settings and vocab
+        with stage("data_load"):
+            cache.load_vocab()
+            train_data = cache.load_instances("labeled")
+            dev_data = cache.load_instances("dev")
+            eval_data = cache.load_instances("eval")
+    else:
+        with stage("data_build"):
+            train_data = parallel_builder.build_data(reader, conf, payload["labeled_data"], "labeled")
 
-        # TODO: split data 80/20 if not present
-        if "dev_data" not in payload or payload["dev_data"] is None:
-            dev_data = None
-        else:
-            dev_data = reader.build_data(payload["dev_data"], "dev")
+            # TODO: split data 80/20 if not present
+            if "dev_data" not in payload or payload["dev_data"] is None:
+                dev_data = None
+            else:
+                dev_data = parallel_builder.build_data(reader, conf, payload["dev_data"], "dev")
 
-        if "eval_data" not in payload or payload["eval_data"] is None:
-            eval_data = None
-        else:
-            eval_data = reader.build_data(payload["eval_data"], "eval")
+            if "eval_data" not in payload or payload["eval_data"] is None:
+                eval_data = None
+            else:
+                eval_data = parallel_builder.build_data(reader, conf, payload["eval_data"], "eval")
 
         # vocab
-        conf.build_label_idx(train_data)
-        conf.build_word_idx(train_data, dev_data)
-        conf.build_emb_table()
-        conf.dump_label_word_emb_data()
-
-        conf.map_insts_ids(train_data, "labeled")
-        if dev_data:
-            conf.map_insts_ids(dev_data, "dev")
-        if eval_data:
-            conf.map_insts_ids(eval_data, "eval")
+        with stage("vocab_embedding"):
+            conf.build_label_idx(train_data)
+            conf.build_word_idx(train_data, dev_data)
+            build_emb_table(conf)
+            cache.save_vocab()
+
+        with stage("id_mapping"):
+            parallel_builder.map_insts_ids(conf, train_data)
+            if dev_data:
+                parallel_builder.map_insts_ids(conf, dev_data)
+            if eval_data:
+                parallel_builder.map_insts_ids(conf, eval_data)
+        with stage("data_cache_save"):
+            cache.save_instances("labeled", train_data)
+            cache.save_instances("dev", dev_data)
+            cache.save_instances("eval", eval_data)
 
         # TODO: ask dongho about implementation
         # if conf.context_emb == ContextEmb.bert:
@@ -75,19 +113,6 @@ def standard_ner_pipeline(payload):
                 conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1,
                 "built training data"
             )
-    else:
-        # load_data
-        with open(conf.generate_training_data_path("labeled"), 'rb') as f:
-            train_data = pickle.load(f)
-
-        with open(conf.generate_training_data_path("dev"), 'rb') as f:
-            dev_data = pickle.load(f)
-
-        with open(conf.generate_training_data_path("eval"), 'rb') as f:
-            eval_data = pickle.load(f)
-
-        # load vocab
-        conf.read_label_word_emd_data()
 
     # dataset division
     numbers = int(len(train_data) * conf.percentage / 100)
@@ -104,7 +129,8 @@ def standard_ner_pipeline(payload):
             conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1, "starting training"
         )
 
-    _, best_train_loss = trainer.train_model(conf.num_epochs, initial_trains)
+    with stage("training"):
+        _, best_train_loss = trainer.train_model(conf.num_epochs, initial_trains)
     model_save_path = conf.generate_model_path("naive")
 
     if conf.is_lean_life:
@@ -114,57 +140,71 @@ def standard_ner_pipeline(payload):
     return model_save_path
 
 
+@timed_pipeline("standard_ner_eval")
 def evaluate_standard_ner_pipeline(payload):
-    conf = Config(payload)
+    conf = apply_run_options(Config(payload), payload)
+    configure_memory(conf)
 
     # load vocab
-    conf.read_label_word_emd_data()
+    with stage("vocab_load"):
+        read_vocab(conf)
 
     reader = Reader(conf.digit2zero)
     eval_data = [{'text': tup[0], 'label': tup[1]} for tup in payload["eval_data"]]
-    eval_data = reader.build_data(eval_data, "eval")
-    conf.map_insts_ids(eval_data, "eval")
+    with stage("data_build"):
+        eval_data = parallel_builder.build_data(reader, conf, eval_data, "eval", with_ids=True)
 
-    encoder = SoftSequenceNaive(conf)
-    encoder.load_state_dict(
-        torch.load(conf.generate_model_path("naive"))
-    )
+    with stage("model_load"), MODEL_LOAD_SECONDS.time(pipeline="standard_ner_eval"):
+        encoder = SoftSequenceNaive(conf)
+        encoder.load_state_dict(
+            torch.load(conf.generate_model_path("naive"))
+        )
     trainer = SoftSequenceNaiveTrainer(encoder, conf)
 
     encoder.eval()
-    test_batches = batching_list_instances(conf, eval_data)
-    test_metrics = trainer.evaluate_model(test_batches, "eval", eval_data)
+    test_batches = BatchLoader(conf, eval_data)
+    with stage("evaluation"), PREDICTION_SECONDS.time(pipeline="standard_ner_eval"), profiled(conf, "evaluation"):
+        test_metrics = trainer.evaluate_model(test_batches, "eval", eval_data)
+    SENTENCES_PREDICTED.inc(len(eval_data), pipeline="standard_ner_eval")
     return test_metrics
 
 
+@timed_pipeline("standard_ner_predict")
 def predict_standard_ner_pipeline(payload):
-    conf = Config(payload)
+    conf = apply_run_options(Config(payload), payload)
+    configure_memory(conf)
 
     # load vocab
-    conf.read_label_word_emd_data()
+    with stage("vocab_load"):
+        read_vocab(conf)
 
     reader = Reader(conf.digit2zero)
     pred_data = [{'text': row} for row in payload["prediction_data"]]
-    pred_data = reader.build_data(pred_data, "pred")
-    conf.map_insts_ids(pred_data, "pred")
+    with stage("data_build"):
+        pred_data = parallel_builder.build_data(reader, conf, pred_data, "pred", with_ids=True)
 
-    encoder = SoftSequenceNaive(conf)
-    encoder.load_state_dict(
-        torch.load(conf.generate_model_path("naive"))
-    )
+    with stage("model_load"), MODEL_LOAD_SECONDS.time(pipeline="standard_ner_predict"):
+        encoder = SoftSequenceNaive(conf)
+        encoder.load_state_dict(
+            torch.load(conf.generate_model_path("naive"))
+        )
     trainer = SoftSequenceNaiveTrainer(encoder, conf)
 
     encoder.eval()
-    pred_batches = batching_list_instances(conf, pred_data)
-    trainer.predict_model(pred_batches, pred_data)
+    pred_batches = BatchLoader(conf, pred_data)
+    with stage("prediction"), PREDICTION_SECONDS.time(pipeline="standard_ner_predict"), profiled(conf, "prediction"):
+        trainer.predict_model(pred_batches, pred_data)
+    SENTENCES_PREDICTED.inc(len(pred_data), pipeline="standard_ner_predict")
 
     return list(map(lambda x: " ".join(x.prediction), pred_data))
 
 
+@timed_pipeline("trigger_training")
 def trigger_soft_match_pipeline(payload):
     start_time = time.time()
     build_data = payload["build_data"]
-    conf = Config(payload)
+    conf = apply_run_options(Config(payload), payload)
+    configure_memory(conf)
 
     if conf.is_lean_life:
         update_model_training(
@@ -175,32 +215,48 @@ def trigger_soft_match_pipeline(payload):
     conf.optimizer = conf.trig_optimizer
     reader = Reader(conf.digit2zero)
 
-    if build_data:
-        train_data, max_length, label_length = reader.build_trigger_data(payload["labeled_data"])
-        reader.merge_labels(train_data)
+    cache = DataCache(conf, payload, {"trigger": "labeled_data", "dev": "dev_data", "eval": "eval_data"})
+
+    if not build_data and all(cache.contains(name) for name in ("vocab", "trigger", "dev", "eval")):
+        # load_data, the cache keys cover the payload data, reader settings and vocab
+        with stage("data_load"):
+            label_length = cache.load_vocab()
+            train_data = cache.load_instances("trigger")
+            dev_data = cache.load_instances("dev")
+            eval_data = cache.load_instances("eval")
+    else:
+        with stage("data_build"):
+            train_data, max_length, label_length = reader.build_trigger_data(payload["labeled_data"])
+            reader.merge_labels(train_data)
 
-        # TODO: split data 80/20 if not present
-        if "dev_data" not in payload or payload["dev_data"] is None:
-            dev_data = None
-        else:
-            dev_data = reader.build_data(payload["dev_data"], "dev")
+            # TODO: split data 80/20 if not present
+            if "dev_data" not in payload or payload["dev_data"] is None:
+                dev_data = None
+            else:
+                dev_data = parallel_builder.build_data(reader, conf, payload["dev_data"], "dev")
 
-        if "eval_data" not in payload or payload["eval_data"] is None:
-            eval_data = None
-        else:
-            eval_data = reader.build_data(payload["eval_data"], "eval")
+            if "eval_data" not in payload or payload["eval_data"] is None:
+                eval_data = None
+            else:
+                eval_data = parallel_builder.build_data(reader, conf, payload["eval_data"], "eval")
 
         # vocab
-        conf.build_label_idx(train_data)
-        conf.build_word_idx(train_data, dev_data)
-        conf.build_emb_table()
-        conf.dump_label_word_emb_data(label_length)
-
-        conf.map_insts_ids(train_data, "trigger")
-        if dev_data:
-            conf.map_insts_ids(dev_data, "dev")
-        if eval_data:
-            conf.map_insts_ids(eval_data, "eval")
+        with stage("vocab_embedding"):
+            conf.build_label_idx(train_data)
+            conf.build_word_idx(train_data, dev_data)
+            build_emb_table(conf)
+            cache.save_vocab(label_length)
+
+        with stage("id_mapping"):
+            parallel_builder.map_insts_ids(conf, train_data)
+            if dev_data:
+                parallel_builder.map_insts_ids(conf, dev_data)
+            if eval_data:
+                parallel_builder.map_insts_ids(conf, eval_data)
+        with stage("data_cache_save"):
+            cache.save_instances("trigger", train_data)
+            cache.save_instances("dev", dev_data)
+            cache.save_instances("eval", eval_data)
 
         # TODO: ask dongho about implementation
         # if conf.context_emb == ContextEmb.bert:
@@ -213,19 +269,6 @@ def trigger_soft_match_pipeline(payload):
                 conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1,
                 "built training data"
             )
-    else:
-        # load_data
-        with open(conf.generate_training_data_path("trigger"), 'rb') as f:
-            train_data = pickle.load(f)
-
-        with open(conf.generate_training_data_path("dev"), 'rb') as f:
-            dev_data = pickle.load(f)
-
-        with open(conf.generate_training_data_path("eval"), 'rb') as f:
-            eval_data = pickle.load(f)
-
-        # load vocab
-        label_length = conf.read_label_word_emd_data()
 
     dataset = reader.trigger_percentage(train_data, conf.percentage)
     encoder = SoftMatcher(conf, label_length)
@@ -238,24 +281,29 @@ def trigger_soft_match_pipeline(payload):
         update_model_training(
             conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1, "starting pre-training"
         )
-    trainer.train_model(conf.num_epochs_soft, dataset)
+    with stage("matcher_training"):
+        distributed.run(trainer, "train_model", conf.num_epochs_soft, dataset)
     if conf.is_lean_life:
         time_spent = time.time() - start_time
         update_model_training(
-            conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1, "completed pre-training"
+            conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1,
+            "completed pre-training after %d of %d epochs" % (trainer.epochs_run, conf.num_epochs_soft)
         )
-    logits, predicted, triggers = trainer.get_triggervec(dataset)
-    triggers_remove = remove_duplicates(logits, predicted, triggers, dataset)
+    with stage("trigger_extraction"):
+        logits, predicted, triggers = trainer.get_triggervec(dataset)
+    with stage("remove_duplicates"):
+        triggers_remove = remove_duplicates(logits, predicted, triggers, dataset)
+    with stage("trigger_index"):
+        trigger_index = build_trigger_index(conf, triggers_remove)
 
     # write trigger data to file
-    path = conf.generate_training_data_path("soft_triggers")
-    with open(path, 'wb') as f:
-        pickle.dump(triggers_remove, f)
+    with stage("trigger_save"):
+        save_triggers(conf, triggers_remove)
 
     # sequence labeling module training
     random.shuffle(dataset)
     inference = SoftSequence(conf, encoder)
-    sequence_trainer = SoftSequenceTrainer(inference, conf, dev_data, eval_data, triggers_remove)
+    sequence_trainer = SoftSequenceTrainer(inference, conf, dev_data, eval_data, triggers_remove, trigger_index)
 
     if conf.is_lean_life:
         time_spent = time.time() - start_time
@@ -263,83 +311,109 @@ def trigger_soft_match_pipeline(payload):
             conf.project_id, conf.experiment_name, -1, conf.num_epochs, time_spent, -1, "starting training"
         )
 
-    _, best_train_loss = sequence_trainer.train_model(conf.num_epochs, dataset, True)
+    with stage("sequence_training"):
+        _, best_train_loss = distributed.run(sequence_trainer, "train_model", conf.num_epochs, dataset, True)
     model_save_path = conf.generate_model_path("trigger")
+    if trigger_index is not None and dev_data:
+        logging.info("Trigger index recall@1 on dev: %.4f" % sequence_trainer.trigger_index_recall(
+            BatchLoader(conf, dev_data)))
 
     if conf.is_lean_life:
+        # send_model_metadata has no field for them, so the epochs actually run and the memory peak are reported
+        # with the last update
+        time_spent = time.time() - start_time
+        update_model_training(
+            conf.project_id, conf.experiment_name, sequence_trainer.epochs_run, conf.num_epochs, time_spent,
+            best_train_loss, "completed training after %d of %d epochs%s" % (sequence_trainer.epochs_run,
+                                                                            conf.num_epochs, memory_report())
+        )
         file_size = os.path.getsize(model_save_path)
         send_model_metadata(conf.project_id, conf.experiment_name, model_save_path, best_train_loss, file_size)
 
     return model_save_path
 
 
+@timed_pipeline("trigger_eval")
 def evaluate_trigger_ner_pipeline(payload):
-    conf = Config(payload)
+    conf = apply_run_options(Config(payload), payload)
+    configure_memory(conf)
 
     # load vocab
-    label_length = conf.read_label_word_emd_data()
+    with stage("vocab_load"):
+        label_length = read_vocab(conf)
 
     reader = Reader(conf.digit2zero)
     eval_data = [{'text': tup[0], 'label': tup[1]} for tup in payload["eval_data"]]
-    eval_data = reader.build_data(eval_data, "eval")
-    conf.map_insts_ids(eval_data, "eval")
+    with stage("data_build"):
+        eval_data = parallel_builder.build_data(reader, conf, eval_data, "eval", with_ids=True)
 
     # load trigger data
-    path = conf.generate_training_data_path("soft_triggers")
-    with open(path, 'rb') as f:
-        triggers = pickle.load(f)
+    with stage("trigger_load"):
+        triggers = load_triggers(conf)
 
-    encoder = SoftMatcher(conf, label_length)
-    encoder.load_state_dict(
-        torch.load(conf.generate_model_path("trigger_soft"))
-    )
+    with stage("model_load"), MODEL_LOAD_SECONDS.time(pipeline="trigger_eval"):
+        encoder = SoftMatcher(conf, label_length)
+        encoder.load_state_dict(
+            torch.load(conf.generate_model_path("trigger_soft"))
+        )
 
-    inference = SoftSequence(conf, encoder)
-    inference.load_state_dict(
-        torch.load(conf.generate_model_path("trigger"))
-    )
-    sequence_trainer = SoftSequenceTrainer(inference, conf, None, None, triggers)
+        inference = SoftSequence(conf, encoder)
+        inference.load_state_dict(
+            torch.load(conf.generate_model_path("trigger"))
+        )
+    with stage("trigger_index"):
+        trigger_index = build_trigger_index(conf, triggers)
+    sequence_trainer = SoftSequenceTrainer(inference, conf, None, None, triggers, trigger_index)
 
     encoder.eval()
     inference.eval()
-    test_batches = batching_list_instances(conf, eval_data)
-    test_metrics = sequence_trainer.evaluate_model(test_batches, "eval", eval_data, triggers)
+    test_batches = BatchLoader(conf, eval_data)
+    with stage("evaluation"), PREDICTION_SECONDS.time(pipeline="trigger_eval"), profiled(conf, "evaluation"):
+        test_metrics = sequence_trainer.evaluate_model(test_batches, "eval", eval_data, triggers)
+    SENTENCES_PREDICTED.inc(len(eval_data), pipeline="trigger_eval")
 
     return test_metrics
 
 
+@timed_pipeline("trigger_predict")
 def predict_trigger_ner_pipeline(payload):
-    conf = Config(payload)
+    conf = apply_run_options(Config(payload), payload)
+    configure_memory(conf)
 
     # load vocab
-    label_length = conf.read_label_word_emd_data()
+    with stage("vocab_load"):
+        label_length = read_vocab(conf)
 
     reader = Reader(conf.digit2zero)
     pred_data = [{'text': text, 'label': " ".join("O" * (text.count(" ")+1))} for text in payload["prediction_data"]]
-    pred_data = reader.build_data(pred_data, "pred")
-    conf.map_insts_ids(pred_data, "pred")
+    with stage("data_build"):
+        pred_data = parallel_builder.build_data(reader, conf, pred_data, "pred", with_ids=True)
 
     # load trigger data
-    path = conf.generate_training_data_path("soft_triggers")
-    with open(path, 'rb') as f:
-        triggers = pickle.load(f)
+    with stage("trigger_load"):
+        triggers = load_triggers(conf)
 
-    encoder = SoftMatcher(conf, label_length)
-    encoder.load_state_dict(
-        torch.load(conf.generate_model_path("trigger_soft"))
-    )
+    with stage("model_load"), MODEL_LOAD_SECONDS.time(pipeline="trigger_predict"):
+        encoder = SoftMatcher(conf, label_length)
+        encoder.load_state_dict(
+            torch.load(conf.generate_model_path("trigger_soft"))
+        )
 
-    inference = SoftSequence(conf, encoder)
-    inference.load_state_dict(
-        torch.load(conf.generate_model_path("trigger"))
-    )
-    sequence_trainer = SoftSequenceTrainer(inference, conf, None, None, triggers)
+        inference = SoftSequence(conf, encoder)
+        inference.load_state_dict(
+            torch.load(conf.generate_model_path("trigger"))
+        )
+    with stage("trigger_index"):
+        trigger_index = build_trigger_index(conf, triggers)
+    sequence_trainer = SoftSequenceTrainer(inference, conf, None, None, triggers, trigger_index)
 
     encoder.eval()
     inference.eval()
 
-    pred_batches = batching_list_instances(conf, pred_data)
-    sequence_trainer.predict_model(pred_batches, pred_data, triggers)
+    pred_batches = BatchLoader(conf, pred_data)
+    with stage("prediction"), PREDICTION_SECONDS.time(pipeline="trigger_predict"), profiled(conf, "prediction"):
+        sequence_trainer.predict_model(pred_batches, pred_data, triggers)
+    SENTENCES_PREDICTED.inc(len(pred_data), pipeline="trigger_predict")
 
     preds = list(map(lambda x: (" ".join(x.prediction[0]), x.prediction[1], x.prediction[2]), pred_data))
     class_preds, trigger_preds, distance_preds = zip(*preds)
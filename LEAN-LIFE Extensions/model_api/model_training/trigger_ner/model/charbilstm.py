@@ -7,6 +7,8 @@ from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from overrides import overrides
 import logging
 
+from ..utilities.precision import autocast_input
+
 
 class CharBiLSTM(nn.Module):
 
@@ -45,7 +47,7 @@ class CharBiLSTM(nn.Module):
         sorted_seq_tensor = char_seq_tensor[permIdx]
 
         char_embeds = self.dropout(self.char_embeddings(sorted_seq_tensor))
-        pack_input = pack_padded_sequence(char_embeds, sorted_seq_len.cpu(), batch_first=True)
+        pack_input = pack_padded_sequence(autocast_input(char_embeds), sorted_seq_len.cpu(), batch_first=True)
 
         _, char_hidden = self.char_lstm(pack_input, None)
         hidden = char_hidden[0].transpose(1, 0).contiguous().view(batch_size * sent_len, 1,
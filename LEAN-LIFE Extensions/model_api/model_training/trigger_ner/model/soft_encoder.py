@@ -10,6 +10,8 @@ import torch.nn as nn
 import torch
 
 from ..utilities.config import ContextEmb
+from ..utilities.precision import autocast_input
+from ..utilities.profiling import labelled
 from .charbilstm import CharBiLSTM
 
 
@@ -41,6 +43,7 @@ class SoftEncoder(nn.Module):
             self.word_drop = encoder.word_drop
             self.lstm = encoder.lstm
 
+    @labelled("SoftEncoder.forward")
     def forward(self, word_seq_tensor: torch.Tensor,
                 word_seq_lens: torch.Tensor,
                 batch_context_emb: torch.Tensor,
@@ -69,7 +72,7 @@ class SoftEncoder(nn.Module):
         word_rep = self.word_drop(word_emb)
         sorted_seq_len, permIdx = word_seq_lens.sort(0, descending=True)
         _, recover_idx = permIdx.sort(0, descending=False)
-        sorted_seq_tensor = word_rep[permIdx]
+        sorted_seq_tensor = autocast_input(word_rep[permIdx])
         packed_words = pack_padded_sequence(sorted_seq_tensor, sorted_seq_len.cpu(), True)
         output, _ = self.lstm(packed_words, None)
         output, _ = pad_packed_sequence(output, batch_first=True)
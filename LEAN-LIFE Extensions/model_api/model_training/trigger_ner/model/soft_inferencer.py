@@ -4,6 +4,7 @@ using the most suitable triggers as additional inputs to inferencer. (CRF)
 
 Written in 2020 by Dong-Ho Lee.
 """
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -16,8 +17,18 @@ import sys
 import pathlib
 
 from ..utilities.config import ContextEmb
-from ..utilities.utils import batching_list_instances, get_optimizer
-from ..utilities.eval import evaluate_batch_insts
+from ..utilities.utils import get_optimizer
+from ..utilities.batch_loader import BatchLoader
+from ..utilities.span_metrics import SpanMetrics, format_confusion
+from ..utilities.viterbi import transition_mask, viterbi_decode, label_tables, greedy_decode
+from ..utilities.train_loop import TrainLoop
+from ..utilities.precision import autocast, full_precision
+from ..utilities.checkpoint import CheckpointManager
+from ..utilities.schedule import early_stopping, get_optimizer_and_scheduler
+from ..utilities.eval_schedule import EvalSchedule, apply_results
+from ..utilities.timing import span
+from ..utilities.profiling import label, labelled, profiled
+from ..utilities import distributed
 from .linear_crf_inferencer import LinearCRF
 from .soft_encoder import SoftEncoder
 
@@ -41,6 +52,10 @@ class SoftSequence(nn.Module):
         self.softmatch_attention = softmatcher.attention
         self.label_size = config.label_size
         self.inferencer = LinearCRF(config, print_info=print_info)
+        # transitions decode may take, None leaves them to the learned CRF transitions
+        self.transition_mask = transition_mask(config.idx2labels).to(self.device) \
+            if getattr(config, "crf_transition_mask", False) else None
+        self.label_tables = label_tables(config.idx2labels, self.device)
         self.hidden2tag = nn.Linear(config.hidden_dim * 2, self.label_size).to(self.device)
 
         self.w1 = nn.Linear(config.hidden_dim, config.hidden_dim // 2).to(self.device)
@@ -64,78 +79,83 @@ class SoftSequence(nn.Module):
         batch_size = word_seq_tensor.size(0)
         max_sent_len = word_seq_tensor.size(1)
 
-        output, sentence_mask, trigger_vec, trigger_mask = \
-            self.encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens,
-                         trigger_position)
-
-        if trigger_vec is not None:
-            trig_rep, sentence_vec_cat, trigger_vec_cat = self.softmatch_attention(output, sentence_mask, trigger_vec,
-                                                                                   trigger_mask)
-
-            # attention
-            weights = []
-            for i in range(len(output)):
-                trig_applied = self.tanh(
-                    self.w1(output[i].unsqueeze(0)) + self.w2(trig_rep[i].unsqueeze(0).unsqueeze(0)))
-                x = self.attn1(trig_applied)  # 63,1
-                x = torch.mul(x.squeeze(0), sentence_mask[i].unsqueeze(1))
-                x[x == 0] = float('-inf')
-                weights.append(x)
-            normalized_weights = F.softmax(torch.stack(weights), 1)
-            attn_applied1 = torch.mul(normalized_weights.repeat(1, 1, output.size(2)), output)
-        else:
-            weights = []
-            for i in range(len(output)):
-                trig_applied = self.tanh(
-                    self.w1(output[i].unsqueeze(0)) + self.w1(output[i].unsqueeze(0)))
-                x = self.attn1(trig_applied)  # 63,1
-                x = torch.mul(x.squeeze(0), sentence_mask[i].unsqueeze(1))
-                x[x == 0] = float('-inf')
-                weights.append(x)
-            normalized_weights = F.softmax(torch.stack(weights), 1)
-            attn_applied1 = torch.mul(normalized_weights.repeat(1, 1, output.size(2)), output)
-
-        output = torch.cat([output, attn_applied1], dim=2)
-        lstm_scores = self.hidden2tag(output)
+        with autocast(self.config):
+            output, sentence_mask, trigger_vec, trigger_mask = \
+                self.encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens,
+                             trigger_position)
+
+            if trigger_vec is not None:
+                with label("SoftAttention.forward"):
+                    trig_rep, sentence_vec_cat, trigger_vec_cat = self.softmatch_attention(output, sentence_mask,
+                                                                                           trigger_vec, trigger_mask)
+
+                # attention
+                attn_applied1 = self.trigger_attention(output, sentence_mask, trig_rep)
+            else:
+                with label("SoftSequence.self_attention"):
+                    weights = []
+                    for i in range(len(output)):
+                        trig_applied = self.tanh(
+                            self.w1(output[i].unsqueeze(0)) + self.w1(output[i].unsqueeze(0)))
+                        x = self.attn1(trig_applied)  # 63,1
+                        x = torch.mul(x.squeeze(0), sentence_mask[i].unsqueeze(1))
+                        x[x == 0] = float('-inf')
+                        weights.append(x)
+                    normalized_weights = F.softmax(torch.stack(weights), 1)
+                    attn_applied1 = torch.mul(normalized_weights.repeat(1, 1, output.size(2)), output)
+
+            output = torch.cat([output, attn_applied1], dim=2)
+            lstm_scores = self.hidden2tag(output)
+        # the CRF and the sequence loss are computed in fp32
+        lstm_scores = lstm_scores.float()
         maskTemp = torch.arange(1, max_sent_len + 1, dtype=torch.long).view(1, max_sent_len).expand(batch_size,
                                                                                                     max_sent_len).to(
             self.device)
         mask = torch.le(maskTemp, word_seq_lens.view(batch_size, 1).expand(batch_size, max_sent_len)).to(self.device)
 
-        if self.inferencer is not None:
-            unlabeled_score, labeled_score = self.inferencer(lstm_scores, word_seq_lens, tags, mask)
-            sequence_loss = unlabeled_score - labeled_score
-        else:
-            sequence_loss = self.compute_nll_loss(lstm_scores, tags, mask, word_seq_lens)
+        with full_precision(self.config), label("LinearCRF.forward"):
+            if self.inferencer is not None:
+                unlabeled_score, labeled_score = self.inferencer(lstm_scores, word_seq_lens, tags, mask)
+                sequence_loss = unlabeled_score - labeled_score
+            else:
+                sequence_loss = self.compute_nll_loss(lstm_scores, tags, mask, word_seq_lens)
 
         return sequence_loss
 
-    def decode(self, word_seq_tensor: torch.Tensor,
-               word_seq_lens: torch.Tensor,
-               batch_context_emb: torch.Tensor,
-               char_inputs: torch.Tensor,
-               char_seq_lens: torch.Tensor,
-               trig_rep):
-
-        output, sentence_mask, _, _ = \
-            self.encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens, None)
-
+    def match_representation(self, word_seq_tensor: torch.Tensor,
+                             word_seq_lens: torch.Tensor,
+                             batch_context_emb: torch.Tensor,
+                             char_inputs: torch.Tensor,
+                             char_seq_lens: torch.Tensor):
+        """
+        Sentence representations of the soft matcher, which are compared to the trigger vectors
+        """
         soft_output, soft_sentence_mask, _, _ = \
-            self.softmatch_encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens, None)
-        soft_sent_rep = self.softmatch_attention.attention(soft_output, soft_sentence_mask)
-
+            self.softmatch_encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens,
+                                   None)
+        with label("SoftAttention.attention"):
+            return self.softmatch_attention.attention(soft_output, soft_sentence_mask)
+
+    def nearest_triggers(self, soft_sent_rep: torch.Tensor, trig_rep, trigger_index=None):
+        """
+        Vector, key and distance of the trigger closest to every sentence representation
+        :param trigger_index: optional `TriggerIndex` over `trig_rep`, finds the closest triggers approximately
+        """
         trig_vec = trig_rep[0]
         trig_key = trig_rep[1]
 
-        n = soft_sent_rep.size(0)
-        m = trig_vec.size(0)
-        d = soft_sent_rep.size(1)
+        if trigger_index is not None:
+            dvalue, dindices = trigger_index.search(soft_sent_rep)
+        else:
+            n = soft_sent_rep.size(0)
+            m = trig_vec.size(0)
+            d = soft_sent_rep.size(1)
 
-        soft_sent_rep_dist = soft_sent_rep.unsqueeze(1).expand(n, m, d)
-        trig_vec_dist = trig_vec.unsqueeze(0).expand(n, m, d)
+            soft_sent_rep_dist = soft_sent_rep.unsqueeze(1).expand(n, m, d)
+            trig_vec_dist = trig_vec.unsqueeze(0).expand(n, m, d)
 
-        dist = torch.pow(soft_sent_rep_dist - trig_vec_dist, 2).sum(2).sqrt()
-        dvalue, dindices = torch.min(dist, dim=1)
+            dist = torch.pow(soft_sent_rep_dist - trig_vec_dist, 2).sum(2).sqrt()
+            dvalue, dindices = torch.min(dist, dim=1)
         dvalue = dvalue.tolist()
 
         trigger_list = []
@@ -143,29 +163,73 @@ class SoftSequence(nn.Module):
         for i in dindices.tolist():
             trigger_list.append(trig_vec[i])
             trigger_keys.append(trig_key[i])
-        trig_rep = torch.stack(trigger_list)
+        return torch.stack(trigger_list), trigger_keys, dvalue
 
-        # attention
+    @labelled("SoftSequence.trigger_attention")
+    def trigger_attention(self, output: torch.Tensor, sentence_mask: torch.Tensor, trig_rep: torch.Tensor):
+        """
+        Sentence encodings weighted by their attention to the trigger of every sentence
+        """
         weights = []
         for i in range(len(output)):
-            trig_applied = self.tanh(self.w1(output[i].unsqueeze(0)) + self.w2(trig_rep[i].unsqueeze(0).unsqueeze(0)))
+            trig_applied = self.tanh(
+                self.w1(output[i].unsqueeze(0)) + self.w2(trig_rep[i].unsqueeze(0).unsqueeze(0)))
             x = self.attn1(trig_applied)
             x = torch.mul(x.squeeze(0), sentence_mask[i].unsqueeze(1))
             x[x == 0] = float('-inf')
             weights.append(x)
         normalized_weights = F.softmax(torch.stack(weights), 1)
-        attn_applied1 = torch.mul(normalized_weights.repeat(1, 1, output.size(2)), output)
+        return torch.mul(normalized_weights.repeat(1, 1, output.size(2)), output)
+
+    @labelled("LinearCRF.decode")
+    def decode_labels(self, lstm_scores: torch.Tensor, word_seq_lens: torch.Tensor):
+        """
+        Best score and label ids of every sentence, with Viterbi or greedily as configured by `decode_mode`
+        """
+        with full_precision(self.config):
+            if getattr(self.config, "decode_mode", "viterbi") == "greedy":
+                return greedy_decode(lstm_scores.float(), word_seq_lens, self.label_tables, self.inferencer.pad_idx)
+            return viterbi_decode(lstm_scores.float(), self.inferencer.transition, word_seq_lens,
+                                  self.inferencer.start_idx, self.inferencer.end_idx, self.transition_mask,
+                                  self.inferencer.pad_idx)
 
-        output = torch.cat([output, attn_applied1], dim=2)
+    def decode(self, word_seq_tensor: torch.Tensor,
+               word_seq_lens: torch.Tensor,
+               batch_context_emb: torch.Tensor,
+               char_inputs: torch.Tensor,
+               char_seq_lens: torch.Tensor,
+               trig_rep,
+               trigger_index=None):
+        """
+        :param trigger_index: optional `TriggerIndex` over `trig_rep`, finds the closest triggers approximately
+        """
+        with autocast(self.config):
+            with span("decode.encode"):
+                output, sentence_mask, _, _ = \
+                    self.encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens, None)
+
+            with span("decode.match"):
+                soft_sent_rep = self.match_representation(word_seq_tensor, word_seq_lens, batch_context_emb,
+                                                          char_inputs, char_seq_lens)
+                trig_rep, trigger_keys, dvalue = self.nearest_triggers(soft_sent_rep, trig_rep, trigger_index)
 
-        lstm_scores = self.hidden2tag(output)
-        bestScores, decodeIdx = self.inferencer.decode(lstm_scores, word_seq_lens, None)
+            # attention
+            with span("decode.attention"):
+                attn_applied1 = self.trigger_attention(output, sentence_mask, trig_rep)
+                output = torch.cat([output, attn_applied1], dim=2)
+
+                lstm_scores = self.hidden2tag(output)
+        with span("decode.crf"):
+            bestScores, decodeIdx = self.decode_labels(lstm_scores, word_seq_lens)
 
         return bestScores, decodeIdx, trigger_keys, dvalue
 
 
 class SoftSequenceTrainer(object):
-    def __init__(self, model, config, dev, test, triggers):
+    def __init__(self, model, config, dev, test, triggers, trigger_index=None):
+        """
+        :param trigger_index: optional `TriggerIndex` over `triggers`, used when decoding with them
+        """
         self.model = model
         self.config = config
         self.device = config.device
@@ -173,6 +237,10 @@ class SoftSequenceTrainer(object):
         self.context_emb = config.context_emb
         self.use_char = config.use_char_rnn
         self.triggers = triggers
+        self.trigger_index = trigger_index
+        self.epochs_run = 0
+        # full results of the last evaluation of every set, see span_metrics.py
+        self.eval_results = {}
         if self.context_emb != ContextEmb.none:
             self.input_size += config.context_emb_size
         if self.use_char:
@@ -180,153 +248,197 @@ class SoftSequenceTrainer(object):
         self.dev = dev
         self.test = test
 
+    def step_loss(self, batch):
+        return self.model(*batch[0:5], batch[-2], batch[-3])
+
+    def index_of(self, triggers):
+        # the index only covers the trainer's own trigger bank
+        return self.trigger_index if triggers is self.triggers else None
+
+    def trigger_index_recall(self, batch_insts_ids, nprobe=None):
+        """
+        Recall@1 of the trigger index against exact search, with the sentences of the batches as queries
+        """
+        self.model.eval()
+        with torch.no_grad(), autocast(self.config):
+            queries = [self.model.match_representation(*batch[0:5]).float() for batch in batch_insts_ids]
+        return self.trigger_index.recall_at_1(torch.cat(queries), nprobe) if queries else 1.0
+
     def save_model(self):
         logging.info("Saving Model")
         model_save_path = self.config.generate_model_path("trigger")
         torch.save(self.model.state_dict(), model_save_path)
 
     def train_model(self, num_epochs, train_data, eval):
-        batched_data = batching_list_instances(self.config, train_data)
-        self.optimizer = get_optimizer(self.config, self.model, 'sgd')
+        batched_data = BatchLoader(self.config, train_data, shuffle=True, shard=True)
+        evaluation = EvalSchedule(self.config, "sequence", num_epochs)
+        dev = evaluation.sample(self.dev)
+        test = evaluation.sample(self.test)
+        # loaders iterated on the evaluation thread collate there instead of forking workers
+        eval_workers = 0 if evaluation.executor is not None else None
+        dev_batches = BatchLoader(self.config, dev, workers=eval_workers) if dev else None
+        test_batches = BatchLoader(self.config, test, workers=eval_workers) if test else None
+        self.optimizer, scheduler = get_optimizer_and_scheduler(self.config, self.model, 'sgd')
+        train_loop = TrainLoop(self.model, self.optimizer, self.step_loss, self.config)
+        checkpoint = CheckpointManager(self.config.generate_model_path("trigger"), self.config)
+        stopping = early_stopping(self.config)
         start_time = time.time()
         best_train_loss = 1e30
-        best_dev_f1_score = -1
 
-        for epoch in range(num_epochs):
-            epoch_loss = 0
-            self.model.zero_grad()
-            for index in tqdm(np.random.permutation(len(batched_data))):
-                self.model.train()
-                sequence_loss = self.model(*batched_data[index][0:5], batched_data[index][-2], batched_data[index][-3])
-                loss = sequence_loss
-                epoch_loss = epoch_loss + loss.data
-                loss.backward(retain_graph=True)
-                self.optimizer.step()
-                self.model.zero_grad()
-            logging.info(epoch_loss)
-            best_train_loss = min(best_train_loss, epoch_loss.item())
-
-            if eval:
-                self.model.eval()
-                if self.dev:
-                    dev_batches = batching_list_instances(self.config, self.dev)
-                    dev_metrics = self.evaluate_model(dev_batches, "dev", self.dev, self.triggers)
-                    if best_dev_f1_score < dev_metrics[2]:
-                        self.save_model()
-                        best_dev_f1_score = dev_metrics[2]
-                    else:
-                        self.save_model()
-
-                if self.test:
-                    test_batches = batching_list_instances(self.config, self.test)
-                    test_metrics = self.evaluate_model(test_batches, "test", self.test, self.triggers)
-                self.model.zero_grad()
-
-            if self.config.is_lean_life:
-                time_spent = time.time() - start_time
-                update_model_training(
-                    self.config.project_id, self.config.experiment_name,
-                    epoch + 1, num_epochs,
-                    time_spent, epoch_loss,
-                    "training"
-                )
+        def evaluate(model):
+            dev_f1_score = None
+            if dev:
+                dev_f1_score = self.evaluate_model(dev_batches, "dev", dev, self.triggers, model)[2]
+            if test:
+                self.evaluate_model(test_batches, "test", test, self.triggers, model)
+            return dev_f1_score
+
+        with profiled(self.config, "sequence_training"):
+            for epoch in range(num_epochs):
+                epoch_loss = train_loop.run_epoch(batched_data)
+                best_train_loss = min(best_train_loss, epoch_loss)
+                self.epochs_run = epoch + 1
+
+                if eval and (dev or test) and evaluation.due(epoch):
+                    evaluation.submit(self.model, epoch, evaluate)
+                    self.model.zero_grad()
+                else:
+                    checkpoint.step(self.model, epoch)
+                stop = apply_results(evaluation.collect(), checkpoint, scheduler, stopping)
+
+                if self.config.is_lean_life and distributed.is_main_process():
+                    time_spent = time.time() - start_time
+                    update_model_training(
+                        self.config.project_id, self.config.experiment_name,
+                        epoch + 1, num_epochs,
+                        time_spent, epoch_loss,
+                        "training"
+                    )
+                if stop:
+                    break
+        apply_results(evaluation.close(), checkpoint, scheduler, stopping)
+        checkpoint.close(self.model)
+        checkpoint.restore_best(self.model)
         return self.model, best_train_loss
 
     def self_training(self, num_epochs, train_data, unlabeled_data):
         self.optimizer = get_optimizer(self.config, self.model, 'sgd')
-        merged_data = train_data
+        train_loop = TrainLoop(self.model, self.optimizer, self.step_loss, self.config)
+        evaluation = EvalSchedule(self.config, "sequence", num_epochs)
+        dev = evaluation.sample(self.dev)
+        test = evaluation.sample(self.test)
+        eval_workers = 0 if evaluation.executor is not None else None
+        dev_batches = BatchLoader(self.config, dev, workers=eval_workers) if dev else None
+        test_batches = BatchLoader(self.config, test, workers=eval_workers) if test else None
+
+        def evaluate(model):
+            if dev:
+                self.evaluate_model(dev_batches, "dev", dev, self.triggers, model)
+            if test:
+                self.evaluate_model(test_batches, "test", test, self.triggers, model)
+
+        # weakly labeled instances are appended to the storage of the training loader instead of re-batching
+        merged_data = BatchLoader(self.config, list(train_data), shuffle=True, shard=True)
         unlabels = unlabeled_data
         for epoch in range(num_epochs):
-            batched_data = batching_list_instances(self.config, merged_data)
-            epoch_loss = 0
-            self.model.zero_grad()
-            for index in tqdm(np.random.permutation(len(batched_data))):
-                self.model.train()
-                sequence_loss = self.model(*batched_data[index][0:5], batched_data[index][-2], batched_data[index][-3])
-                loss = sequence_loss
-                epoch_loss = epoch_loss + loss.data
-                loss.backward(retain_graph=True)
-                self.optimizer.step()
+            epoch_loss = train_loop.run_epoch(merged_data)
+            logging.info("Self-training epoch %d: loss %.5f" % (epoch, epoch_loss))
+
+            if (dev or test) and evaluation.due(epoch):
+                evaluation.submit(self.model, epoch, evaluate)
                 self.model.zero_grad()
-            print(epoch_loss)
-
-            self.model.eval()
-            dev_batches = batching_list_instances(self.config, self.dev)
-            test_batches = batching_list_instances(self.config, self.test)
-            dev_metrics = self.evaluate_model(dev_batches, "dev", self.dev, self.triggers)
-            test_metrics = self.evaluate_model(test_batches, "test", self.test, self.triggers)
-            self.model.zero_grad()
-
-            weaklabel, unlabel = self.weak_label_selftrain(unlabels, self.triggers)
-            merged_data = merged_data + weaklabel
-            unlabels = unlabel
-            print(len(merged_data), len(weaklabel), len(unlabels))
+            evaluation.collect()
+
+            weaklabel, unlabels = self.weak_label_selftrain(unlabels, self.triggers)
+            merged_data.extend(weaklabel)
+            logging.info("Self-training epoch %d: %d training instances, %d weakly labeled, %d unlabeled left" %
+                         (epoch, len(merged_data.insts), len(weaklabel), len(unlabels)))
+        evaluation.close()
         return self.model
 
-    def evaluate_model(self, batch_insts_ids, name: str, insts, triggers):
+    def evaluate_model(self, batch_insts_ids, name: str, insts, triggers, model=None):
         ## evaluation
-        metrics = np.asarray([0, 0, 0], dtype=int)
-        batch_id = 0
-        batch_size = self.config.batch_size
+        model = self.model if model is None else model
+        metrics = SpanMetrics(self.config.idx2labels, confusion=getattr(self.config, "eval_confusion_matrix", False))
         for batch in batch_insts_ids:
-            one_batch_insts = insts[batch_id * batch_size:(batch_id + 1) * batch_size]
-            batch_max_scores, batch_max_ids, _, _ = self.model.decode(*batch[0:5], triggers)
-            metrics += evaluate_batch_insts(one_batch_insts, batch_max_ids, batch[6], batch[1], self.config.idx2labels,
-                                            self.config.use_crf_layer)
-            batch_id += 1
-        p, total_predict, total_entity = metrics[0], metrics[1], metrics[2]
-        precision = p * 1.0 / total_predict * 100 if total_predict != 0 else 0
-        recall = p * 1.0 / total_entity * 100 if total_entity != 0 else 0
-        fscore = 2.0 * precision * recall / (precision + recall) if precision != 0 or recall != 0 else 0
+            batch_max_scores, batch_max_ids, _, _ = model.decode(*batch[0:5], triggers, self.index_of(triggers))
+            metrics.add(batch[6], batch_max_ids, batch[1])
+        results = metrics.compute()
+        precision, recall, fscore = results["precision"], results["recall"], results["f1"]
         print("[%s set] Precision: %.2f, Recall: %.2f, F1: %.2f" % (name, precision, recall, fscore), flush=True)
+        for type_name, scores in results["per_type"].items():
+            logging.info("[%s set] %s Precision: %.2f, Recall: %.2f, F1: %.2f, Support: %d" % (
+                name, type_name, scores["precision"], scores["recall"], scores["f1"], scores["support"]))
+        if results["confusion"] is not None:
+            logging.info("[%s set] confusion matrix (rows gold, columns predicted):\n%s" % (
+                name, format_confusion(results["confusion"], self.config.idx2labels)))
+        self.eval_results[name] = results
         return [precision, recall, fscore]
 
+    def match_batches(self, batch_insts_ids, triggers):
+        """
+        Decode the batches without gradients and find the sentences with a label other than O
+        :return: indices of the matched instances, their scores, and a function returning the decoded label ids of
+            the i-th matched instance
+        """
+        o_idx = self.config.label2idx['O']
+        indices, scores, decoded, owners = [], [], [], []
+        offset = 0
+        self.model.eval()
+        with torch.no_grad():
+            for batch in batch_insts_ids:
+                batch_max_scores, batch_max_ids, _, _ = self.model.decode(*batch[0:5], triggers,
+                                                                          self.index_of(triggers))
+                word_seq_lens = batch[1].to(batch_max_ids.device)
+                positions = torch.arange(batch_max_ids.size(1), device=batch_max_ids.device)
+                mask = positions.unsqueeze(0) < word_seq_lens.unsqueeze(1)
+                rows = ((batch_max_ids != o_idx) & mask).any(dim=1).nonzero().squeeze(1)
+                indices.append(rows.cpu().numpy() + offset)
+                scores.append(batch_max_scores[rows].detach().float().reshape(-1).cpu().numpy())
+                decoded.append((batch_max_ids[rows].cpu(), word_seq_lens[rows].cpu()))
+                owners.append(np.stack([np.full(len(rows), len(decoded) - 1), np.arange(len(rows))], axis=1))
+                offset += batch_max_ids.size(0)
+        owners = np.concatenate(owners) if owners else np.zeros((0, 2), dtype=int)
+
+        def prediction(i):
+            ids, lens = decoded[owners[i, 0]]
+            return ids[owners[i, 1], :lens[owners[i, 1]]].tolist()
+
+        return (np.concatenate(indices) if indices else np.zeros(0, dtype=int),
+                np.concatenate(scores) if scores else np.zeros(0), prediction)
+
+    def weakly_label(self, inst, prediction):
+        inst.output_ids = prediction
+        inst.trigger_label = -1
+        inst.trigger_positions = [i for i in range(0, len(prediction))]
+        return inst
+
     def weakly_labeling(self, batch_insts_ids, insts, triggers):
-        batch_id = 0
-        batch_size = self.config.batch_size
-        matched = []
-        matched_scores = []
-        matched_sentences = 0
-        unlabeled = []
-        for batch in batch_insts_ids:
-            one_batch_insts = insts[batch_id * batch_size:(batch_id + 1) * batch_size]
-            batch_max_scores, batch_max_ids, _, _ = self.model.decode(*batch[0:5], triggers)
-            match_indices = (torch.sum(batch_max_ids, dim=1) > 0).nonzero().squeeze(1).tolist()
-            unmatch_indices = (torch.sum(batch_max_ids, dim=1) == 0).nonzero().squeeze(1).tolist()
-            matched_sentences += len(match_indices)
-            word_seq_lens = batch[1].cpu().numpy()
-            for idx in match_indices:
-                length = word_seq_lens[idx]
-                prediction = batch_max_ids[idx][:length].tolist()
-                prediction = prediction[::-1]
-                is_match = False
-                for pred in prediction:
-                    if pred != self.config.label2idx['O']:
-                        one_batch_insts[idx].output_ids = prediction
-                        one_batch_insts[idx].trigger_label = -1
-                        one_batch_insts[idx].trigger_positions = [i for i in range(0, len(prediction))]
-                        matched.append(one_batch_insts[idx])
-                        matched_scores.append(batch_max_scores[idx])
-                        is_match = True
-                        break
-                if is_match == False:
-                    unlabeled.append(one_batch_insts[idx])
-            for idx in unmatch_indices:
-                unlabeled.append(one_batch_insts[idx])
-            batch_id += 1
-        return matched, unlabeled, matched_scores
+        indices, scores, prediction = self.match_batches(batch_insts_ids, triggers)
+        matched = [self.weakly_label(insts[index], prediction(i)) for i, index in enumerate(indices)]
+        is_matched = np.zeros(len(insts), dtype=bool)
+        is_matched[indices] = True
+        unlabeled = [inst for inst, match in zip(insts, is_matched) if not match]
+        return matched, unlabeled, scores.tolist()
 
     def weak_label_selftrain(self, unlabeled_data, triggers):
-        batched_data = batching_list_instances(self.config, unlabeled_data, is_soft=False, is_naive=True)
-        weakly_labeled, unlabeled, confidence = self.weakly_labeling(batched_data, unlabeled_data, triggers)
-
-        confidence_order = [i[0] for i in sorted(enumerate(confidence), key=lambda x: x[1])]
-        threshold = int(len(confidence_order) * 0.01)
-        high_confidence = confidence_order[:threshold]
-        low_confidence = confidence_order[threshold:]
-
-        final_weakly_labeled = [weakly_labeled[i] for i in high_confidence]
-        unlabeled = unlabeled + [weakly_labeled[i] for i in low_confidence]
+        """
+        Weakly label the 1% of the matched unlabeled sentences with the lowest scores, the rest stays unlabeled
+        """
+        decode_config = copy.copy(self.config)
+        decode_config.batch_size = getattr(self.config, "weak_label_batch_size", 0) or 4 * self.config.batch_size
+        batched_data = BatchLoader(decode_config, unlabeled_data, is_soft=False, is_naive=True)
+        indices, scores, prediction = self.match_batches(batched_data, triggers)
+
+        threshold = int(len(indices) * 0.01)
+        # partial selection of the lowest scores, only the selected ones are sorted
+        selected = np.argpartition(scores, threshold)[:threshold] if threshold else np.zeros(0, dtype=int)
+        selected = selected[np.argsort(scores[selected], kind="stable")]
+
+        final_weakly_labeled = [self.weakly_label(unlabeled_data[indices[i]], prediction(i)) for i in selected]
+        is_labeled = np.zeros(len(unlabeled_data), dtype=bool)
+        is_labeled[indices[selected]] = True
+        unlabeled = [inst for inst, labeled in zip(unlabeled_data, is_labeled) if not labeled]
 
         return final_weakly_labeled, unlabeled
 
@@ -336,12 +448,13 @@ class SoftSequenceTrainer(object):
         batch_size = self.config.batch_size
         for batch in batch_insts_ids:
             one_batch_insts = insts[batch_id * batch_size:(batch_id + 1) * batch_size]
-            batch_max_scores, batch_max_ids, trigger_keys, distances = self.model.decode(*batch[0:5], triggers)
-            word_seq_lens = batch[1].tolist()
-            for idx in range(len(batch_max_ids)):
-                length = word_seq_lens[idx]
-                prediction = batch_max_ids[idx][:length].tolist()
-                prediction = prediction[::-1] if self.config.use_crf_layer else prediction
-                prediction = [self.config.idx2labels[l] for l in prediction]
-                one_batch_insts[idx].prediction = (prediction, trigger_keys[idx], distances[idx])
+            batch_max_scores, batch_max_ids, trigger_keys, distances = \
+                self.model.decode(*batch[0:5], triggers, self.index_of(triggers))
+            with span("postprocess"):
+                word_seq_lens = batch[1].tolist()
+                for idx in range(len(batch_max_ids)):
+                    length = word_seq_lens[idx]
+                    prediction = batch_max_ids[idx][:length].tolist()
+                    prediction = [self.config.idx2labels[l] for l in prediction]
+                    one_batch_insts[idx].prediction = (prediction, trigger_keys[idx], distances[idx])
             batch_id += 1
@@ -17,7 +17,14 @@ import logging
 import time
 
 from ..utilities.config import ContextEmb
-from ..utilities.utils import batching_list_instances, get_optimizer
+from ..utilities.batch_loader import BatchLoader
+from ..utilities.train_loop import TrainLoop
+from ..utilities.precision import autocast
+from ..utilities.profiling import label, profiled
+from ..utilities.checkpoint import CheckpointManager
+from ..utilities.schedule import early_stopping, get_optimizer_and_scheduler
+from ..utilities.eval_schedule import EvalSchedule, apply_results
+from ..utilities import distributed
 from .soft_encoder import SoftEncoder
 from .soft_attention import SoftAttention
 
@@ -55,12 +62,17 @@ class SoftMatcher(nn.Module):
                 char_inputs: torch.Tensor,
                 char_seq_lens: torch.Tensor,
                 trigger_position):
-        output, sentence_mask, trigger_vec, trigger_mask = \
-            self.encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens,
-                         trigger_position)
-        trig_rep, sentence_vec_cat, trigger_vec_cat = self.attention(output, sentence_mask, trigger_vec, trigger_mask)
-        final_trigger_type = self.trigger_type_layer(trig_rep)
-        return trig_rep, F.log_softmax(final_trigger_type, dim=1), sentence_vec_cat, trigger_vec_cat
+        with autocast(self.config):
+            output, sentence_mask, trigger_vec, trigger_mask = \
+                self.encoder(word_seq_tensor, word_seq_lens, batch_context_emb, char_inputs, char_seq_lens,
+                             trigger_position)
+            with label("SoftAttention.forward"):
+                trig_rep, sentence_vec_cat, trigger_vec_cat = self.attention(output, sentence_mask, trigger_vec,
+                                                                             trigger_mask)
+            final_trigger_type = self.trigger_type_layer(trig_rep)
+        # the classification and contrastive losses are computed in fp32
+        return trig_rep.float(), F.log_softmax(final_trigger_type.float(), dim=1), sentence_vec_cat.float(), \
+            trigger_vec_cat.float()
 
 
 class SoftMatcherTrainer(object):
@@ -76,87 +88,119 @@ class SoftMatcherTrainer(object):
         if self.use_char:
             self.input_size += config.charlstm_hidden_dim
         self.contrastive_loss = ContrastiveLoss(1.0, self.device)
+        self.criterion = nn.NLLLoss()
+        self.match_targets = {}
+        self.epochs_run = 0
         self.dev = dev
         self.test = test
 
+    def get_match_targets(self, batch_size):
+        """
+        Contrastive targets of a batch: matching pairs for the first half, mismatched pairs for the second half
+        """
+        if batch_size not in self.match_targets:
+            self.match_targets[batch_size] = torch.cat(
+                [torch.ones(batch_size, dtype=torch.long), torch.zeros(batch_size, dtype=torch.long)]).to(self.device)
+        return self.match_targets[batch_size]
+
+    def step_loss(self, batch):
+        trig_rep, trig_type_probas, match_trig, match_sent = self.model(*batch[0:5], batch[-2])
+        trigger_loss = self.criterion(trig_type_probas, batch[-1])
+        soft_matching_loss = self.contrastive_loss(match_trig, match_sent, self.get_match_targets(trig_rep.size(0)))
+        return trigger_loss + soft_matching_loss
+
     def save_model(self):
         logging.info("Saving Model")
         model_save_path = self.config.generate_model_path("trigger_soft")
         torch.save(self.model.state_dict(), model_save_path)
 
     def train_model(self, num_epochs, train_data):
-        batched_data = batching_list_instances(self.config, train_data)
-        self.optimizer = get_optimizer(self.config, self.model, 'adam')
-        criterion = nn.NLLLoss()
+        batched_data = BatchLoader(self.config, train_data, shuffle=True, shard=True)
+        self.optimizer, scheduler = get_optimizer_and_scheduler(self.config, self.model, 'adam')
+        train_loop = TrainLoop(self.model, self.optimizer, self.step_loss, self.config)
+        checkpoint = CheckpointManager(self.config.generate_model_path("trigger_soft"), self.config)
+        stopping = early_stopping(self.config)
+        evaluation = EvalSchedule(self.config, "matcher", num_epochs)
+        eval_data = evaluation.sample(train_data)
+        # the evaluation thread collates its batches itself instead of forking loader workers
+        eval_workers = 0 if evaluation.executor is not None else None
         start_time = time.time()
         best_train_loss = 1e30
-        best_dev_f1_score = -1
-
-        for epoch in range(num_epochs):
-            epoch_loss = 0
-            self.model.zero_grad()
-            for index in tqdm(np.random.permutation(len(batched_data))):
-                self.model.train()
-                trig_rep, trig_type_probas, match_trig, match_sent = self.model(*batched_data[index][0:5],
-                                                                                batched_data[index][-2])
-                trigger_loss = criterion(trig_type_probas, batched_data[index][-1])
-                soft_matching_loss = self.contrastive_loss(match_trig, match_sent, torch.stack(
-                    [torch.tensor(1)] * trig_rep.size(0) + [torch.tensor(0)] * trig_rep.size(0)))
-                loss = trigger_loss + soft_matching_loss
-                epoch_loss = epoch_loss + loss.data
-                loss.backward(retain_graph=True)
-                self.optimizer.step()
-                self.model.zero_grad()
-            logging.info(epoch_loss)
-            best_train_loss = min(best_train_loss, epoch_loss.item())
-
-            self.test_model(train_data)
-            self.save_model()
-            self.model.zero_grad()
 
+        with profiled(self.config, "matcher_training"):
+            for epoch in range(num_epochs):
+                epoch_loss = train_loop.run_epoch(batched_data)
+                best_train_loss = min(best_train_loss, epoch_loss)
+                self.epochs_run = epoch + 1
+
+                if evaluation.due(epoch):
+                    evaluation.submit(self.model, epoch,
+                                      lambda model: self.test_model(eval_data, model, eval_workers)[1])
+                    self.model.zero_grad()
+                else:
+                    checkpoint.step(self.model, epoch)
+                if apply_results(evaluation.collect(), checkpoint, scheduler, stopping):
+                    break
+
+        apply_results(evaluation.close(), checkpoint, scheduler, stopping)
+        checkpoint.close(self.model)
+        # triggers are extracted from the returned model, so it has to be the saved one
+        checkpoint.restore_best(self.model)
         return self.model
 
-    def test_model(self, test_data):
-        batched_data = batching_list_instances(self.config, test_data)
-        self.model.eval()
+    def test_model(self, test_data, model=None, workers=None):
+        """
+        Trigger classification and soft matching accuracy of `model`, the trained model by default
+        """
+        model = self.model if model is None else model
+        batched_data = BatchLoader(self.config, test_data, workers=workers)
+        model.eval()
         predicted_list = []
         target_list = []
         match_target_list = []
         matched_list = []
-        for index in tqdm(np.random.permutation(len(batched_data))):
-            trig_rep, trig_type_probas, match_trig, match_sent = self.model(*batched_data[index][0:5],
-                                                                            batched_data[index][-2])
+        for batch in tqdm(batched_data):
+            trig_rep, trig_type_probas, match_trig, match_sent = model(*batch[0:5], batch[-2])
             trig_type_value, trig_type_predicted = torch.max(trig_type_probas, 1)
-            target = batched_data[index][-1]
+            target = batch[-1]
             target_list.extend(target.tolist())
             predicted_list.extend(trig_type_predicted.tolist())
 
-            match_target_list.extend([torch.tensor(1)] * trig_rep.size(0) + [torch.tensor(0)] * trig_rep.size(0))
+            match_target_list.extend(self.get_match_targets(trig_rep.size(0)).tolist())
             distances = (match_trig - match_sent).pow(2).sum(1)
             distances = torch.sqrt(distances)
             matched_list.extend((distances < 1.0).long().tolist())
 
-        print("trigger classification accuracy ", accuracy_score(predicted_list, target_list))
-        print("soft matching accuracy ", accuracy_score(matched_list, match_target_list))
+        classification_accuracy = accuracy_score(predicted_list, target_list)
+        matching_accuracy = accuracy_score(matched_list, match_target_list)
+        print("trigger classification accuracy ", classification_accuracy)
+        print("soft matching accuracy ", matching_accuracy)
+        return classification_accuracy, matching_accuracy
 
     def get_triggervec(self, data):
-        batched_data = batching_list_instances(self.config, data)
+        """
+        Trigger vectors of the instances as one detached, contiguous (len(data), dim) matrix, with the predicted
+        trigger type and the trigger words of every instance
+        """
+        batched_data = BatchLoader(self.config, data)
         self.model.eval()
         logits_list = []
         predicted_list = []
         trigger_list = []
-        for index in tqdm(range(len(batched_data))):
-            trig_rep, trig_type_probas, match_trig, match_sent = self.model(*batched_data[index][0:5],
-                                                                            batched_data[index][-2])
-            trig_type_value, trig_type_predicted = torch.max(trig_type_probas, 1)
-            ne_batch_insts = data[index * self.config.batch_size:(index + 1) * self.config.batch_size]
-            for idx in range(len(trig_rep)):
-                ne_batch_insts[idx].trigger_vec = trig_rep[idx]
-            logits_list.extend(trig_rep)
-            predicted_list.extend(trig_type_predicted)
-            word_seq = batched_data[index][0]
-            trigger_positions = batched_data[index][-2]
-            for ws, tp in zip(word_seq, trigger_positions):
-                trigger_list.append(" ".join(self.config.idx2word[ws[index]] for index in tp))
-
-        return logits_list, predicted_list, trigger_list
+        with torch.inference_mode():
+            for batch in tqdm(batched_data):
+                trig_rep, trig_type_probas, match_trig, match_sent = self.model(*batch[0:5], batch[-2])
+                trig_type_value, trig_type_predicted = torch.max(trig_type_probas, 1)
+                logits_list.append(trig_rep)
+                predicted_list.append(trig_type_predicted)
+                for ws, tp in zip(batch[0].tolist(), batch[-2]):
+                    trigger_list.append(" ".join(self.config.idx2word[ws[int(index)]] for index in tp))
+        if not logits_list:
+            return torch.zeros(0, self.config.hidden_dim // 2), torch.zeros(0, dtype=torch.long), trigger_list
+
+        # cloned outside of inference mode, so the results can be used like any other tensor
+        logits = torch.cat(logits_list).clone()
+        predicted = torch.cat(predicted_list).clone()
+        for inst, trigger_vec in zip(data, logits):
+            inst.trigger_vec = trigger_vec
+        return logits, predicted, trigger_list
@@ -0,0 +1,150 @@
+"""batch_loader.py: Prefetching batch iterator replacing the up-front `batching_list_instances`
+Yields the same contiguous, padded batches as `batching_list_instances`, but collates them lazily on background
+workers of a `torch.utils.data.DataLoader`. At most `loader_workers * prefetch_batches` padded batches are alive at
+any time, so memory no longer grows with the dataset size, and the next batches are built while the model trains.
+
+Workers are forked and inherit the instances, so nothing but the finished batch tensors crosses the process boundary.
+Only training loaders (`shuffle=True`) start workers by default, and keep them across epochs. Evaluation and the eval
+and predict requests of the API collate on demand in the calling process, as does `loader_workers == 0` or a platform
+without fork, so the server is not forked for every request.
+"""
+import copy
+import functools
+import math
+import multiprocessing as mp
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+from . import distributed
+from .timing import record
+from .utils import batching_list_instances
+
+
+def _collate(config, is_soft, is_naive, insts):
+    return batching_list_instances(config, insts, is_soft=is_soft, is_naive=is_naive)[0]
+
+
+def _to_device(batch, device):
+    return tuple(item.to(device, non_blocking=True) if torch.is_tensor(item) else item for item in batch)
+
+
+class ContiguousBatchSampler(Sampler):
+    """
+    Index lists of the batches of `batching_list_instances`, in order or in a new random order every epoch.
+    The order is drawn from `np.random` in the calling process, so seeding behaves as with a permuted list.
+
+    When sharded over the processes of a distributed run, every process takes every `world_size`-th batch of an order
+    drawn from the seed and the epoch, which all processes agree on. The order is padded by repeating its start, so
+    all processes run the same number of steps.
+    """
+
+    def __init__(self, size: int, batch_size: int, shuffle: bool = False, seed: Optional[int] = None,
+                 shard: bool = False):
+        self.size = size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = distributed.rank() if shard else 0
+        self.world_size = distributed.world_size() if shard else 1
+        self.epoch = 0
+
+    def num_batches(self) -> int:
+        return math.ceil(self.size / self.batch_size)
+
+    def __len__(self) -> int:
+        return math.ceil(self.num_batches() / self.world_size)
+
+    def order(self):
+        if not self.shuffle:
+            return np.arange(self.num_batches())
+        if self.world_size == 1:
+            return np.random.permutation(self.num_batches())
+        return np.random.RandomState((self.seed or 0) + self.epoch).permutation(self.num_batches())
+
+    def __iter__(self):
+        order = self.order()
+        self.epoch += 1
+        if self.world_size > 1:
+            order = np.resize(order, len(self) * self.world_size)[self.rank::self.world_size]
+        for batch_id in order:
+            yield list(range(batch_id * self.batch_size, min((batch_id + 1) * self.batch_size, self.size)))
+
+
+class BatchLoader(object):
+    def __init__(self, config, insts, is_soft: bool = True, is_naive: bool = False, shuffle: bool = False,
+                 workers: Optional[int] = None, shard: bool = False):
+        """
+        :param insts: instances with mapped ids, batch `i` holds `insts[i * batch_size:(i + 1) * batch_size]`
+        :param shuffle: iterate the batches in a random order, as the training loops do
+        :param workers: overrides `config.loader_workers` of training loaders and the default of 0 of the others,
+            loaders iterated off the main thread should use 0
+        :param shard: only yield this process's share of the batches in a distributed run
+        """
+        self.config = config
+        self.insts = insts
+        self.is_soft = is_soft
+        self.is_naive = is_naive
+        self.device = torch.device(config.device)
+        self.sampler = ContiguousBatchSampler(len(insts), config.batch_size, shuffle, getattr(config, "seed", None),
+                                              shard)
+
+        if workers is None:
+            workers = getattr(config, "loader_workers", 0) if shuffle else 0
+        workers = workers or 0
+        if len(self.sampler) <= 1 or "fork" not in mp.get_all_start_methods():
+            workers = 0
+        self.workers = workers
+        self.collate_config = config
+        self.move = workers > 0 and self.device.type != "cpu"
+        if self.move:
+            # CUDA can't be used in forked workers, batches are built on the CPU and moved to the device here
+            self.collate_config = copy.copy(config)
+            self.collate_config.device = torch.device("cpu")
+        self.loader = self._make_loader()
+
+    def _make_loader(self) -> DataLoader:
+        # persistent workers are forked once for all epochs, with the instances of the time they were forked
+        workers = self.workers
+        return DataLoader(self.insts, batch_sampler=self.sampler,
+                          collate_fn=functools.partial(_collate, self.collate_config, self.is_soft, self.is_naive),
+                          num_workers=workers,
+                          prefetch_factor=max(1, getattr(self.config, "prefetch_batches", 2)) if workers else None,
+                          persistent_workers=workers > 0,
+                          pin_memory=self.move,
+                          multiprocessing_context="fork" if workers else None)
+
+    def __len__(self) -> int:
+        return len(self.sampler)
+
+    def __iter__(self):
+        waited = time.perf_counter()
+        for batch in self.loader:
+            batch = _to_device(batch, self.device) if self.move else batch
+            # time the consumer waited for the batch, all of the collation when it is not prefetched
+            record("batching", time.perf_counter() - waited)
+            yield batch
+            waited = time.perf_counter()
+
+    def extend(self, insts: list):
+        """
+        Append instances to the batched storage, they are batched after the existing ones from the next epoch on
+        """
+        self.insts.extend(insts)
+        self.sampler.size = len(self.insts)
+        if self.workers:
+            # the running workers only hold the instances they were forked with
+            self.loader = self._make_loader()
+
+    def __getitem__(self, index: int):
+        """
+        Collate a single batch in the calling process, ignoring sharding
+        """
+        if index < 0:
+            index += self.sampler.num_batches()
+        batch_size = self.config.batch_size
+        insts = self.insts[index * batch_size:(index + 1) * batch_size]
+        return _collate(self.config, self.is_soft, self.is_naive, insts)
@@ -0,0 +1,130 @@
+"""checkpoint.py: Checkpointing on improvement, written in the background
+`CheckpointManager` snapshots the weights to CPU memory and hands the snapshot to a writer thread, so an epoch only
+waits for the copy, not for `torch.save`. Every checkpoint is written to a temporary file and renamed into place,
+and the model path is then atomically relinked to it, so readers of the model path never see a partial file.
+
+Files next to the model path `<path>`:
+    <path>              the best checkpoint, or the latest one when no metric is tracked
+    <path>.epoch<N>     the last `checkpoint_keep` checkpoints
+"""
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import torch
+
+from . import distributed
+
+
+def snapshot(model: torch.nn.Module) -> Dict[str, torch.Tensor]:
+    """
+    Copy of the state dict on the CPU that training can't modify anymore
+    """
+    return {name: tensor.detach().to("cpu", copy=True) for name, tensor in model.state_dict().items()}
+
+
+def _replace(source: str, path: str):
+    # a hard link avoids writing the checkpoint twice, copying covers file systems without links
+    tmp = path + ".tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointManager(object):
+    def __init__(self, path: str, config):
+        """
+        :param path: model path the best checkpoint is published at
+        :param config: reads `checkpoint_every`, which also saves every N epochs when > 0, and `checkpoint_keep`,
+            the number of epoch checkpoints kept on disk
+        """
+        self.path = path
+        self.every = getattr(config, "checkpoint_every", 0) or 0
+        self.keep = max(1, getattr(config, "checkpoint_keep", 1) or 1)
+        self.best_metric: Optional[float] = None
+        self.best_state: Optional[Dict[str, torch.Tensor]] = None
+        self.saved: List[str] = []
+        self.last_epoch = -1
+        self.last_saved_epoch = -1
+        # in a distributed run every process keeps the best snapshot, but only rank 0 writes
+        self.writes = distributed.is_main_process()
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def step(self, model: torch.nn.Module, epoch: int, metric: Optional[float] = None) -> bool:
+        """
+        Save after an epoch if `metric` improved on the best one so far, or every `checkpoint_every` epochs.
+        Without a metric, only the periodic saves happen and `close` saves the final weights.
+        :return: whether a checkpoint was saved
+        """
+        # evaluated in the background, results can arrive after later epochs were stepped
+        self.last_epoch = max(self.last_epoch, epoch)
+        improved = metric is not None and (self.best_metric is None or metric > self.best_metric)
+        periodic = self.every > 0 and (epoch + 1) % self.every == 0
+        if not improved and not periodic:
+            return False
+        state = self.save(model, epoch, publish=improved or self.best_metric is None)
+        if improved:
+            logging.info("Dev metric improved to %.4f at epoch %d" % (metric, epoch + 1))
+            self.best_metric = metric
+            self.best_state = state
+        return True
+
+    def save(self, model: torch.nn.Module, epoch: int, publish: bool = True) -> Dict[str, torch.Tensor]:
+        """
+        Snapshot the model and write it in the background
+        :param publish: also relink the model path to this checkpoint
+        """
+        # at most one snapshot is waiting to be written, this also surfaces errors of the previous write
+        self.wait()
+        state = snapshot(model)
+        if self.writes:
+            self.pending = self.writer.submit(self._write, state, epoch, publish)
+        self.last_saved_epoch = epoch
+        return state
+
+    def _write(self, state: Dict[str, torch.Tensor], epoch: int, publish: bool):
+        logging.info("Saving Model")
+        epoch_path = "%s.epoch%d" % (self.path, epoch + 1)
+        tmp = epoch_path + ".tmp"
+        with open(tmp, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, epoch_path)
+        if publish:
+            _replace(epoch_path, self.path)
+        if epoch_path in self.saved:
+            self.saved.remove(epoch_path)
+        self.saved.append(epoch_path)
+        while len(self.saved) > self.keep:
+            os.remove(self.saved.pop(0))
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def restore_best(self, model: torch.nn.Module) -> bool:
+        """
+        Load the best checkpoint back into the model, so it matches what was published
+        """
+        if self.best_state is None:
+            return False
+        model.load_state_dict(self.best_state)
+        return True
+
+    def close(self, model: Optional[torch.nn.Module] = None):
+        """
+        Save the final weights when no metric was tracked and they weren't saved yet, then wait for every write
+        """
+        if model is not None and self.best_metric is None and self.last_epoch not in (-1, self.last_saved_epoch):
+            self.save(model, self.last_epoch)
+        self.wait()
+        self.writer.shutdown()
@@ -0,0 +1,177 @@
+"""columnar.py: Columnar, memory-mapped storage for TriggerNER corpora
+Converts the JSON corpora (e.g. `Dataset/dev_IDRISI-RE-flood.json`) into flat numpy arrays of token, label and
+explanation ids plus an offset table, so a corpus can be opened with `mmap` instead of being parsed.
+This is the corpus format of the benchmarks (see `benchmarks/common.py`). The pipelines are not reading it: their data
+arrives as JSON in the API payloads, and what they build from it is kept by `data_cache.py`.
+
+Layout of a converted corpus directory:
+    meta.json          format version, number of sentences and stored columns
+    vocab.json         id -> string tables for every column
+    offsets.npy        int64 (num_sentences + 1), start of every sentence in the flat arrays
+    tokens.npy         int32 token ids
+    labels.npy         int16 label ids (only for labeled corpora)
+    explanations.npy   int16 explanation ids (only for corpora with trigger explanations)
+
+`load_corpus` keeps the conversion of a JSON file in a versioned directory behind a symlink, and converts a stale one
+into a new version before switching the symlink over, so readers never combine the files of two conversions.
+
+Usage:
+    python columnar.py <corpus.json> <output directory>
+"""
+import json
+import os
+import shutil
+import sys
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+
+FORMAT_VERSION = 1
+COLUMNS = {"text": ("tokens", np.int32), "label": ("labels", np.int16), "explanation": ("explanations", np.int16)}
+
+
+def convert_json(json_path: str, output_dir: str) -> str:
+    """
+    Convert a JSON array of {"text", "label", "explanation"} records into a columnar corpus directory
+    :param json_path: path to the source corpus
+    :param output_dir: directory the columnar corpus is written to
+    :return: output_dir
+    """
+    with open(json_path, "r", encoding="utf8") as f:
+        records = json.load(f)
+
+    present = [key for key in COLUMNS if key == "text" or any(key in record for record in records)]
+    for index, record in enumerate(records):
+        missing = [key for key in present if key not in record]
+        if missing:
+            raise ValueError("Record %d of %s has no %s, while other records have it" %
+                             (index, json_path, ", ".join(missing)))
+    vocabs = {key: {} for key in present}
+    ids = {key: [] for key in present}
+    offsets = [0]
+    for record in records:
+        tokens = record["text"].split(" ")
+        for key in present:
+            values = record[key].split(" ")
+            if len(values) != len(tokens):
+                raise ValueError("%s has %d tokens but %d %s values" % (record["text"], len(tokens), len(values), key))
+            vocab = vocabs[key]
+            ids[key].extend(vocab.setdefault(value, len(vocab)) for value in values)
+        offsets.append(offsets[-1] + len(tokens))
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    for key in present:
+        name, dtype = COLUMNS[key]
+        if len(vocabs[key]) > np.iinfo(dtype).max:
+            raise ValueError("Too many distinct %s values for %s" % (key, np.dtype(dtype).name))
+        np.save(os.path.join(output_dir, name + ".npy"), np.asarray(ids[key], dtype=dtype))
+
+    with open(os.path.join(output_dir, "vocab.json"), "w", encoding="utf8") as f:
+        json.dump({COLUMNS[key][0]: list(vocabs[key]) for key in present}, f)
+    # meta.json is written last, a directory without it is an incomplete conversion
+    with open(os.path.join(output_dir, "meta.json"), "w", encoding="utf8") as f:
+        json.dump({"version": FORMAT_VERSION, "num_sentences": len(records), "columns": present,
+                   "source": os.path.basename(json_path)}, f)
+    return output_dir
+
+
+class ColumnarCorpus(object):
+    """
+    Read-only, lazily decoded view of a columnar corpus.
+    Arrays are memory-mapped, so opening a corpus costs only the vocab parsing and the pages are shared between
+    processes reading the same corpus. Indexing returns the same {"text", "label", "explanation"} records as the
+    JSON corpora, which is what `Reader.build_data` consumes.
+    """
+
+    def __init__(self, path: str):
+        # a symlinked conversion is resolved once, so every file is read from the same version
+        path = os.path.realpath(path)
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf8") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError("Unsupported columnar corpus version %s in %s" % (self.meta["version"], path))
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf8") as f:
+            self.vocab = json.load(f)
+        self.columns = self.meta["columns"]
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.arrays = {key: np.load(os.path.join(path, COLUMNS[key][0] + ".npy"), mmap_mode="r")
+                       for key in self.columns}
+
+    def __len__(self) -> int:
+        return self.meta["num_sentences"]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return {key: " ".join(self.decode(key, index)) for key in self.columns}
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def ids(self, key: str, index: int) -> np.ndarray:
+        """
+        Raw ids of one column for one sentence, as a view on the memory-mapped array
+        """
+        return self.arrays[key][self.offsets[index]:self.offsets[index + 1]]
+
+    def decode(self, key: str, index: int) -> List[str]:
+        table = self.vocab[COLUMNS[key][0]]
+        return [table[i] for i in self.ids(key, index)]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+def _convert_version(json_path: str, convert_dir: str):
+    """
+    Convert into a new version directory next to `convert_dir` and atomically point the `convert_dir` symlink to it.
+    The version it replaces is kept for readers that resolved it just before, older ones are removed.
+    """
+    parent, name = os.path.split(os.path.abspath(convert_dir))
+    version = "%s.v-%s" % (name, uuid.uuid4().hex)
+    tmp_version = os.path.join(parent, version + ".tmp")
+    convert_json(json_path, tmp_version)
+    os.rename(tmp_version, os.path.join(parent, version))
+    replaced = None
+    if os.path.islink(convert_dir):
+        replaced = os.path.basename(os.readlink(convert_dir))
+    elif os.path.isdir(convert_dir):
+        # a conversion written before versioning, moved aside so the symlink can take its place
+        replaced = "%s.v-%s" % (name, uuid.uuid4().hex)
+        os.rename(convert_dir, os.path.join(parent, replaced))
+    link = os.path.join(parent, "%s.link-%s" % (name, uuid.uuid4().hex))
+    os.symlink(version, link)
+    os.replace(link, convert_dir)
+    for entry in os.listdir(parent):
+        if entry.startswith(name + ".v-") and entry not in (version, replaced) and not entry.endswith(".tmp"):
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+
+def load_corpus(path: str, convert_dir: Optional[str] = None):
+    """
+    Open a corpus from either a columnar directory or a JSON file. JSON files are converted once into
+    `convert_dir` (defaults to `<path>.columnar`) and reused afterwards, unless the JSON file is newer.
+    """
+    if os.path.isdir(path):
+        return ColumnarCorpus(path)
+    convert_dir = convert_dir or path + ".columnar"
+    meta_path = os.path.join(convert_dir, "meta.json")
+    if not os.path.exists(meta_path) or os.path.getmtime(meta_path) < os.path.getmtime(path):
+        os.makedirs(os.path.dirname(os.path.abspath(convert_dir)), exist_ok=True)
+        _convert_version(path, convert_dir)
+    return ColumnarCorpus(convert_dir)
+
+
+def column_summary(corpus: ColumnarCorpus) -> Dict[str, int]:
+    return {"sentences": len(corpus), "tokens": int(corpus.offsets[-1]),
+            **{key + "_vocab": len(corpus.vocab[COLUMNS[key][0]]) for key in corpus.columns}}
+
+
+if __name__ == "__main__":
+    corpus = ColumnarCorpus(convert_json(sys.argv[1], sys.argv[2]))
+    print(column_summary(corpus))
@@ -0,0 +1,328 @@
+"""data_cache.py: Content-hashed cache for built instances and vocabularies
+Replaces the pickles written by `generate_training_data_path` and `dump_label_word_emb_data`: the pipelines map ids
+with `parallel_builder`, which writes nothing, and only read the pickles of experiments trained before this cache.
+
+Every entry is keyed by a hash of the payload data it was built from, the reader settings (`digit2zero`), the
+embedding settings, the vocabulary the ids refer to and the source of the code that builds them, so a changed input
+can never load stale data. Entries are directories of numpy arrays (opened memory-mapped) and a small json file,
+written to a temporary directory first and renamed into place, so concurrent writers never see a half written entry.
+Pointers are updated under a file lock, and an entry that is no longer pointed to is only deleted `GC_AGE` seconds
+after it was replaced, so processes still reading it are not cut off.
+
+Layout under `generated_data/cache/`:
+    <key>/meta.json       format version, what the entry holds and json-sized fields (label vocab, char vocab, ...)
+    <key>/*.npy           ragged columns (flat values + offsets) and the word embedding table
+    <stem>.json           pointer from an experiment (same stem as the old pickle names) to its latest keys
+    .lock                 lock file serializing pointer updates and garbage collection
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .instance import Instance
+from .sentence import Sentence
+
+CACHE_VERSION = 1
+CODE_FILES = ["reader.py", "config.py", "instance.py", "sentence.py", "parallel_builder.py"]
+VOCAB_FIELDS = ["label2idx", "idx2labels", "char2idx", "idx2char"]
+# seconds an unreferenced entry or abandoned temporary directory is kept before it is deleted
+GC_AGE = 3600
+
+
+def _hash(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+def _code_fingerprint() -> str:
+    digest = hashlib.sha256(str(CACHE_VERSION).encode("utf-8"))
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:32]
+
+
+def _pack(rows: List[List[int]], dtype=np.int32):
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter((v for row in rows for v in row), dtype=dtype, count=int(offsets[-1]))
+    return values, offsets
+
+
+def _unpack(values: np.ndarray, offsets: np.ndarray) -> List[List[int]]:
+    values, offsets = values.tolist(), offsets.tolist()
+    return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+def _split(values: List[int], lengths: List[int]) -> List[List[int]]:
+    bounds = list(accumulate(lengths, initial=0))
+    return [values[bounds[i]:bounds[i + 1]] for i in range(len(lengths))]
+
+
+def _pack_columns(meta: Dict, columns: Dict[str, List[List[int]]]) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    meta["columns"] = list(columns)
+    arrays = {}
+    for column, rows in columns.items():
+        arrays[column], arrays[column + "_offsets"] = _pack(rows)
+    return meta, arrays
+
+
+def _unpack_columns(meta: Dict, arrays: Dict[str, np.ndarray]) -> Dict[str, List[List[int]]]:
+    return {column: _unpack(arrays[column], arrays[column + "_offsets"]) for column in meta["columns"]}
+
+
+def pack_ids(insts: List[Instance]) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """
+    Compact form of the ids set by `parallel_builder.map_ids`: a json-sized meta dict and flat numpy arrays
+    """
+    columns = {
+        "word_ids": [inst.word_ids for inst in insts],
+        "output_ids": [inst.output_ids or [] for inst in insts],
+        "char_ids": [[c for word in inst.char_ids for c in word] for inst in insts],
+        "char_lengths": [[len(word) for word in inst.char_ids] for inst in insts],
+    }
+    return _pack_columns({"has_output_ids": [inst.output_ids is not None for inst in insts]}, columns)
+
+
+def assign_ids(insts: List[Instance], meta: Dict, arrays: Dict[str, np.ndarray]):
+    """
+    Inverse of `pack_ids`, sets the ids on `insts` in place
+    """
+    columns = _unpack_columns(meta, arrays)
+    for i, inst in enumerate(insts):
+        inst.word_ids = columns["word_ids"][i]
+        inst.output_ids = columns["output_ids"][i] if meta["has_output_ids"][i] else None
+        inst.char_ids = _split(columns["char_ids"][i], columns["char_lengths"][i])
+
+
+def pack_instances(insts: List[Instance]) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """
+    Compact form of whole instances: words, labels, trigger annotations and, once mapped, their ids
+    """
+    mapped = all(inst.word_ids is not None for inst in insts)
+    meta, columns = {}, {}
+    if mapped:
+        meta, arrays = pack_ids(insts)
+        columns = _unpack_columns(meta, arrays)
+    table = {}
+    intern = lambda values: [table.setdefault(v, len(table)) for v in values]
+    columns["words"] = [intern(inst.input.words) for inst in insts]
+    columns["output"] = [intern(inst.output) if inst.output is not None else [] for inst in insts]
+    meta.update({"size": len(insts), "mapped": mapped, "has_output": [inst.output is not None for inst in insts],
+                 "trigger_label": [getattr(inst, "trigger_label", None) for inst in insts],
+                 "trigger_key": [getattr(inst, "trigger_key", None) for inst in insts]})
+    if any(label is not None for label in meta["trigger_label"]):
+        columns["trigger_positions"] = [inst.trigger_positions or [] for inst in insts]
+    meta["strings"] = list(table)
+    return _pack_columns(meta, columns)
+
+
+def unpack_instances(meta: Dict, arrays: Dict[str, np.ndarray]) -> List[Instance]:
+    """
+    Inverse of `pack_instances`
+    """
+    strings = meta["strings"]
+    columns = _unpack_columns(meta, arrays)
+    insts = []
+    for i in range(meta["size"]):
+        words = [strings[w] for w in columns["words"][i]]
+        output = [strings[o] for o in columns["output"][i]] if meta["has_output"][i] else None
+        inst = Instance(Sentence(words), output)
+        if "trigger_positions" in columns and meta["trigger_label"][i] is not None:
+            inst.trigger_positions = columns["trigger_positions"][i]
+            inst.trigger_label = meta["trigger_label"][i]
+            inst.trigger_key = meta["trigger_key"][i]
+        insts.append(inst)
+    if meta["mapped"]:
+        assign_ids(insts, meta, arrays)
+    return insts
+
+
+class DataCache(object):
+    """
+    Cache of the data built from one training payload.
+    :param config: the Config of the pipeline, used for the cache location and reader/embedding settings
+    :param payload: the pipeline payload, every entry in `inputs` is hashed
+    :param inputs: mapping from cached data name (e.g. "trigger", "dev") to the payload key it is built from
+    """
+
+    def __init__(self, config, payload: Dict, inputs: Dict[str, str]):
+        self.config = config
+        self.root, self.stem = cache_location(config)
+        self.code = _code_fingerprint()
+        self.settings = {"digit2zero": config.digit2zero, "embeddings": payload.get("embeddings"),
+                         "emb_dim": payload.get("emb_dim"), "seed": payload.get("seed")}
+        self.input_hashes = {name: _hash(payload.get(key)) if payload.get(key) is not None else None
+                             for name, key in inputs.items()}
+        self.keys = {"vocab": _hash("vocab", self.code, self.settings, sorted(self.input_hashes.items()))}
+        for name, input_hash in self.input_hashes.items():
+            self.keys[name] = _hash(name, self.code, self.settings, input_hash, self.keys["vocab"])
+
+    def _entry(self, name: str) -> str:
+        return os.path.join(self.root, self.keys[name])
+
+    def contains(self, name: str) -> bool:
+        if name != "vocab" and self.input_hashes[name] is None:
+            return True
+        return os.path.exists(os.path.join(self._entry(name), "meta.json"))
+
+    def load_vocab(self) -> Optional[int]:
+        """
+        Restore the label/word/char vocabularies and embedding table onto the config
+        :return: label_length as passed to `save_vocab`
+        """
+        return _load_vocab(self.config, self._entry("vocab"))
+
+    def save_vocab(self, label_length: Optional[int] = None):
+        config = self.config
+        meta = {field: getattr(config, field) for field in VOCAB_FIELDS}
+        meta["label_length"] = label_length
+        arrays = {"idx2word": np.asarray(config.idx2word, dtype=object).astype(str)}
+        if getattr(config, "word_embedding", None) is not None:
+            arrays["word_embedding"] = np.asarray(config.word_embedding, dtype=np.float32)
+        self._write("vocab", meta, arrays)
+
+    def load_instances(self, name: str) -> Optional[List[Instance]]:
+        if self.input_hashes[name] is None:
+            return None
+        entry = self._entry(name)
+        with open(os.path.join(entry, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {array_name: np.load(os.path.join(entry, array_name + ".npy"), mmap_mode="r")
+                  for column in meta["columns"] for array_name in (column, column + "_offsets")}
+        return unpack_instances(meta, arrays)
+
+    def save_instances(self, name: str, insts: Optional[List[Instance]]):
+        if insts is not None:
+            self._write(name, *pack_instances(insts))
+
+    def _write(self, name: str, meta: Dict, arrays: Dict[str, np.ndarray]):
+        entry = self._entry(name)
+        tmp = "%s.tmp-%s" % (entry, uuid.uuid4().hex)
+        os.makedirs(tmp)
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp, array_name + ".npy"), array, allow_pickle=False)
+        meta = dict(meta, version=CACHE_VERSION, name=name, key=self.keys[name])
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another writer built the same entry first, keys are content hashes so both are identical. Its age is
+            # reset so garbage collection does not take it before the pointer refers to it again.
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.utime(entry)
+        self._update_pointer(name)
+
+    def _update_pointer(self, name: str):
+        path = os.path.join(self.root, self.stem + ".json")
+        with _locked(self.root):
+            pointer = _read_pointer(path)
+            replaced = pointer.get(name)
+            pointer[name] = self.keys[name]
+            tmp = "%s.tmp-%s" % (path, uuid.uuid4().hex)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(pointer, f)
+            os.replace(tmp, path)
+            if replaced and replaced != self.keys[name] and os.path.isdir(os.path.join(self.root, replaced)):
+                # the age of an unreferenced entry counts from when it was replaced
+                os.utime(os.path.join(self.root, replaced))
+            _collect_garbage(self.root)
+
+
+def cache_location(config):
+    """
+    Cache directory and experiment stem, derived from the path the old vocab pickle would have been written to
+    """
+    legacy_path = config.generate_training_data_path("vocab")
+    root = os.path.join(os.path.dirname(os.path.dirname(legacy_path)), "cache")
+    os.makedirs(root, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(legacy_path))[0]
+    return root, stem
+
+
+@contextmanager
+def _locked(root: str):
+    """
+    Exclusive lock on the cache directory, held across a read-modify-write of the pointers
+    """
+    with open(os.path.join(root, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _collect_garbage(root: str, max_age: float = GC_AGE):
+    """
+    Delete entries no pointer refers to and temporary directories, once they are older than `max_age` seconds.
+    Called with the lock held.
+    """
+    referenced = set()
+    for name in os.listdir(root):
+        if name.endswith(".json"):
+            referenced.update(_read_pointer(os.path.join(root, name)).values())
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name in referenced or not os.path.isdir(path):
+            continue
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def _read_pointer(path: str) -> Dict[str, str]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _load_vocab(config, entry: str) -> Optional[int]:
+    with open(os.path.join(entry, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    for field in VOCAB_FIELDS:
+        setattr(config, field, meta[field])
+    config.label_size = len(config.label2idx)
+    config.idx2word = np.load(os.path.join(entry, "idx2word.npy")).tolist()
+    config.word2idx = {word: idx for idx, word in enumerate(config.idx2word)}
+    embedding_path = os.path.join(entry, "word_embedding.npy")
+    if os.path.exists(embedding_path):
+        # copy-on-write mapping, pages stay shared until someone writes to the table
+        config.word_embedding = np.load(embedding_path, mmap_mode="c")
+    return meta["label_length"]
+
+
+def read_vocab(config) -> Optional[int]:
+    """
+    Restore the vocabularies of the latest training run of this experiment, used by the eval and predict pipelines
+    :return: label_length
+    """
+    root, stem = cache_location(config)
+    key = _read_pointer(os.path.join(root, stem + ".json")).get("vocab")
+    if key is None:
+        # experiments trained before the cache existed only have the pickled vocab
+        logging.warning("No cached vocab for %s, falling back to the pickled vocab" % stem)
+        return config.read_label_word_emd_data()
+    return _load_vocab(config, os.path.join(root, key))
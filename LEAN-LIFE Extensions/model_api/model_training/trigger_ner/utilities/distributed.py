@@ -0,0 +1,130 @@
+"""distributed.py: CPU data-parallel training of the soft trainers with torch.distributed (gloo)
+`run` forks `train_processes` local processes that each hold a full copy of the trainer. The training batches are
+sharded across them by `BatchLoader(shard=True)`, gradients are averaged with one all-reduce per optimizer step in
+`TrainLoop`, and every process evaluates the same weights so early stopping stays in lockstep. Only rank 0 writes
+checkpoints and sends progress updates; its weights and results are handed back to the calling process.
+
+The batch order of an epoch is drawn from `config.seed` and the epoch number, and every process seeds its dropout
+from `config.seed` and its rank, so a run is reproducible for a fixed number of processes.
+"""
+import io
+import multiprocessing
+import os
+import random
+import socket
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# stands in for the model in the return values sent back by rank 0
+MODEL = "<model>"
+
+
+def is_initialized() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_initialized() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main_process() -> bool:
+    return rank() == 0
+
+
+def average_gradients(model: torch.nn.Module):
+    """
+    Average the gradients of all processes with a single all-reduce. Parameters without a gradient on this process
+    take part with zeros, so every process reduces the same buffer.
+    """
+    if not is_initialized():
+        return
+    params = [param for param in model.parameters() if param.requires_grad]
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in params]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= world_size()
+    offset = 0
+    for param, grad in zip(params, grads):
+        reduced = flat[offset:offset + grad.numel()].view_as(grad)
+        if param.grad is None:
+            param.grad = reduced.clone()
+        else:
+            param.grad.copy_(reduced)
+        offset += grad.numel()
+
+
+def reduce_sum(value: float) -> float:
+    if not is_initialized():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+def seed_process(seed: int):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _worker(process_rank, processes, port, trainer, method, args, results):
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:%d" % port, rank=process_rank,
+                            world_size=processes)
+    try:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // processes))
+        seed_process(trainer.config.seed + process_rank)
+        for param in trainer.model.parameters():
+            dist.broadcast(param.data, 0)
+        result = getattr(trainer, method)(*args)
+        if process_rank == 0:
+            # the model is sent back as a CPU state dict, other return values as they are
+            returned = result if isinstance(result, tuple) else (result,)
+            returned = tuple(MODEL if value is trainer.model else value for value in returned)
+            state = {name: tensor.detach().cpu() for name, tensor in trainer.model.state_dict().items()}
+            # serialized instead of shared, shared tensors would die with this process
+            buffer = io.BytesIO()
+            torch.save((state, returned, trainer.epochs_run), buffer)
+            results.put(buffer.getvalue())
+        dist.barrier()
+    finally:
+        dist.destroy_process_group()
+
+
+def run(trainer, method: str, *args, processes: Optional[int] = None):
+    """
+    Call `getattr(trainer, method)(*args)` on `train_processes` processes, or directly when it is 1.
+    Afterwards the trainer's model holds the weights rank 0 ended with and `epochs_run` is set.
+    """
+    processes = processes or getattr(trainer.config, "train_processes", 1) or 1
+    if processes <= 1 or "fork" not in mp.get_all_start_methods():
+        return getattr(trainer, method)(*args)
+
+    results = multiprocessing.get_context("fork").SimpleQueue()
+    context = mp.start_processes(_worker, args=(processes, _free_port(), trainer, method, args, results),
+                                 nprocs=processes, join=False, start_method="fork")
+    # read before joining, rank 0 blocks until its result is taken from the queue
+    while results.empty():
+        # raises when one of the processes failed
+        if context.join(timeout=1):
+            raise RuntimeError("Training processes exited without a result")
+    state, returned, epochs_run = torch.load(io.BytesIO(results.get()), weights_only=False)
+    while not context.join():
+        pass
+    trainer.model.load_state_dict(state)
+    trainer.epochs_run = epochs_run
+    returned = tuple(trainer.model if isinstance(value, str) and value == MODEL else value for value in returned)
+    return returned if len(returned) > 1 else returned[0]
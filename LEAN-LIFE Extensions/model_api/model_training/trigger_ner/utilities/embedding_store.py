@@ -0,0 +1,188 @@
+"""embedding_store.py: Binary, memory-mapped store for pretrained word embeddings
+A text embedding file (e.g. glove.840B.300d.txt) is converted once into a float32 matrix and a hashed word index.
+Building the embedding table afterwards only looks up the words of the current vocabulary and reads their rows from
+the memory-mapped matrix, instead of parsing the whole text file and keeping every vector in a dict.
+
+Layout of `<embedding file>.store/`:
+    meta.json           format version, number of words and dimension
+    vectors.npy         float32 (num_words, dim)
+    words.bin           utf-8 bytes of all words, concatenated
+    word_offsets.npy    int64 (num_words + 1), start of every word in words.bin
+    hash_table.npy      int64 open-addressing table from word hash to row, -1 for empty slots
+
+Usage:
+    python embedding_store.py <embedding file>
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import uuid
+from typing import Dict, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+STORE_VERSION = 1
+
+
+def _word_hash(word: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(word, digest_size=8).digest(), "little")
+
+
+def _is_header(line: str) -> bool:
+    # word2vec/fastText files start with "<num_words> <dim>"
+    parts = line.split()
+    return len(parts) == 2 and all(part.isdigit() for part in parts)
+
+
+def convert_embedding(embedding_file: str, store_dir: Optional[str] = None) -> str:
+    """
+    Convert a text embedding file into a store directory
+    :param embedding_file: one "word v1 v2 ... vd" line per word
+    :param store_dir: defaults to `<embedding_file>.store`
+    :return: store_dir
+    """
+    store_dir = store_dir or embedding_file + ".store"
+    with open(embedding_file, "r", encoding="utf-8", errors="replace") as f:
+        first = f.readline()
+        skip_header = _is_header(first)
+        dim = len((f.readline() if skip_header else first).rstrip().split(" ")) - 1
+        f.seek(0)
+        num_lines = sum(1 for _ in f) - int(skip_header)
+
+    tmp = "%s.tmp-%s" % (store_dir, uuid.uuid4().hex)
+    os.makedirs(tmp)
+    vectors = np.lib.format.open_memmap(os.path.join(tmp, "vectors.npy"), mode="w+", dtype=np.float32,
+                                        shape=(num_lines, dim))
+    table_size = 1 << max(4, (2 * num_lines - 1).bit_length())
+    hash_table = np.full(table_size, -1, dtype=np.int64)
+    offsets = [0]
+    num_words = 0
+    seen = set()
+    with open(embedding_file, "r", encoding="utf-8", errors="replace") as f, \
+            open(os.path.join(tmp, "words.bin"), "wb") as words:
+        if skip_header:
+            f.readline()
+        for line in tqdm(f, total=num_lines):
+            # some glove.840B words contain spaces, so the vector is taken from the right
+            parts = line.rstrip("\n").rstrip(" ").rsplit(" ", dim)
+            if len(parts) != dim + 1:
+                continue
+            word = parts[0].encode("utf-8")
+            if word in seen:
+                continue
+            seen.add(word)
+            slot = _word_hash(word) & (table_size - 1)
+            while hash_table[slot] != -1:
+                slot = (slot + 1) & (table_size - 1)
+            hash_table[slot] = num_words
+            vectors[num_words] = np.asarray(parts[1:], dtype=np.float32)
+            words.write(word)
+            offsets.append(offsets[-1] + len(word))
+            num_words += 1
+    vectors.flush()
+    del vectors
+
+    np.save(os.path.join(tmp, "word_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp, "hash_table.npy"), hash_table)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"version": STORE_VERSION, "num_words": num_words, "dim": dim,
+                   "source": os.path.basename(embedding_file)}, f)
+    try:
+        os.rename(tmp, store_dir)
+    except OSError:
+        # converted concurrently by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    return store_dir
+
+
+class EmbeddingStore(object):
+    def __init__(self, store_dir: str):
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError("Unsupported embedding store version %s in %s" % (self.meta["version"], store_dir))
+        self.dim = self.meta["dim"]
+        # the matrix can be larger than the number of words when duplicate lines were skipped
+        self.vectors = np.load(os.path.join(store_dir, "vectors.npy"), mmap_mode="r")
+        self.words = np.memmap(os.path.join(store_dir, "words.bin"), dtype=np.uint8, mode="r") \
+            if os.path.getsize(os.path.join(store_dir, "words.bin")) else np.zeros(0, dtype=np.uint8)
+        self.offsets = np.load(os.path.join(store_dir, "word_offsets.npy"), mmap_mode="r")
+        self.hash_table = np.load(os.path.join(store_dir, "hash_table.npy"), mmap_mode="r")
+        self.mask = len(self.hash_table) - 1
+
+    def __len__(self) -> int:
+        return self.meta["num_words"]
+
+    def index(self, word: str) -> int:
+        """
+        Row of `word` in the matrix, -1 if the word has no pretrained vector
+        """
+        encoded = word.encode("utf-8")
+        slot = _word_hash(encoded) & self.mask
+        while True:
+            row = int(self.hash_table[slot])
+            if row == -1:
+                return -1
+            if self.words[self.offsets[row]:self.offsets[row + 1]].tobytes() == encoded:
+                return row
+            slot = (slot + 1) & self.mask
+
+    def __contains__(self, word: str) -> bool:
+        return self.index(word) != -1
+
+    def gather(self, word2idx: Dict[str, int], scale: float) -> np.ndarray:
+        """
+        Embedding table for a vocabulary, with the same fallbacks as `Config.build_emb_table`:
+        the word itself, then its lowercased form, then a uniform random vector in [-scale, scale]
+        """
+        rows = np.full(len(word2idx), -1, dtype=np.int64)
+        for word, idx in word2idx.items():
+            row = self.index(word)
+            rows[idx] = row if row != -1 else self.index(word.lower())
+        found = rows != -1
+        table = np.empty((len(word2idx), self.dim))
+        # sorted reads keep the page accesses on the memory-mapped matrix sequential
+        order = np.argsort(rows[found])
+        targets = np.flatnonzero(found)[order]
+        table[targets] = self.vectors[rows[found][order]]
+        missing = np.flatnonzero(~found)
+        for idx in missing:
+            table[idx] = np.random.uniform(-scale, scale, [1, self.dim])
+        return table
+
+
+def open_store(embedding_file: str) -> EmbeddingStore:
+    """
+    Open the store of an embedding file, converting it first if this is the first time it is used
+    """
+    store_dir = embedding_file + ".store"
+    if not os.path.exists(os.path.join(store_dir, "meta.json")):
+        logging.info("Converting %s into a binary embedding store, this only happens once" % embedding_file)
+        convert_embedding(embedding_file, store_dir)
+    return EmbeddingStore(store_dir)
+
+
+def build_emb_table(config) -> None:
+    """
+    Drop-in replacement for `config.build_emb_table()` that reads from the binary store of `config.embedding_file`.
+    Falls back to the config's own implementation when there is no embedding file to convert.
+    """
+    embedding_file = getattr(config, "embedding_file", None)
+    if embedding_file is None or not os.path.isfile(embedding_file):
+        config.build_emb_table()
+        return
+    store = open_store(embedding_file)
+    if store.dim != config.embedding_dim:
+        raise ValueError("%s has dimension %d, but emb_dim is %d" % (embedding_file, store.dim, config.embedding_dim))
+    logging.info("[Info] Use the pretrained word embedding to initialize: %d x %d" % (len(config.word2idx), store.dim))
+    config.word_embedding = store.gather(config.word2idx, np.sqrt(3.0 / config.embedding_dim))
+    config.embedding = None
+
+
+if __name__ == "__main__":
+    store = EmbeddingStore(convert_embedding(sys.argv[1]))
+    print("%d words, dimension %d" % (len(store), store.dim))
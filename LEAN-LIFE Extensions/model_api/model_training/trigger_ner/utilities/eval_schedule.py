@@ -0,0 +1,111 @@
+"""eval_schedule.py: How often and on how much data the trainers evaluate during training
+Every trainer reads its own settings with a prefix, e.g. `matcher_eval_every` and `sequence_eval_samples`:
+    <prefix>_eval_every     evaluate every N epochs and after the last one, 0 only after the last one
+    <prefix>_eval_samples   evaluate on a fixed random sample of at most N instances, 0 uses all of them
+`eval_in_background` evaluates a copy of the weights on a worker thread while training continues. Its result then
+arrives one or more epochs later, which delays checkpointing and early stopping accordingly.
+"""
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+
+from . import distributed
+
+
+def copy_model(model: torch.nn.Module, config) -> torch.nn.Module:
+    """
+    Deep copy of the model in eval mode that shares the config, and with it the vocab and embedding table
+    """
+    snapshot = copy.deepcopy(model, {id(config): config})
+    snapshot.eval()
+    return snapshot
+
+
+class EvalSchedule(object):
+    def __init__(self, config, prefix: str, num_epochs: int):
+        self.config = config
+        self.every = getattr(config, prefix + "_eval_every", 1)
+        self.samples = getattr(config, prefix + "_eval_samples", 0) or 0
+        self.num_epochs = num_epochs
+        self.sampled = {}
+        # distributed processes have to see results at the same epochs to stop together, so they evaluate inline
+        background = getattr(config, "eval_in_background", False) and not distributed.is_initialized()
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = []
+
+    def due(self, epoch: int) -> bool:
+        return epoch + 1 == self.num_epochs or (self.every > 0 and (epoch + 1) % self.every == 0)
+
+    def sample(self, insts: list) -> list:
+        """
+        The same random sample of `insts` every epoch, in the original order
+        """
+        if not insts or not self.samples or len(insts) <= self.samples:
+            return insts
+        if id(insts) not in self.sampled:
+            indices = np.random.RandomState(self.config.seed).choice(len(insts), self.samples, replace=False)
+            self.sampled[id(insts)] = [insts[i] for i in sorted(indices)]
+        return self.sampled[id(insts)]
+
+    def submit(self, model: torch.nn.Module, epoch: int, evaluate: Callable[[torch.nn.Module], float]):
+        """
+        Evaluate the model as it is after `epoch`, now or on the worker thread
+        :param evaluate: computes the metric of a model
+        """
+        if self.executor is None:
+            model.eval()
+            with torch.no_grad():
+                self.pending.append((epoch, model, evaluate(model)))
+            return
+        # at most one evaluation is queued behind the running one, each of them holds a copy of the model
+        if len(self.pending) > 1:
+            self.pending[-2][2].result()
+        snapshot = copy_model(model, self.config)
+        self.pending.append((epoch, snapshot, self.executor.submit(self._evaluate, evaluate, snapshot)))
+
+    @staticmethod
+    def _evaluate(evaluate, model):
+        with torch.no_grad():
+            return evaluate(model)
+
+    def collect(self, wait: bool = False) -> List[Tuple[int, torch.nn.Module, float]]:
+        """
+        Finished evaluations as (epoch, evaluated model, metric), in epoch order
+        :param wait: wait for the evaluations still running
+        """
+        finished = []
+        while self.pending:
+            epoch, model, result = self.pending[0]
+            if self.executor is not None:
+                if not wait and not result.done():
+                    break
+                result = result.result()
+            finished.append((epoch, model, result))
+            self.pending.pop(0)
+        return finished
+
+    def close(self) -> List[Tuple[int, torch.nn.Module, float]]:
+        finished = self.collect(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+        return finished
+
+
+def apply_results(results, checkpoint, scheduler=None, stopping=None) -> bool:
+    """
+    Feed finished evaluations to the checkpoint manager, the learning-rate scheduler and early stopping
+    :return: whether training should stop
+    """
+    stop = False
+    for epoch, model, metric in results:
+        checkpoint.step(model, epoch, metric)
+        if metric is None:
+            continue
+        if scheduler is not None:
+            scheduler.step(metric)
+        if stopping is not None:
+            stop = stopping.step(metric) or stop
+    return stop
@@ -0,0 +1,276 @@
+"""memory.py: Peak memory of every pipeline stage and training epoch
+A `MemoryTracker` records, for every stage, the resident memory at its end and the peaks reached while it ran: RSS,
+the Python heap with the `memory_tracemalloc` run option (tracemalloc slows allocation down, so it is off by default)
+and the torch CUDA allocator when there is a GPU. On Linux the RSS peak is the kernel's high-water mark (VmHWM),
+which is reset at every stage boundary, so short spikes in between samples are not missed. Peaks of nested stages
+also count towards the stages around them.
+These peaks are process-wide, so only a tracker that is the only one active in the process resets them. While other
+pipelines are tracked concurrently, a tracker samples VmRSS from a thread instead, and leaves the Python heap and CUDA
+peaks out. tracemalloc runs while any tracker asked for it.
+
+Every pipeline runs in `memory_tracker`, the stages are the `timing.stage` blocks of the pipelines and the epochs of
+`TrainLoop`, as far as they run in the pipeline's process (with `train_processes` > 1 the epochs run in the workers).
+The peaks are logged as one structured (json) log line when the pipeline ends. When a stage goes over the soft
+`memory_budget_mb` (or MODEL_API_MEMORY_BUDGET_MB), a warning is logged, well before the kernel kills the job at its
+hard limit.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+
+ENV_BUDGET = "MODEL_API_MEMORY_BUDGET_MB"
+# interval of the VmRSS samples of trackers that share the process
+SAMPLE_SECONDS = 0.05
+
+_active: contextvars.ContextVar = contextvars.ContextVar("memory_tracker", default=None)
+
+# process-wide state of the trackers: how many are active, and how many of them asked for tracemalloc
+_lock = threading.Lock()
+_tracked = 0
+_tracing_users = 0
+_started_tracing = False
+
+
+def _read_status(field: str) -> Optional[float]:
+    """
+    A memory field of /proc/self/status in MB, None where it is not available
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb() -> float:
+    return _read_status("VmRSS") or 0.0
+
+
+def _reset_rss_peak() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class _RssSampler(threading.Thread):
+    """
+    Highest VmRSS sampled since the last `take`, for trackers that can't reset the process-wide high-water mark
+    """
+    def __init__(self):
+        super(_RssSampler, self).__init__(name="rss-sampler", daemon=True)
+        self.lock = threading.Lock()
+        self.peak = rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_SECONDS):
+            current = rss_mb()
+            with self.lock:
+                self.peak = max(self.peak, current)
+
+    def take(self) -> float:
+        current = rss_mb()
+        with self.lock:
+            peak, self.peak = max(self.peak, current), current
+        return peak
+
+    def stop(self):
+        self.stopped.set()
+
+
+class MemoryTracker(object):
+    def __init__(self, name: str, budget_mb: float = 0.0):
+        self.name = name
+        self.budget_mb = budget_mb
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.epochs: List[Dict] = []
+        # peaks of the open stages, innermost last
+        self.frames: List[Dict] = []
+        self.peak_rss_mb = rss_mb()
+        self.warned = set()
+        self.tracing = False
+        # whether the process-wide peaks were reset by this tracker at its last reset, otherwise `sampler` runs
+        self.exclusive = False
+        self.sampler: Optional[_RssSampler] = None
+
+    def start(self):
+        """
+        Count the tracker as active in the process and reset its peaks
+        """
+        global _tracked
+        with _lock:
+            _tracked += 1
+            self._reset()
+
+    def configure(self, config):
+        """
+        Take the budget and the tracemalloc switch from the run options of `config`
+        """
+        global _tracing_users, _started_tracing
+        self.budget_mb = getattr(config, "memory_budget_mb", 0) or float(os.environ.get(ENV_BUDGET, 0) or 0)
+        if getattr(config, "memory_tracemalloc", False) and not self.tracing:
+            with _lock:
+                self.tracing = True
+                _tracing_users += 1
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _started_tracing = True
+
+    def _peaks(self) -> Dict[str, float]:
+        if not self.exclusive:
+            return {"peak_rss_mb": self.sampler.take()}
+        peaks = {"peak_rss_mb": max(_read_status("VmHWM") or 0.0, rss_mb())}
+        if tracemalloc.is_tracing():
+            peaks["python_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        if torch.cuda.is_available():
+            peaks["torch_peak_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+        return peaks
+
+    def _reset(self):
+        """
+        Reset the process-wide peaks when no other tracker is active, otherwise sample VmRSS. Called holding `_lock`
+        """
+        self.exclusive = _tracked == 1
+        if not self.exclusive:
+            if self.sampler is None:
+                self.sampler = _RssSampler()
+                self.sampler.start()
+            return
+        _reset_rss_peak()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _fold(self):
+        """
+        Count the peaks since the last reset towards every open stage, then reset them
+        """
+        with _lock:
+            peaks = self._peaks()
+            self._reset()
+        self.peak_rss_mb = max(self.peak_rss_mb, peaks["peak_rss_mb"])
+        for frame in self.frames:
+            for key, value in peaks.items():
+                frame["peaks"][key] = max(frame["peaks"].get(key, 0.0), value)
+
+    @contextmanager
+    def stage(self, name: str, epoch: Optional[int] = None):
+        self._fold()
+        frame = {"name": name, "peaks": {}}
+        self.frames.append(frame)
+        try:
+            yield
+        finally:
+            self._fold()
+            self.frames.pop()
+            result = dict(frame["peaks"], rss_mb=rss_mb())
+            if epoch is None:
+                totals = self.stages.setdefault(name, {})
+                for key, value in result.items():
+                    totals[key] = max(totals.get(key, 0.0), value)
+            else:
+                parent = self.frames[-1]["name"] if self.frames else self.name
+                self.epochs.append(dict(result, stage=parent, epoch=epoch))
+                name = "%s epoch %d" % (parent, epoch)
+            # logged as they end, so the log of a job killed for its memory shows the stages it got through
+            logging.info("%s: %s peaked at %.0f MB RSS, %.0f MB at its end" %
+                         (self.name, name, result["peak_rss_mb"], result["rss_mb"]))
+            self.check(name, result["peak_rss_mb"])
+
+    def check(self, name: str, peak_mb: float):
+        """
+        Warn once per stage when its RSS peak went over the budget
+        """
+        if self.budget_mb and peak_mb > self.budget_mb and name not in self.warned:
+            self.warned.add(name)
+            logging.warning("%s: %s peaked at %.0f MB RSS, over the memory budget of %.0f MB" %
+                            (self.name, name, peak_mb, self.budget_mb))
+
+    def summary(self) -> Dict:
+        """
+        Overall RSS peak and the peaks of every stage, in the order they were first entered, and of every epoch
+        """
+        return {"pipeline": self.name, "peak_rss_mb": self.peak_rss_mb, "budget_mb": self.budget_mb,
+                "stages": self.stages, "epochs": self.epochs}
+
+    def peak_stage(self) -> Optional[str]:
+        if not self.stages:
+            return None
+        return max(self.stages, key=lambda stage: self.stages[stage]["peak_rss_mb"])
+
+    def log(self):
+        logging.info(json.dumps({"event": "memory_peaks", **self.summary()}))
+
+    def close(self):
+        """
+        Stop counting the tracker as active, and stop tracemalloc when it was the last one that asked for it
+        """
+        global _tracked, _tracing_users, _started_tracing
+        with _lock:
+            _tracked -= 1
+            if self.tracing:
+                self.tracing = False
+                _tracing_users -= 1
+                if not _tracing_users and _started_tracing:
+                    tracemalloc.stop()
+                    _started_tracing = False
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+
+def active_tracker() -> Optional[MemoryTracker]:
+    return _active.get()
+
+
+def configure_memory(config):
+    tracker = _active.get()
+    if tracker is not None:
+        tracker.configure(config)
+
+
+@contextmanager
+def memory_stage(name: str, epoch: Optional[int] = None):
+    """
+    Record the memory peaks of the block as stage `name` (or as an epoch of the enclosing stage) of the active tracker
+    """
+    tracker = _active.get()
+    if tracker is None:
+        yield
+        return
+    with tracker.stage(name, epoch):
+        yield
+
+
+@contextmanager
+def memory_tracker(name: str):
+    """
+    Tracker of a pipeline run, the caller's when it activated one, otherwise a new one that is logged at the end
+    """
+    tracker = _active.get()
+    if tracker is not None:
+        yield tracker
+        return
+    tracker = MemoryTracker(name)
+    tracker.start()
+    token = _active.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _active.reset(token)
+        tracker.close()
+        tracker.log()
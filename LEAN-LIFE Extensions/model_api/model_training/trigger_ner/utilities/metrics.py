@@ -0,0 +1,242 @@
+"""metrics.py: In-process metrics of the model API in the Prometheus text format
+A small registry of counters, gauges and histograms, each with optional labels, that `REGISTRY.render()` writes out in
+the text exposition format served by the `/metrics` route of `fast_api/main.py`. It has no dependencies: recording a
+value takes a lock and a dict lookup (and a bisect for histograms), which is negligible next to a request.
+
+The metrics of the API are declared at the bottom of this file so the endpoints and the pipelines share them. Rates,
+such as sentences predicted per second, are meant to be taken from the counters by the scraper
+(`rate(model_api_sentences_predicted_total[1m])`). Process RSS and CPU time are read when the metrics are rendered.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# latency buckets in seconds, from a cached prediction to a full training run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join('%s="%s"' % (name, value) for name, value in zip(names, escaped)) + "}"
+
+
+class _Metric(object):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError("%s takes the labels %s, got %s" % (self.name, self.label_names, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, label_names, label_values, value in self.samples():
+            lines.append("%s%s %s" % (name, _format_labels(label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super(Counter, self).__init__(name, documentation, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.label_names, key, value) for key, value in self.values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Raise the gauge by one while the block runs
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.label_names, key, value) for key, value in self.values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: observations per bucket (the last one past every bound), sum and count
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the wall time of the block, also when it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        samples = []
+        bucket_names = self.label_names + ("le",)
+        for key, counts, total, count in values:
+            cumulative = 0
+            for bound, observed in zip(self.buckets + (math.inf,), counts):
+                cumulative += observed
+                samples.append((self.name + "_bucket", bucket_names, key + (_format_value(bound),), cumulative))
+            samples.append((self.name + "_sum", self.label_names, key, total))
+            samples.append((self.name + "_count", self.label_names, key, count))
+        return samples
+
+
+class ProcessMetrics(object):
+    """
+    Resident memory and CPU time of this process, read when rendered
+    """
+    def render(self) -> List[str]:
+        times = os.times()
+        lines = ["# HELP process_cpu_seconds_total Total user and system CPU time spent in seconds.",
+                 "# TYPE process_cpu_seconds_total counter",
+                 "process_cpu_seconds_total %s" % _format_value(times.user + times.system)]
+        rss = self.resident_memory_bytes()
+        if rss is not None:
+            lines += ["# HELP process_resident_memory_bytes Resident memory size in bytes.",
+                      "# TYPE process_resident_memory_bytes gauge",
+                      "process_resident_memory_bytes %d" % rss]
+        return lines
+
+    @staticmethod
+    def resident_memory_bytes():
+        try:
+            with open("/proc/self/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+
+class Registry(object):
+    def __init__(self):
+        self.collectors = []
+        self.names = set()
+        self.lock = threading.Lock()
+
+    def register(self, collector):
+        with self.lock:
+            name = getattr(collector, "name", None)
+            if name is not None:
+                if name in self.names:
+                    raise ValueError("A metric named %s is already registered" % name)
+                self.names.add(name)
+            self.collectors.append(collector)
+        return collector
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            collectors = list(self.collectors)
+        lines = []
+        for collector in collectors:
+            lines.extend(collector.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REGISTRY.register(ProcessMetrics())
+
+REQUESTS = REGISTRY.counter("model_api_requests_total", "Requests handled, by route and status code.",
+                            ("method", "route", "status"))
+REQUEST_SECONDS = REGISTRY.histogram("model_api_request_duration_seconds", "Request latency, by route.",
+                                     ("method", "route"))
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("model_api_requests_in_flight", "Requests being handled, by route.",
+                                    ("method", "route"))
+TRAINING_JOBS = REGISTRY.gauge("model_api_training_jobs", "Training jobs by state (queued or running).",
+                               ("pipeline", "state"))
+SENTENCES_PREDICTED = REGISTRY.counter("model_api_sentences_predicted_total",
+                                       "Sentences labelled by the eval and predict pipelines.", ("pipeline",))
+PREDICTION_SECONDS = REGISTRY.histogram("model_api_prediction_duration_seconds",
+                                        "Time spent labelling the sentences of a request, model loading excluded.",
+                                        ("pipeline",))
+MODEL_LOAD_SECONDS = REGISTRY.histogram("model_api_model_load_duration_seconds",
+                                        "Time spent loading model weights, its count is the number of loads.",
+                                        ("pipeline",))
@@ -0,0 +1,117 @@
+"""parallel_builder.py: Process-parallel `Reader.build_data` and id mapping
+Splits the input into contiguous chunks that worker processes tokenize and map to ids, and that come back in the
+compact packed form of `data_cache`, unpacked in chunk order so the result is identical to the serial calls.
+The ids are the ones `Config.map_insts_ids` sets, but the instances are not pickled to `generate_training_data_path`:
+built data is only kept by `data_cache`.
+
+The pipelines run in the threads of the API server, so the workers are started with forkserver (spawn where it is not
+available) rather than forked from a multithreaded process, and every call has its own pool. The reader and the
+vocabularies (not the whole config) go to the workers through the pool initializer, the chunks as task arguments, so
+concurrent calls never share state.
+
+Small inputs and `num_data_workers == 1` run serially.
+"""
+import math
+import multiprocessing as mp
+import os
+from types import SimpleNamespace
+from typing import List, Optional
+
+from .data_cache import pack_instances, unpack_instances, pack_ids, assign_ids
+from .instance import Instance
+
+MIN_PARALLEL_SIZE = 2000
+CHUNKS_PER_WORKER = 4
+
+# state of a worker process, set by `_init_worker`
+_worker = {}
+
+
+def map_ids(config, insts: List[Instance]) -> None:
+    """
+    Set the word, char and label ids of `insts` in place, like `Config.map_insts_ids` without writing them to disk
+    """
+    word2idx, char2idx, label2idx = config.word2idx, config.char2idx, config.label2idx
+    word_unk, char_unk = word2idx[config.UNK], char2idx[config.UNK]
+    for inst in insts:
+        words = inst.input.words
+        inst.word_ids = [word2idx.get(word, word_unk) for word in words]
+        inst.char_ids = [[char2idx.get(c, char_unk) for c in word] for word in words]
+        inst.output_ids = [label2idx[label] for label in inst.output] if inst.output else None
+
+
+def _vocab(config):
+    """
+    The part of the config `map_ids` reads, sent to the workers instead of the config and its embedding table
+    """
+    return SimpleNamespace(UNK=config.UNK, word2idx=config.word2idx, char2idx=config.char2idx,
+                           label2idx=config.label2idx)
+
+
+def _num_workers(config, size: int) -> int:
+    if size < MIN_PARALLEL_SIZE:
+        return 1
+    cores = os.cpu_count() or 1
+    workers = min(getattr(config, "num_data_workers", None) or cores, cores)
+    return max(1, min(workers, size // (MIN_PARALLEL_SIZE // 2)))
+
+
+def _context():
+    return mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+
+
+def _init_worker(state):
+    _worker.update(state)
+
+
+def _run(function, items: list, workers: int, **state):
+    chunk = math.ceil(len(items) / (workers * CHUNKS_PER_WORKER))
+    chunks = [items[start:start + chunk] for start in range(0, len(items), chunk)]
+    with _context().Pool(workers, initializer=_init_worker, initargs=(state,)) as pool:
+        return pool.map(function, chunks)
+
+
+def _build_chunk(data):
+    insts = _worker["reader"].build_data(data, _worker["data_type"])
+    if _worker["vocab"] is not None:
+        map_ids(_worker["vocab"], insts)
+    return pack_instances(insts)
+
+
+def _map_chunk(insts):
+    map_ids(_worker["vocab"], insts)
+    return pack_ids(insts)
+
+
+def build_data(reader, config, data, data_type: str, with_ids: bool = False) -> List[Instance]:
+    """
+    Parallel equivalent of `reader.build_data(data, data_type)`
+    :param with_ids: also map the result to ids, the vocab has to be built or loaded already
+    """
+    workers = _num_workers(config, len(data))
+    if workers == 1:
+        insts = reader.build_data(data, data_type)
+        if with_ids:
+            map_ids(config, insts)
+        return insts
+    insts = []
+    for packed in _run(_build_chunk, list(data), workers, reader=reader, data_type=data_type,
+                       vocab=_vocab(config) if with_ids else None):
+        insts.extend(unpack_instances(*packed))
+    return insts
+
+
+def map_insts_ids(config, insts: Optional[List[Instance]]) -> None:
+    """
+    Parallel equivalent of `map_ids(config, insts)`, sets the ids in place
+    """
+    if not insts:
+        return
+    workers = _num_workers(config, len(insts))
+    if workers == 1:
+        map_ids(config, insts)
+        return
+    start = 0
+    for meta, arrays in _run(_map_chunk, insts, workers, vocab=_vocab(config)):
+        assign_ids(insts[start:start + len(meta["has_output_ids"])], meta, arrays)
+        start += len(meta["has_output_ids"])
@@ -0,0 +1,41 @@
+"""precision.py: Reduced precision forward and backward passes
+With `precision == "bf16"` the encoders, attention and projection layers run under bfloat16 autocast on the config's
+device, halving their activation memory and using the bf16 instructions of recent CPUs. Weights, gradients, the CRF and
+the losses stay in fp32.
+"""
+import torch
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16}
+
+
+def _device_type(config) -> str:
+    return torch.device(config.device).type
+
+
+def autocast(config):
+    """
+    Context manager running the enclosed ops in the precision chosen by `config.precision`
+    """
+    precision = getattr(config, "precision", "fp32")
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision %s, choose from %s" % (precision, ", ".join(PRECISIONS)))
+    dtype = PRECISIONS[precision]
+    return torch.autocast(_device_type(config), dtype=dtype or torch.bfloat16, enabled=dtype is not None)
+
+
+def full_precision(config):
+    """
+    Context manager disabling autocast again, for the CRF and the losses
+    """
+    return torch.autocast(_device_type(config), enabled=False)
+
+
+def autocast_input(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    Cast the input of a packed LSTM to the autocast dtype. Autocast casts the LSTM weights, but leaves a packed
+    sequence in the dtype it was built with, which would keep the LSTM in fp32.
+    """
+    device_type = tensor.device.type
+    if torch.is_autocast_enabled(device_type) and tensor.is_floating_point():
+        return tensor.to(torch.get_autocast_dtype(device_type))
+    return tensor
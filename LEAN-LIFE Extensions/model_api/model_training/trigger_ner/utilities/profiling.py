@@ -0,0 +1,112 @@
+"""profiling.py: On-demand torch.profiler traces of prediction, evaluation and training
+With the `profile` run option, or the MODEL_API_PROFILE environment variable set on the server, `profiled` runs its
+block under `torch.profiler` and writes a Chrome trace (open it in chrome://tracing or Perfetto) and a table of the
+operators, overall and per input shape, to `profile_dir` (MODEL_API_PROFILE_DIR, "profiles" by default).
+The pipelines profile prediction and evaluation, the soft trainers their epoch loop. Training runs can be long, so
+`profile_steps` limits the trace to that many training steps after a warm-up step, `TrainLoop` marks the steps.
+
+`label` and `labelled` name a block or a function in the trace, for example "SoftEncoder.forward" or
+"LinearCRF.decode", and are a no-op unless a profiler is running in the current context.
+"""
+import contextvars
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule
+
+from . import distributed
+
+ENV_SWITCH = "MODEL_API_PROFILE"
+ENV_DIR = "MODEL_API_PROFILE_DIR"
+# operators listed in the summary tables
+TABLE_ROWS = 40
+
+_active: contextvars.ContextVar = contextvars.ContextVar("profiler", default=None)
+
+
+def profiling_enabled(config) -> bool:
+    return bool(getattr(config, "profile", False)) or \
+        os.environ.get(ENV_SWITCH, "").lower() in ("1", "true", "yes", "on")
+
+
+def profile_dir(config) -> str:
+    return getattr(config, "profile_dir", None) or os.environ.get(ENV_DIR) or "profiles"
+
+
+def write_profile(profiler, config, name: str):
+    """
+    Write the Chrome trace and the operator tables of a finished profile
+    """
+    directory = profile_dir(config)
+    os.makedirs(directory, exist_ok=True)
+    stem = "%s_%s_%s" % (getattr(config, "experiment_name", "run"), name, time.strftime("%Y%m%d-%H%M%S"))
+    if distributed.world_size() > 1:
+        stem += "_rank%d" % distributed.rank()
+    trace_path = os.path.join(directory, stem + ".trace.json")
+    table_path = os.path.join(directory, stem + ".ops.txt")
+    profiler.export_chrome_trace(trace_path)
+    sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+    events = profiler.key_averages()
+    with open(table_path, "w") as f:
+        f.write("Operators of %s, by self time\n" % name)
+        f.write(events.table(sort_by=sort_by, row_limit=TABLE_ROWS))
+        f.write("\n\nOperators of %s by input shape, by self time\n" % name)
+        f.write(profiler.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=TABLE_ROWS))
+    logging.info("Wrote the profile of %s to %s and %s" % (name, trace_path, table_path))
+
+
+@contextmanager
+def profiled(config, name: str):
+    """
+    Profile the block when profiling is enabled for `config`, writing the results when it ends
+    """
+    if not profiling_enabled(config) or _active.get() is not None:
+        yield
+        return
+    steps = getattr(config, "profile_steps", 0) or 0
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    profiler = profile(activities=activities,
+                       schedule=schedule(wait=0, warmup=1, active=steps, repeat=1) if steps else None,
+                       on_trace_ready=lambda finished: write_profile(finished, config, name),
+                       record_shapes=True, profile_memory=True)
+    token = _active.set(profiler)
+    try:
+        with profiler:
+            yield
+    finally:
+        _active.reset(token)
+
+
+def step():
+    """
+    Mark the end of a training step for the `profile_steps` schedule
+    """
+    profiler = _active.get()
+    if profiler is not None:
+        profiler.step()
+
+
+def label(name: str):
+    """
+    Name the enclosed block in the trace of the running profiler
+    """
+    return record_function(name) if _active.get() is not None else nullcontext()
+
+
+def labelled(name: str):
+    """
+    Run the decorated function in `label(name)`
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with label(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,72 @@
+"""run_options.py: Runtime options of the trigger pipelines that are not part of Config
+`Config` only picks up the payload fields it knows about. Options added on top of it are declared here with their
+defaults and copied onto the config by `apply_run_options`, so trainers and helpers read them as config attributes.
+"""
+from typing import Dict
+
+RUN_OPTIONS = {
+    # processes used to build and map instances, None uses every core for inputs large enough to benefit
+    "num_data_workers": None,
+    # background processes collating the batches of training epochs in `BatchLoader`, kept across epochs, 0 collates
+    # in the training process. Evaluation and prediction always collate in the calling process
+    "loader_workers": 1,
+    # batches every loader worker builds ahead
+    "prefetch_batches": 2,
+    # batches whose gradients are summed before every optimizer step
+    "grad_accum_steps": 1,
+    # also checkpoint every N epochs, 0 only checkpoints when the dev metric improves
+    "checkpoint_every": 0,
+    # epoch checkpoints kept next to the model file
+    "checkpoint_keep": 1,
+    # stop after this many epochs without dev improvement, 0 runs every epoch
+    "early_stop_patience": 0,
+    # smallest dev metric increase that counts as an improvement
+    "early_stop_min_delta": 0.0,
+    # multiply the learning rate by lr_plateau_factor after this many epochs without dev improvement, 0 disables it
+    "lr_plateau_patience": 0,
+    "lr_plateau_factor": 0.5,
+    # evaluation during training, see eval_schedule.py
+    "matcher_eval_every": 1,
+    "matcher_eval_samples": 0,
+    "sequence_eval_every": 1,
+    "sequence_eval_samples": 0,
+    "eval_in_background": False,
+    # also log the token-level confusion matrix of every evaluation, see span_metrics.py
+    "eval_confusion_matrix": False,
+    # local processes training the soft matcher and sequence model data-parallel, see distributed.py
+    "train_processes": 1,
+    # sentences decoded per batch when self-training weakly labels the unlabeled data, 0 uses 4 * batch_size
+    "weak_label_batch_size": 0,
+    # approximate nearest-trigger search with an IVF index over the trigger bank, see trigger_index.py
+    "trigger_index": False,
+    # clusters of the index, 0 uses 4 * sqrt(number of triggers)
+    "trigger_index_nlist": 0,
+    # clusters searched per sentence
+    "trigger_index_nprobe": 8,
+    # decode only BIO/IOBES-valid label sequences, see viterbi.py
+    "crf_transition_mask": False,
+    # "greedy" decodes the best label of every token without the CRF transitions and repairs the spans, see viterbi.py
+    "decode_mode": "viterbi",
+    # "bf16" runs the encoders under bfloat16 autocast, see precision.py
+    "precision": "fp32",
+    # torch.profiler trace and operator tables of the run, see profiling.py
+    "profile": False,
+    # where they are written, None uses MODEL_API_PROFILE_DIR or "profiles"
+    "profile_dir": None,
+    # training steps traced after a warm-up step, 0 traces the whole training
+    "profile_steps": 0,
+    # soft memory budget in MB, a warning is logged when a pipeline stage or epoch peaks above it, 0 disables it
+    "memory_budget_mb": 0,
+    # also record the peaks of the Python heap with tracemalloc, see memory.py
+    "memory_tracemalloc": False,
+}
+
+
+def apply_run_options(config, payload: Dict):
+    """
+    Copy every option in `RUN_OPTIONS` from the payload onto the config, using the default when absent or None
+    """
+    for name, default in RUN_OPTIONS.items():
+        value = payload.get(name)
+        setattr(config, name, default if value is None else value)
+    return config
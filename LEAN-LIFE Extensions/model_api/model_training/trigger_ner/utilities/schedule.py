@@ -0,0 +1,61 @@
+"""schedule.py: Dev-driven early stopping and learning-rate scheduling
+Both follow a metric where higher is better (dev F1, matching accuracy) and are disabled with a patience of 0.
+"""
+import logging
+from typing import Optional
+
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+from .utils import get_optimizer
+
+
+class EarlyStopping(object):
+    def __init__(self, patience: int, min_delta: float = 0.0):
+        """
+        :param patience: epochs without an improvement of more than `min_delta` before stopping, 0 never stops
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best: Optional[float] = None
+        self.bad_epochs = 0
+
+    def step(self, metric: Optional[float]) -> bool:
+        """
+        Record the metric of an epoch
+        :return: whether training should stop
+        """
+        if self.patience <= 0 or metric is None:
+            return False
+        if self.best is None or metric > self.best + self.min_delta:
+            self.best = metric
+            self.bad_epochs = 0
+            return False
+        self.bad_epochs += 1
+        if self.bad_epochs >= self.patience:
+            logging.info("No improvement over %.4f for %d epochs, stopping early" % (self.best, self.bad_epochs))
+            return True
+        return False
+
+
+def early_stopping(config) -> EarlyStopping:
+    return EarlyStopping(getattr(config, "early_stop_patience", 0) or 0, getattr(config, "early_stop_min_delta", 0.0))
+
+
+def get_scheduler(config, optimizer) -> Optional[ReduceLROnPlateau]:
+    """
+    Reduce-on-plateau scheduler for an optimizer from `get_optimizer`, None when `lr_plateau_patience` is 0
+    """
+    patience = getattr(config, "lr_plateau_patience", 0) or 0
+    if patience <= 0:
+        return None
+    # torch reduces once more than `patience` epochs were bad, lr_plateau_patience counts the bad epochs themselves
+    return ReduceLROnPlateau(optimizer, mode="max", factor=getattr(config, "lr_plateau_factor", 0.5),
+                             patience=patience - 1)
+
+
+def get_optimizer_and_scheduler(config, model, optimizer_name: str):
+    """
+    `get_optimizer` followed by `get_scheduler` for the same optimizer
+    """
+    optimizer = get_optimizer(config, model, optimizer_name)
+    return optimizer, get_scheduler(config, optimizer)
@@ -0,0 +1,146 @@
+"""span_metrics.py: Span-level precision, recall and F1 over a whole evaluation set
+`evaluate_batch_insts` converted the label ids of every sentence back to strings and collected its spans in Python.
+`SpanMetrics` collects the padded gold and predicted label ids of all batches instead and extracts the spans of the
+whole set at once: span boundaries are found by comparing every token with its neighbours, and every span becomes one
+integer key (sentence, start, end, type), so matching the gold and predicted spans is a set intersection of arrays.
+
+Both BIO and IOBES labels are supported, the scheme follows from the label vocabulary. IOBES spans are read like
+`evaluate_batch_insts` did: from the last B- up to an E-, or a single S- token.
+"""
+from typing import Dict, List
+
+import numpy as np
+
+OUTSIDE, BEGIN, INSIDE, END, SINGLE = 0, 1, 2, 3, 4
+PREFIXES = {"B-": BEGIN, "I-": INSIDE, "E-": END, "S-": SINGLE}
+
+
+def _to_numpy(values) -> np.ndarray:
+    if hasattr(values, "detach"):
+        values = values.detach().cpu().numpy()
+    return np.asarray(values)
+
+
+def _scores(correct, predicted, gold):
+    """
+    Precision, recall and F1 in percent, elementwise for arrays of counts
+    """
+    correct, predicted, gold = (np.asarray(x, dtype=float) for x in (correct, predicted, gold))
+    precision = np.divide(correct * 100, predicted, out=np.zeros_like(correct), where=predicted != 0)
+    recall = np.divide(correct * 100, gold, out=np.zeros_like(correct), where=gold != 0)
+    total = precision + recall
+    fscore = np.divide(2 * precision * recall, total, out=np.zeros_like(correct), where=total != 0)
+    return precision, recall, fscore
+
+
+class SpanMetrics(object):
+    def __init__(self, idx2labels: List[str], confusion: bool = False):
+        """
+        :param idx2labels: label of every label id, ids of labels without a prefix (O, padding) count as outside
+        :param confusion: also count the token-level confusion matrix of gold and predicted labels
+        """
+        self.labels = list(idx2labels)
+        self.type_names = sorted({label[2:] for label in self.labels if label[:2] in PREFIXES})
+        type_ids = {name: i for i, name in enumerate(self.type_names)}
+        self.prefix = np.array([PREFIXES.get(label[:2], OUTSIDE) for label in self.labels], dtype=np.int8)
+        self.types = np.array([type_ids.get(label[2:], -1) if label[:2] in PREFIXES else -1
+                               for label in self.labels], dtype=np.int64)
+        self.iobes = bool(np.isin(self.prefix, [END, SINGLE]).any())
+        self.confusion = confusion
+        self.batches = []
+
+    def add(self, gold_ids, pred_ids, word_seq_lens):
+        """
+        Add a batch of padded (batch size, max length) gold and predicted label ids
+        """
+        lens = _to_numpy(word_seq_lens).astype(np.int64)
+        self.batches.append((_to_numpy(gold_ids).astype(np.int64), _to_numpy(pred_ids).astype(np.int64), lens))
+
+    def _stack(self):
+        """
+        Ids of all batches padded to one (sentences, max length) array each, and the sentence lengths
+        """
+        max_len = max([gold.shape[1] for gold, _, _ in self.batches] + [1])
+        count = sum(len(lens) for _, _, lens in self.batches)
+        gold_ids = np.zeros((count, max_len), dtype=np.int64)
+        pred_ids = np.zeros((count, max_len), dtype=np.int64)
+        lens = np.zeros(count, dtype=np.int64)
+        row = 0
+        for gold, pred, batch_lens in self.batches:
+            rows = slice(row, row + len(batch_lens))
+            gold_ids[rows, :gold.shape[1]] = gold
+            pred_ids[rows, :pred.shape[1]] = pred
+            lens[rows] = batch_lens
+            row += len(batch_lens)
+        positions = np.arange(max_len)
+        return gold_ids, pred_ids, positions[None, :] < lens[:, None]
+
+    def span_keys(self, ids: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """
+        Sorted unique keys of the spans in the label ids, a key encodes sentence, start, end and type
+        """
+        prefix = np.where(mask, self.prefix[ids], OUTSIDE)
+        types = np.where(mask, self.types[ids], -1)
+        max_len = ids.shape[1]
+        if self.iobes:
+            # start of a span at an E- is the last B- before it, -1 when there was none
+            begins = np.where(prefix == BEGIN, np.arange(max_len)[None, :], -1)
+            last_begin = np.maximum.accumulate(begins, axis=1)
+            end_rows, ends = np.nonzero(prefix == END)
+            single_rows, singles = np.nonzero(prefix == SINGLE)
+            rows = np.concatenate([end_rows, single_rows])
+            starts = np.concatenate([last_begin[end_rows, ends], singles])
+            ends = np.concatenate([ends, singles])
+        else:
+            inside = (prefix == BEGIN) | (prefix == INSIDE)
+            same_type = types[:, 1:] == types[:, :-1]
+            continues = np.zeros_like(inside)
+            continues[:, 1:] = (prefix[:, 1:] == INSIDE) & inside[:, :-1] & same_type
+            # an I- that does not continue a span of its type starts one, like a B-
+            start_rows, starts = np.nonzero(inside & ~continues)
+            _, ends = np.nonzero(inside & ~np.roll(continues, -1, axis=1))
+            rows = start_rows
+        span_types = types[rows, ends]
+        keys = ((rows * (max_len + 1) + starts + 1) * max_len + ends) * max(len(self.type_names), 1) + span_types
+        return np.unique(keys)
+
+    def compute(self) -> Dict:
+        """
+        Micro-averaged and per-type precision, recall and F1 in percent, with the span counts, and the confusion
+        matrix (rows gold, columns predicted label ids) when enabled
+        """
+        gold_ids, pred_ids, mask = self._stack()
+        gold_keys = self.span_keys(gold_ids, mask)
+        pred_keys = self.span_keys(pred_ids, mask)
+        correct_keys = np.intersect1d(gold_keys, pred_keys, assume_unique=True)
+
+        num_types = max(len(self.type_names), 1)
+        counts = [np.bincount(keys % num_types, minlength=num_types) for keys in (correct_keys, pred_keys, gold_keys)]
+        precision, recall, fscore = _scores(len(correct_keys), len(pred_keys), len(gold_keys))
+        type_precision, type_recall, type_fscore = _scores(*counts)
+        results = {
+            "precision": float(precision), "recall": float(recall), "f1": float(fscore),
+            "correct": len(correct_keys), "predicted": len(pred_keys), "gold": len(gold_keys),
+            "per_type": {name: {"precision": float(type_precision[i]), "recall": float(type_recall[i]),
+                                "f1": float(type_fscore[i]), "support": int(counts[2][i])}
+                         for i, name in enumerate(self.type_names)},
+            "confusion": None,
+        }
+        if self.confusion:
+            num_labels = len(self.labels)
+            pairs = gold_ids[mask] * num_labels + pred_ids[mask]
+            results["confusion"] = np.bincount(pairs, minlength=num_labels * num_labels).reshape(
+                num_labels, num_labels)
+        return results
+
+
+def format_confusion(confusion: np.ndarray, labels: List[str]) -> str:
+    """
+    Confusion matrix as a text table, leaving out labels that never occur
+    """
+    used = np.nonzero(confusion.sum(0) + confusion.sum(1))[0]
+    width = max([len(labels[i]) for i in used] + [len(str(confusion.max()))]) + 1
+    lines = ["".rjust(width) + "".join(labels[i].rjust(width) for i in used)]
+    for i in used:
+        lines.append(labels[i].rjust(width) + "".join(str(confusion[i, j]).rjust(width) for j in used))
+    return "\n".join(lines)
@@ -0,0 +1,123 @@
+"""timing.py: Per-stage wall time of the pipelines
+A `StageTimer` sums the time spent in named stages. Code anywhere down the call stack marks a stage with
+`with span("decode.crf"):` or adds a duration it measured itself with `record`; both go to the timer active in the
+current context and cost next to nothing when none is.
+
+Every pipeline runs in `pipeline_timer`, usually through `timed_pipeline`, which activates a timer unless the caller
+already did and logs the stages as one structured (json) log line when it finishes. The API activates the timer itself
+when a request asks for its timings, so it can return them with the response. `timed_pipeline` also tracks the memory
+of the run: the top-level stages of the pipelines are marked with `stage`, which records their memory peaks as well
+(see memory.py).
+Stages are only recorded in the thread that activated the timer: evaluation in the background and loader or data
+workers are not covered, their waiting time is.
+"""
+import contextvars
+import functools
+import json
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from .memory import memory_stage, memory_tracker
+
+_active: contextvars.ContextVar = contextvars.ContextVar("stage_timer", default=None)
+
+
+class StageTimer(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.stages: Dict[str, list] = {}
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        totals = self.stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += count
+
+    def summary(self) -> Dict:
+        """
+        Total seconds and number of occurrences of every stage, in the order they were first entered
+        """
+        return {"pipeline": self.name, "total_seconds": time.perf_counter() - self.start,
+                "stages": {stage: {"seconds": seconds, "count": count}
+                           for stage, (seconds, count) in self.stages.items()}}
+
+    def log(self):
+        logging.info(json.dumps({"event": "stage_timings", **self.summary()}))
+
+    @contextmanager
+    def activate(self):
+        token = _active.set(self)
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+
+
+def active_timer() -> Optional[StageTimer]:
+    return _active.get()
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Add the time spent in the block to `stage` of the active timer
+    """
+    timer = _active.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    A pipeline stage, timed like `span` and with its memory peaks recorded by the active memory tracker
+    """
+    with span(name), memory_stage(name):
+        yield
+
+
+def record(stage: str, seconds: float, count: int = 1):
+    """
+    Add a duration measured elsewhere to `stage` of the active timer
+    """
+    timer = _active.get()
+    if timer is not None:
+        timer.add(stage, seconds, count)
+
+
+@contextmanager
+def pipeline_timer(name: str):
+    """
+    Timer of a pipeline run, the caller's when it activated one, otherwise a new one that is logged at the end
+    """
+    timer = _active.get()
+    if timer is not None:
+        yield timer
+        return
+    timer = StageTimer(name)
+    with timer.activate():
+        try:
+            yield timer
+        finally:
+            timer.log()
+
+
+def timed_pipeline(name: str):
+    """
+    Run the decorated function in `pipeline_timer(name)` and `memory_tracker(name)`
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with pipeline_timer(name), memory_tracker(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,82 @@
+"""train_loop.py: Epoch loop shared by SoftMatcherTrainer and SoftSequenceTrainer
+Runs one pass over the batches of a shuffling `BatchLoader` (or a pre-batched list, visited in random order), with
+optional gradient accumulation, per-step timing and the memory peak of every epoch. In a distributed run, gradients
+are averaged across processes before every optimizer step.
+The graph of every step is freed by its backward pass, losses are summed as python floats, and the model is put in
+train mode once per epoch instead of once per step.
+"""
+import logging
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from . import distributed
+from .timing import record
+from .profiling import step as profiler_step
+from .memory import memory_stage
+
+
+class TrainLoop(object):
+    def __init__(self, model: torch.nn.Module, optimizer, step_loss: Callable[[tuple], torch.Tensor], config):
+        """
+        :param step_loss: computes the training loss of one batch from `batching_list_instances`
+        :param config: reads `grad_accum_steps`, the number of batches whose gradients are summed per optimizer step
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.step_loss = step_loss
+        self.accumulation = max(1, getattr(config, "grad_accum_steps", 1) or 1)
+        self.step_times: List[float] = []
+        self.wait_times: List[float] = []
+        self.epochs_run = 0
+
+    def run_epoch(self, batched_data) -> float:
+        """
+        Train on every batch once
+        :return: summed loss of the epoch
+        """
+        self.epochs_run += 1
+        with memory_stage("epoch", self.epochs_run):
+            self.model.train()
+            self.model.zero_grad()
+            self.step_times = []
+            self.wait_times = []
+            epoch_loss = 0.0
+            num_steps = len(batched_data)
+            if isinstance(batched_data, list):
+                batched_data = [batched_data[index] for index in np.random.permutation(num_steps)]
+            waited = time.perf_counter()
+            for step, batch in enumerate(tqdm(batched_data, total=num_steps)):
+                start = time.perf_counter()
+                self.wait_times.append(start - waited)
+                loss = self.step_loss(batch)
+                # the last group of an epoch can be smaller than `accumulation`, it is averaged over its own size
+                group_size = min(self.accumulation, num_steps - step // self.accumulation * self.accumulation)
+                (loss / group_size if group_size > 1 else loss).backward()
+                if (step + 1) % self.accumulation == 0 or step + 1 == num_steps:
+                    distributed.average_gradients(self.model)
+                    self.optimizer.step()
+                    self.model.zero_grad()
+                epoch_loss += loss.item()
+                profiler_step()
+                waited = time.perf_counter()
+                self.step_times.append(waited - start)
+            epoch_loss = distributed.reduce_sum(epoch_loss)
+            logging.info(epoch_loss)
+            logging.info("step time %s" % self.timing())
+        record("train.step", float(np.sum(self.step_times)), len(self.step_times))
+        return epoch_loss
+
+    def timing(self) -> Dict[str, float]:
+        """
+        Summary of the step times of the last epoch, in seconds. `data_wait` is the time spent waiting for batches.
+        """
+        if not self.step_times:
+            return {}
+        times = np.asarray(self.step_times)
+        return {"steps": len(times), "total": float(times.sum()), "mean": float(times.mean()),
+                "p50": float(np.percentile(times, 50)), "p95": float(np.percentile(times, 95)),
+                "max": float(times.max()), "data_wait": float(np.sum(self.wait_times))}
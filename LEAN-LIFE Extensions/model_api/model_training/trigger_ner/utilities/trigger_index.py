@@ -0,0 +1,108 @@
+"""trigger_index.py: Approximate nearest-trigger search for large trigger banks
+`SoftSequence.decode` pairs every sentence with the trigger whose vector is closest to the sentence representation.
+Searching the whole bank costs O(bank size) per sentence. `TriggerIndex` clusters the trigger vectors with k-means
+into `nlist` inverted lists (IVF) and only searches the `nprobe` lists whose centroids are closest to a sentence, so a
+search costs O(nlist + nprobe * list size), which stays about flat as the bank grows.
+
+The index is optional: it is built by `build_trigger_index` when `trigger_index` is enabled, and its recall@1
+against exact search can be measured with `TriggerIndex.recall_at_1`.
+"""
+import logging
+import math
+from typing import Optional, Tuple
+
+import torch
+
+
+def exact_search(queries: torch.Tensor, vectors: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Distance to and index of the closest vector of every query
+    """
+    return torch.cdist(queries.float(), vectors.float()).min(dim=1)
+
+
+def kmeans(vectors: torch.Tensor, k: int, iterations: int = 20, seed: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Lloyd's k-means started from k distinct vectors
+    :return: centroids and the cluster of every vector
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = vectors[torch.randperm(len(vectors), generator=generator)[:k].to(vectors.device)].clone()
+    for _ in range(iterations):
+        assignment = torch.cdist(vectors, centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+        counts = torch.bincount(assignment, minlength=k)
+        # empty clusters keep their centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled].unsqueeze(1).to(sums.dtype)
+    return centroids, torch.cdist(vectors, centroids).argmin(dim=1)
+
+
+class TriggerIndex(object):
+    def __init__(self, vectors: torch.Tensor, nlist: int = 0, nprobe: int = 8, iterations: int = 20, seed: int = 0):
+        """
+        :param vectors: trigger vectors, (number of triggers, dim)
+        :param nlist: number of clusters, 0 uses 4 * sqrt(number of triggers)
+        :param nprobe: clusters searched per query, more raise recall and cost
+        """
+        vectors = vectors.detach().float()
+        self.size = len(vectors)
+        self.nlist = max(1, min(nlist or int(round(4 * math.sqrt(self.size))), self.size))
+        self.nprobe = max(1, min(nprobe, self.nlist))
+        self.centroids, assignment = kmeans(vectors, self.nlist, iterations, seed)
+
+        # inverted lists: the vectors sorted by cluster, cluster c holds rows starts[c]:starts[c] + counts[c]
+        self.order = torch.argsort(assignment, stable=True)
+        self.vectors = vectors[self.order].contiguous()
+        self.norms = self.vectors.pow(2).sum(1)
+        self.counts = torch.bincount(assignment, minlength=self.nlist)
+        self.starts = torch.cumsum(self.counts, 0) - self.counts
+
+    def search(self, queries: torch.Tensor, nprobe: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Approximate distance to and index of the closest trigger of every query.
+        The lists probed by any query of the batch are gathered once and scored with a single matrix product,
+        distances to lists a query didn't probe are masked.
+        """
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        queries = queries.detach().float()
+        probed = torch.cdist(queries, self.centroids).topk(nprobe, dim=1, largest=False).indices
+        probe_mask = torch.zeros(len(queries), self.nlist, dtype=torch.bool, device=queries.device)
+        probe_mask.scatter_(1, probed, True)
+
+        clusters = probe_mask.any(dim=0).nonzero().squeeze(1)
+        lengths = self.counts[clusters]
+        list_offsets = torch.cumsum(lengths, 0) - lengths
+        rows = torch.repeat_interleave(self.starts[clusters] - list_offsets, lengths) + \
+            torch.arange(int(lengths.sum()), device=queries.device)
+        candidates = self.vectors[rows]
+
+        # |q - v|^2 = |q|^2 - 2 q.v + |v|^2
+        distances = queries.pow(2).sum(1, keepdim=True) - 2 * queries @ candidates.t() + self.norms[rows]
+        distances = distances.masked_fill(~probe_mask[:, torch.repeat_interleave(clusters, lengths)], float("inf"))
+        best, position = distances.min(dim=1)
+        return best.clamp(min=0).sqrt(), self.order[rows[position]]
+
+    def recall_at_1(self, queries: torch.Tensor, nprobe: Optional[int] = None) -> float:
+        """
+        Share of the queries for which the index finds the same closest trigger as exact search
+        """
+        if len(queries) == 0:
+            return 1.0
+        _, exact = exact_search(queries, self.vectors)
+        _, approximate = self.search(queries, nprobe)
+        return (self.order[exact] == approximate).float().mean().item()
+
+
+def build_trigger_index(config, triggers) -> Optional[TriggerIndex]:
+    """
+    Index over the trigger vectors of `triggers`, as produced by `remove_duplicates`, or None when `trigger_index`
+    is disabled
+    """
+    if not getattr(config, "trigger_index", False):
+        return None
+    index = TriggerIndex(triggers[0], getattr(config, "trigger_index_nlist", 0),
+                         getattr(config, "trigger_index_nprobe", 8), seed=getattr(config, "seed", 0) or 0)
+    logging.info("Built trigger index over %d triggers with %d lists, probing %d" % (index.size, index.nlist,
+                                                                                     index.nprobe))
+    return index
@@ -0,0 +1,162 @@
+"""trigger_store.py: Versioned on-disk format of the trigger bank
+Replaces the `soft_triggers` pickle of the trigger pipeline. The bank returned by `remove_duplicates` holds the
+trigger vectors as one (m, d) matrix followed by per-trigger fields such as the trigger keys. Every field is written
+as a numpy array next to a small json file, so loading maps the vectors into memory instead of unpickling m tensors,
+and the processes serving the same experiment share their pages.
+
+Layout next to the path of the old pickle `<stem>.p`:
+    <stem>.triggers.json            pointer to the latest entry of the experiment
+    <stem>.triggers-<id>/meta.json  format version, size, dim and how to rebuild every field
+    <stem>.triggers-<id>/*.npy      the vectors and array-like fields
+Entries are written completely before the pointer is atomically replaced, so readers never see a partial bank.
+The entry a save replaces is kept, for readers that read the old pointer just before the swap, and pruned by the save
+after it. A reader that still finds its entry gone reads the pointer again.
+"""
+import json
+import logging
+import os
+import pickle
+import shutil
+import uuid
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+
+TRIGGER_STORE_VERSION = 1
+# times `load_triggers` follows the pointer when the entry it named was pruned while loading it
+LOAD_ATTEMPTS = 3
+
+
+def _pack_field(values) -> Tuple[Dict, np.ndarray]:
+    if torch.is_tensor(values):
+        return {"kind": "tensor"}, values.detach().cpu().numpy()
+    values = list(values)
+    if values and all(torch.is_tensor(value) for value in values):
+        return {"kind": "tensor"}, torch.stack([value.detach().cpu() for value in values]).numpy()
+    if all(isinstance(value, str) for value in values):
+        return {"kind": "list"}, np.asarray(values, dtype=str)
+    if all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in values):
+        return {"kind": "list"}, np.asarray(values, dtype=np.int64)
+    return {"kind": "json", "values": [value.item() if hasattr(value, "item") else value for value in values]}, None
+
+
+def _unpack_field(meta: Dict, array, device):
+    if meta["kind"] == "tensor":
+        return torch.from_numpy(array).to(device)
+    if meta["kind"] == "list":
+        return array.tolist()
+    return meta["values"]
+
+
+def pack_triggers(triggers) -> Tuple[Dict, Dict[str, np.ndarray]]:
+    """
+    Compact form of a trigger bank: a json-sized meta dict and numpy arrays
+    """
+    vectors = triggers[0].detach().float().cpu().contiguous()
+    meta = {"version": TRIGGER_STORE_VERSION, "size": vectors.size(0), "dim": vectors.size(1),
+            "container": type(triggers).__name__ if isinstance(triggers, (list, tuple)) else "tuple", "fields": []}
+    arrays = {"vectors": vectors.numpy()}
+    for i, values in enumerate(triggers[1:], 1):
+        field, array = _pack_field(values)
+        if array is not None:
+            field["array"] = "field%d" % i
+            arrays[field["array"]] = array
+        meta["fields"].append(field)
+    return meta, arrays
+
+
+def unpack_triggers(meta: Dict, arrays: Dict[str, np.ndarray], device="cpu"):
+    """
+    Inverse of `pack_triggers`
+    """
+    if meta.get("version") != TRIGGER_STORE_VERSION:
+        raise ValueError("Unsupported trigger store version %s" % meta.get("version"))
+    fields = [torch.from_numpy(arrays["vectors"]).to(device)]
+    fields += [_unpack_field(field, arrays.get(field.get("array")), device) for field in meta["fields"]]
+    return fields if meta["container"] == "list" else tuple(fields)
+
+
+def _location(config) -> Tuple[str, str]:
+    legacy_path = config.generate_training_data_path("soft_triggers")
+    return legacy_path, os.path.splitext(legacy_path)[0] + ".triggers"
+
+
+def save_triggers(config, triggers) -> str:
+    """
+    Write the trigger bank of the experiment
+    :return: directory of the written entry
+    """
+    _, stem = _location(config)
+    meta, arrays = pack_triggers(triggers)
+    entry = "%s-%s" % (stem, uuid.uuid4().hex)
+    tmp = entry + ".tmp"
+    os.makedirs(tmp)
+    for array_name, array in arrays.items():
+        np.save(os.path.join(tmp, array_name + ".npy"), array, allow_pickle=False)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.rename(tmp, entry)
+
+    pointer = stem + ".json"
+    replaced = _read_pointer(pointer)
+    pointer_tmp = "%s.tmp-%s" % (pointer, uuid.uuid4().hex)
+    with open(pointer_tmp, "w", encoding="utf-8") as f:
+        json.dump({"entry": os.path.basename(entry)}, f)
+    os.replace(pointer_tmp, pointer)
+    if replaced:
+        _prune(stem, os.path.basename(entry), replaced)
+    return entry
+
+
+def _prune(stem: str, current: str, replaced: str):
+    """
+    Remove the entries older than the one just replaced, which is kept for the readers that are still loading it
+    """
+    directory = os.path.dirname(stem)
+    replaced_path = os.path.join(directory, replaced)
+    if not os.path.isdir(replaced_path):
+        return
+    cutoff = os.path.getmtime(replaced_path)
+    prefix = os.path.basename(stem) + "-"
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        # newer entries may belong to a concurrent save that has not swapped the pointer yet
+        if name.startswith(prefix) and not name.endswith(".tmp") and name not in (current, replaced) \
+                and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _read_pointer(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["entry"]
+
+
+def load_triggers(config):
+    """
+    Trigger bank of the latest training run of this experiment, with the vectors memory-mapped copy-on-write
+    """
+    legacy_path, stem = _location(config)
+    for attempt in range(LOAD_ATTEMPTS):
+        name = _read_pointer(stem + ".json")
+        if name is None:
+            # experiments trained before the store existed only have the pickled triggers
+            logging.warning("No stored triggers for %s, falling back to the pickled triggers" % stem)
+            with open(legacy_path, "rb") as f:
+                return pickle.load(f)
+        try:
+            return _load_entry(os.path.join(os.path.dirname(stem), name), config.device)
+        except FileNotFoundError:
+            # pruned by saves that finished while this one loaded, unless the pointer still names it
+            if attempt == LOAD_ATTEMPTS - 1 or _read_pointer(stem + ".json") == name:
+                raise
+
+
+def _load_entry(entry: str, device):
+    with open(os.path.join(entry, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    arrays = {array_name: np.load(os.path.join(entry, array_name + ".npy"), mmap_mode="c")
+              for array_name in ["vectors"] + [field["array"] for field in meta["fields"] if "array" in field]}
+    return unpack_triggers(meta, arrays, device)
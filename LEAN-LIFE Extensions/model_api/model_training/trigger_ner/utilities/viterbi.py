@@ -0,0 +1,127 @@
+"""viterbi.py: Batched decoding of emission scores, Viterbi over the transitions of a `LinearCRF` or greedy
+`LinearCRF.decode` expands the emission and transition scores to a (batch, length, labels, labels) tensor and returns
+every sentence in reverse order, which callers then flip in Python. `viterbi_decode` runs the recursion over the
+whole batch with one (batch, labels, labels) step per position, sentences shorter than the batch keep their scores
+past their length, and the backtracking gathers the labels of all sentences at once, in sentence order.
+
+`transition_mask` compiles the transitions a BIO or IOBES labeling allows (no O -> I-LOC, no B-LOC -> I-PER), so the
+decoder can never produce an invalid sequence.
+
+`greedy_decode` skips the transitions altogether and takes the best label of every token, then repairs the spans
+that result: a span is cut wherever a token does not continue the span before it, and the prefixes are rewritten
+from where the span begins and ends (I-LOC after O becomes B-LOC, B-LOC after an I-LOC span is closed by E-LOC in
+IOBES). The special labels of the CRF (<PAD>, <START>, <STOP>) get no emission training, as every transition into
+them is impossible, so they are never taken. It is much cheaper than Viterbi and somewhat less accurate,
+`benchmarks/greedy_decode_report.py` measures by how much on the IDRISI test sets.
+"""
+from typing import List, Optional, Tuple
+
+import torch
+
+from .span_metrics import PREFIXES, OUTSIDE, BEGIN, INSIDE, END, SINGLE
+
+# score of a forbidden transition, the same as the CRF uses for transitions into its start label
+IMPOSSIBLE = -10000.0
+
+
+def transition_mask(idx2labels: List[str]) -> torch.Tensor:
+    """
+    (labels, labels) mask of the transitions that may occur, mask[i, j] allows label i followed by label j
+    """
+    iobes = any(label[:2] in ("E-", "S-") for label in idx2labels)
+    allowed = torch.ones(len(idx2labels), len(idx2labels), dtype=torch.bool)
+    for i, previous in enumerate(idx2labels):
+        for j, label in enumerate(idx2labels):
+            inside = label[:2] in ("I-", "E-") if iobes else label[:2] == "I-"
+            continues = previous[:2] in ("B-", "I-") and previous[2:] == label[2:]
+            if inside and not continues:
+                allowed[i, j] = False
+            # an IOBES span that started has to go on until its E-
+            if iobes and previous[:2] in ("B-", "I-") and not (inside and continues):
+                allowed[i, j] = False
+    return allowed
+
+
+def viterbi_decode(emissions: torch.Tensor, transition: torch.Tensor, word_seq_lens: torch.Tensor, start_idx: int,
+                   end_idx: int, allowed: Optional[torch.Tensor] = None,
+                   pad_idx: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    :param emissions: (batch, max length, labels) emission scores
+    :param transition: (labels, labels) transition scores, transition[i, j] scores label i followed by label j
+    :param allowed: optional mask of `transition_mask`, forbidden transitions are never decoded
+    :return: best path score and label ids of every sentence, in sentence order and padded with `pad_idx`
+    """
+    batch_size, max_len, num_labels = emissions.size()
+    lens = word_seq_lens.to(emissions.device)
+    transition = transition.to(emissions.dtype)
+    if allowed is not None:
+        transition = transition.masked_fill(~allowed.to(transition.device), IMPOSSIBLE)
+
+    scores = transition[start_idx].unsqueeze(0) + emissions[:, 0]
+    # past the end of a sentence its scores are carried over and every label points back to itself
+    identity = torch.arange(num_labels, device=emissions.device).expand(batch_size, num_labels)
+    backpointers = []
+    for position in range(1, max_len):
+        best, pointers = (scores.unsqueeze(2) + transition.unsqueeze(0)).max(dim=1)
+        active = (position < lens).unsqueeze(1)
+        scores = torch.where(active, best + emissions[:, position], scores)
+        backpointers.append(torch.where(active, pointers, identity))
+    best_scores, last = (scores + transition[:, end_idx].unsqueeze(0)).max(dim=1)
+
+    decode_idx = torch.empty(batch_size, max_len, dtype=torch.long, device=emissions.device)
+    decode_idx[:, max_len - 1] = last
+    for position in range(max_len - 2, -1, -1):
+        decode_idx[:, position] = backpointers[position].gather(1, decode_idx[:, position + 1:position + 2]).squeeze(1)
+    padding = torch.arange(max_len, device=emissions.device).unsqueeze(0) >= lens.unsqueeze(1)
+    return best_scores, decode_idx.masked_fill(padding, pad_idx)
+
+
+def label_tables(idx2labels: List[str], device="cpu") -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Prefix and type of every label id, the label id of every (type, prefix), -1 where the vocabulary lacks it, and
+    which label ids can be decoded, the outside label and the labels with a prefix
+    """
+    type_names = sorted({label[2:] for label in idx2labels if label[:2] in PREFIXES})
+    type_ids = {name: i for i, name in enumerate(type_names)}
+    prefix = torch.tensor([PREFIXES.get(label[:2], OUTSIDE) for label in idx2labels], dtype=torch.long)
+    types = torch.tensor([type_ids[label[2:]] if label[:2] in PREFIXES else 0 for label in idx2labels],
+                         dtype=torch.long)
+    ids = torch.full((max(len(type_names), 1), SINGLE + 1), -1, dtype=torch.long)
+    for i, label in enumerate(idx2labels):
+        if label[:2] in PREFIXES:
+            ids[type_ids[label[2:]], PREFIXES[label[:2]]] = i
+    decodable = torch.tensor([label[:2] in PREFIXES or label == "O" for label in idx2labels], dtype=torch.bool)
+    return prefix.to(device), types.to(device), ids.to(device), decodable.to(device)
+
+
+def greedy_decode(emissions: torch.Tensor, word_seq_lens: torch.Tensor, tables: Tuple[torch.Tensor, ...],
+                  pad_idx: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    :param emissions: (batch, max length, labels) emission scores
+    :param tables: `label_tables` of the label vocabulary
+    :return: summed emission score and repaired label ids of every sentence, padded with `pad_idx`
+    """
+    prefix_of, type_of, label_of, decodable = tables
+    batch_size, max_len, _ = emissions.size()
+    best, labels = emissions.masked_fill(~decodable, float("-inf")).max(dim=2)
+    lens = word_seq_lens.to(emissions.device)
+    valid = torch.arange(max_len, device=emissions.device).unsqueeze(0) < lens.unsqueeze(1)
+
+    prefix = prefix_of[labels].masked_fill(~valid, OUTSIDE)
+    types = type_of[labels]
+    inside = prefix != OUTSIDE
+    # a token continues the span before it if it is an I- or E- of the type of an open span
+    continues = torch.zeros_like(inside)
+    continues[:, 1:] = ((prefix[:, 1:] == INSIDE) | (prefix[:, 1:] == END)) & \
+        ((prefix[:, :-1] == BEGIN) | (prefix[:, :-1] == INSIDE)) & (types[:, 1:] == types[:, :-1])
+    begins = inside & ~continues
+    ends = inside & ~torch.roll(continues, -1, dims=1)
+
+    iobes = bool((label_of[:, END] >= 0).any() or (label_of[:, SINGLE] >= 0).any())
+    if iobes:
+        role = torch.where(begins, torch.where(ends, SINGLE, BEGIN), torch.where(ends, END, INSIDE))
+    else:
+        role = torch.where(begins, BEGIN, INSIDE)
+    repaired = label_of[types, role]
+    labels = torch.where(inside & (repaired >= 0), repaired, labels)
+    return best.masked_fill(~valid, 0).sum(1), labels.masked_fill(~valid, pad_idx)
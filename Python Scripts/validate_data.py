@@ -0,0 +1,293 @@
+'''
+v1.0.0 -- 19 Oct 2026
+Validates TriggerNER data files in a single streaming pass per file.
+Reads CoNLL-style files ("token label" per line, sentences separated by blank
+lines) as well as JSON/JSONL files in the format written by the Doccano to
+TriggerNER converters:
+
+{"text": "Man in Belgium .", "label": "O O B-LOC O", "explanation": "O T-0 O O"}
+
+Runs the following checks on every sentence, selectable with --checks:
+	gaps	Gaps in the enumeration of trigger entities, of any length.
+	bio		Entity labels that break the BIO scheme, e.g. I-LOC after O.
+	counts	Sentences with a different number of tokens and labels.
+
+Compares a manually marked file with its prelabelled counterpart if given
+--overlap, reporting token-level true/false positives/negatives as well as
+span-level precision, recall and F1 for trigger and entity spans.
+
+Can validate every data file in a folder if given a folder. Several files are
+validated in parallel, see --workers.
+
+Exits with status 1 when a check finds a problem, when sentences of --overlap
+files had to be skipped, or on an error, so the script can gate training runs.
+
+Usage:
+	validate_data.py [--checks gaps,bio,counts] [--workers N] <file or folder> [...]
+	validate_data.py --overlap <manual file> <prelabelled file>
+'''
+import json, os, re, sys
+from itertools import zip_longest
+from multiprocessing import Pool
+
+DATA_EXTENSIONS = (".json", ".jsonl", ".txt", ".conll")
+READ_SIZE = 1 << 16
+
+def is_trigger(label):
+	return label.startswith("T-")
+
+def make_sentence(where, tokens, labels):
+	# Splits one mixed label column into entity labels and trigger labels
+	entities = ["O" if is_trigger(label) else label for label in labels]
+	triggers = [label if is_trigger(label) else "O" for label in labels]
+	return {"where": where, "tokens": tokens, "labels": entities, "triggers": triggers}
+
+def read_conll(file):
+	tokens = []
+	labels = []
+	start = 1
+	for number, line in enumerate(file, start=1):
+		fields = line.split()
+		if not fields:
+			if tokens:
+				yield make_sentence(f"line {start}", tokens, labels)
+			tokens = []
+			labels = []
+			start = number + 1
+			continue
+		tokens.append(fields[0])
+		if len(fields) > 1:
+			labels.append(fields[-1])
+	if tokens:
+		yield make_sentence(f"line {start}", tokens, labels)
+
+def iter_json_records(file):
+	# Decodes the records of a JSON array or a JSONL file without reading the whole file at once
+	decoder = json.JSONDecoder()
+	buffer = ""
+	in_array = None
+	eof = False
+	while True:
+		buffer = buffer.lstrip()
+		if in_array is None and buffer:
+			in_array = buffer[0] == "["
+			if in_array:
+				buffer = buffer[1:]
+			continue
+		if in_array and buffer.startswith(","):
+			buffer = buffer[1:]
+			continue
+		if in_array and buffer.startswith("]"):
+			return
+		if buffer:
+			try:
+				record, end = decoder.raw_decode(buffer)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+			else:
+				yield record
+				buffer = buffer[end:]
+				continue
+		if eof:
+			return
+		chunk = file.read(READ_SIZE)
+		eof = not chunk
+		buffer += chunk
+
+def read_json(file):
+	for index, record in enumerate(iter_json_records(file)):
+		tokens = record.get("text", "").split()
+		labels = record.get("label")
+		triggers = record.get("explanation")
+		if not isinstance(labels, str):							# Unlabelled test data or Doccano spans
+			yield {"where": f"record {index}", "tokens": tokens, "labels": None, "triggers": None}
+			continue
+		sentence = make_sentence(f"record {index}", tokens, labels.split())
+		if triggers is not None:
+			sentence["triggers"] = triggers.split()
+		yield sentence
+
+def read_sentences(filepath):
+	with open(filepath, "r", encoding="utf8") as file:
+		if re.search(r"\.jsonl?$", filepath):
+			yield from read_json(file)
+		else:
+			yield from read_conll(file)
+
+def check_gaps(sentence):
+	if sentence["triggers"] is None:
+		return []
+	enums = set()
+	for label in sentence["triggers"]:
+		if is_trigger(label) and label[2:].isdigit():
+			enums.add(int(label[2:]))
+	if not enums:
+		return []
+	missing = sorted(set(range(max(enums))) - enums)
+	if not missing:
+		return []
+	return [f"Trigger enumeration gap, missing {', '.join(f'T-{enum}' for enum in missing)}"]
+
+def check_bio(sentence):
+	problems = []
+	if sentence["labels"] is None:
+		return problems
+	previous = "O"
+	for i, label in enumerate(sentence["labels"]):
+		if label != "O" and not re.match(r"[BI]-.+", label):
+			problems.append(f"Unknown label {label} at token {i}")
+		elif label.startswith("I-") and previous[2:] != label[2:]:
+			problems.append(f"{label} follows {previous} at token {i}")
+		previous = label
+	return problems
+
+def check_counts(sentence):
+	problems = []
+	tokens = len(sentence["tokens"])
+	for column in ("labels", "triggers"):
+		if sentence[column] is not None and len(sentence[column]) != tokens:
+			problems.append(f"{tokens} tokens but {len(sentence[column])} {column}")
+	return problems
+
+CHECKS = {"gaps": check_gaps, "bio": check_bio, "counts": check_counts}
+
+def validate_file(filepath, checks):
+	checked = 0
+	problems = {name: [] for name in checks}
+	for sentence in read_sentences(filepath):
+		checked += 1
+		for name in checks:
+			for problem in CHECKS[name](sentence):
+				problems[name].append(f"{sentence['where']}: {problem}")
+	return filepath, checked, problems
+
+def get_spans(labels):
+	# Entity spans follow BIO, trigger spans are runs of the same T-n label
+	spans = set()
+	start = None
+	for i, label in enumerate(labels + ["O"]):
+		if start is not None:
+			current = labels[start]
+			continues = label == current if is_trigger(current) else label == f"I-{current[2:]}"
+			if continues:
+				continue
+			spans.add((start, i, current if is_trigger(current) else current[2:]))
+			start = None
+		if label != "O":
+			start = i
+	return spans
+
+def count_spans(manual, prelabelled, counts, by_position=False):
+	if by_position:
+		manual = {(start, end) for start, end, _ in manual}
+		prelabelled = {(start, end) for start, end, _ in prelabelled}
+	counts[0] += len(manual & prelabelled)
+	counts[1] += len(manual)
+	counts[2] += len(prelabelled)
+
+def span_scores(matched, predicted, expected):
+	precision = matched / predicted if predicted else 0
+	recall = matched / expected if expected else 0
+	f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0
+	return precision, recall, f1
+
+def compare_files(file_manual, file_prelabelled):
+	tokens = {"true_positives": 0, "false_positives": 0, "true_negatives": 0, "false_negatives": 0}
+	trigger_spans = [0, 0, 0]
+	entity_spans = [0, 0, 0]
+	skipped = []
+	for sentence_m, sentence_p in zip_longest(read_sentences(file_manual), read_sentences(file_prelabelled)):
+		if sentence_p is None:
+			skipped.append(f"{sentence_m['where']} of {file_manual}, no such sentence in {file_prelabelled}")
+			continue
+		if sentence_m is None:
+			skipped.append(f"{sentence_p['where']} of {file_prelabelled}, no such sentence in {file_manual}")
+			continue
+		if sentence_m["tokens"] != sentence_p["tokens"]:
+			skipped.append(f"{sentence_m['where']}, tokens differ between both files")
+			continue
+		if sentence_m["triggers"] is None or sentence_p["triggers"] is None:
+			unlabelled = file_manual if sentence_m["triggers"] is None else file_prelabelled
+			skipped.append(f"{sentence_m['where']}, unlabelled in {unlabelled}")
+			continue
+		for label_m, label_p in zip(sentence_m["triggers"], sentence_p["triggers"]):
+			if label_p == "O":
+				tokens["true_negatives" if label_m == "O" else "false_positives"] += 1
+			elif label_m.startswith("T-"):
+				tokens["true_positives"] += 1
+			else:
+				tokens["false_negatives"] += 1
+		# Trigger enumeration may differ between both files, so trigger spans are compared by position only
+		count_spans(get_spans(sentence_m["triggers"]), get_spans(sentence_p["triggers"]), trigger_spans, True)
+		count_spans(get_spans(sentence_m["labels"]), get_spans(sentence_p["labels"]), entity_spans)
+	return tokens, span_scores(*trigger_spans), span_scores(*entity_spans), skipped
+
+def list_files(paths):
+	for path in paths:
+		if os.path.isdir(path):
+			yield from list_files(sorted(os.path.join(path, subfile) for subfile in os.listdir(path)))
+		elif path.endswith(DATA_EXTENSIONS):
+			yield path
+
+def parse_arguments(arguments):
+	options = {"checks": list(CHECKS), "workers": os.cpu_count() or 1, "overlap": False, "paths": []}
+	arguments = iter(arguments)
+	for argument in arguments:
+		if argument == "--checks":
+			options["checks"] = next(arguments).split(",")
+		elif argument == "--workers":
+			options["workers"] = int(next(arguments))
+		elif argument == "--overlap":
+			options["overlap"] = True
+		else:
+			options["paths"].append(argument)
+	for name in options["checks"]:
+		if name not in CHECKS:
+			raise ValueError(f"Unknown check {name}, choose from {', '.join(CHECKS)}")
+	if not options["paths"]:
+		raise ValueError(__doc__)
+	return options
+
+def run_checks(options):
+	files = list(list_files(options["paths"]))
+	workers = max(1, min(options["workers"], len(files)))
+	total_checked = 0
+	total_problems = {name: 0 for name in options["checks"]}
+	with Pool(workers) as pool:
+		jobs = pool.starmap(validate_file, [(filepath, options["checks"]) for filepath in files])
+		for filepath, checked, problems in jobs:
+			print(f"{filepath}:")
+			for name, messages in problems.items():
+				for message in messages:
+					print(f"\t[{name}] {message}")
+				total_problems[name] += len(messages)
+			total_checked += checked
+	print(f"Files checked: {len(files)}\nSentences checked: {total_checked}")
+	for name, count in total_problems.items():
+		print(f"{name.capitalize()} problems: {count}")
+	return sum(total_problems.values())
+
+def run_overlap(options):
+	if len(options["paths"]) != 2:
+		raise ValueError("--overlap needs a manual file and a prelabelled file")
+	tokens, triggers, entities, skipped = compare_files(*options["paths"])
+	for reason in skipped:
+		print(f"Skipped {reason}")
+	print(f" True positives: {tokens['true_positives']}\nFalse positives: {tokens['false_positives']}\n True negatives: {tokens['true_negatives']}\nFalse negatives: {tokens['false_negatives']}")
+	print("Trigger spans -- Precision: %.4f, Recall: %.4f, F1: %.4f" % triggers)
+	print("Entity spans  -- Precision: %.4f, Recall: %.4f, F1: %.4f" % entities)
+	return len(skipped)
+
+if __name__ == "__main__":	# Guarded so worker processes can import this file
+	try:
+		options = parse_arguments(sys.argv[1:])
+		if options["overlap"]:
+			problems = run_overlap(options)
+		else:
+			problems = run_checks(options)
+		print(f"Operation complete.")
+	except Exception as e:
+		print(e)
+		sys.exit(1)
+	sys.exit(1 if problems else 0)